@@ -1,15 +1,23 @@
 import click
-from flask import Flask
+from flask import Flask, current_app
 from flask.cli import with_appcontext
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
-from apscheduler.schedulers.background import BackgroundScheduler
 from .config import Config
 from .models import db
 from .routes.main import main_bp
 from .auth.routes import auth_bp
-from .services.aggregation import run_aggregation_for_all_users
+from .services.scheduler import AGGREGATION_LEASE, acquire_lease, lease_owner, run_scheduler
 from .services.notification import mail
+from .services.index_manager import index_manager
+from .services import shared_index
+from .services.embedding_cache import embedding_cache
+from .services.result_cache import result_cache
+from .services.seen_entries import seen_entries
+from .services.article_cache import article_cache
+from .services.ingest import ingest_queue
+from .services.clustering import cluster_cache
+from .services.custom_embeddings import LlamaServerEmbeddings
 
 @click.command('init-db')
 @with_appcontext
@@ -18,30 +26,73 @@ def init_db_command():
     db.create_all()
     click.echo('Initialized the database.')
 
-def create_app():
+@click.command('compact-indexes')
+@click.option('--user-id', help='Compact only this user\'s index.')
+@click.option('--threshold', type=int, help='Minimum number of delta segments to compact.')
+@with_appcontext
+def compact_indexes_command(user_id, threshold):
+    """Fold delta segments and deletions into each user's base vector index."""
+    embeddings = LlamaServerEmbeddings()
+    if user_id:
+        compacted = {user_id: index_manager.compact(user_id, embeddings)}
+    else:
+        compacted = index_manager.compact_all(embeddings, threshold)
+    for uid, result in compacted.items():
+        owner = uid if str(uid).startswith(shared_index.SHARD_PREFIX) else f"user {uid}"
+        click.echo(f"Compacted {result['segments']} segments and removed {result['removed']} vectors for {owner}.")
+
+@click.command('embedding-cache-stats')
+@with_appcontext
+def embedding_cache_stats_command():
+    """Show the embedding cache size and hit rate."""
+    stats = embedding_cache.stats(current_app.config['EMBEDDING_MODEL'])
+    click.echo(f"Entries: {stats['entries']}")
+    click.echo(f"Hits: {stats['hits']}, misses: {stats['misses']} ({stats['hit_rate']:.1%} hit rate)")
+
+@click.command('aggregation-worker')
+@click.option('--no-wait', is_flag=True, help='Exit instead of standing by while another worker is running.')
+@with_appcontext
+def aggregation_worker_command(no_wait):
+    """Run the feed aggregation scheduler; only the worker holding the lease polls feeds."""
+    app = current_app._get_current_object()
+    owner = lease_owner()
+    if acquire_lease(AGGREGATION_LEASE, owner, app.config['AGGREGATION_LEASE_TTL']):
+        click.echo("Acquired the aggregation lease, starting the scheduler.")
+    elif no_wait:
+        raise click.ClickException("Another aggregation worker is already running.")
+    else:
+        click.echo("Another worker holds the aggregation lease, standing by.")
+    run_scheduler(app, owner)
+
+def create_app(test_config=None):
     app = Flask(__name__)
     app.config.from_object(Config)
+    # Applied before the extensions read their settings (the database engine
+    # is created in db.init_app)
+    if test_config:
+        app.config.update(test_config)
 
     CORS(app)
     db.init_app(app)
     JWTManager(app)
     mail.init_app(app)
+    index_manager.init_app(app)
+    embedding_cache.init_app(app)
+    result_cache.init_app(app)
+    seen_entries.init_app(app)
+    article_cache.init_app(app)
+    ingest_queue.init_app(app)
+    cluster_cache.init_app(app)
 
     app.register_blueprint(main_bp)
     app.register_blueprint(auth_bp, url_prefix='/auth')
 
     # Add the command to the app
     app.cli.add_command(init_db_command)
-
-    # Setup scheduler
-    scheduler = BackgroundScheduler()
-    # Run in app context
-    scheduler.add_job(
-        func=lambda: app.app_context().push() or run_aggregation_for_all_users(),
-        trigger="interval",
-        hours=6
-    )
-    scheduler.start()
+    app.cli.add_command(compact_indexes_command)
+    app.cli.add_command(embedding_cache_stats_command)
+    # The aggregation scheduler runs in its own process, see aggregation-worker
+    app.cli.add_command(aggregation_worker_command)
 
     return app
 
@@ -11,6 +11,63 @@ class Config:
     LLAMA_SERVER_LLM_URL = os.environ.get('LLAMA_SERVER_LLM_URL')
     LLAMA_SERVER_EMBEDDING_URL = os.environ.get('LLAMA_SERVER_EMBEDDING_URL')
     LLAMA_SERVER_RERANKING_URL = os.environ.get('LLAMA_SERVER_RERANKING_URL')
+    EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL') or 'ggml-org/embeddinggemma-300M-GGUF'
+    EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', 'embedding_cache.db')
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES') or 200000)
+    EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE') or 64)
+    EMBEDDING_BATCH_TOKENS = int(os.environ.get('EMBEDDING_BATCH_TOKENS') or 8192)
+    EMBEDDING_MAX_WORKERS = int(os.environ.get('EMBEDDING_MAX_WORKERS') or 4)
+    EMBEDDING_MAX_RETRIES = int(os.environ.get('EMBEDDING_MAX_RETRIES') or 3)
+    EMBEDDING_TIMEOUT = int(os.environ.get('EMBEDDING_TIMEOUT') or 60)
+    RERANK_BATCH_SIZE = int(os.environ.get('RERANK_BATCH_SIZE') or 32)
+    RERANK_MAX_WORKERS = int(os.environ.get('RERANK_MAX_WORKERS') or 4)
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or 'uploads'
+    FAISS_INDEX_PATH = os.environ.get('FAISS_INDEX_PATH') or 'faiss_index'
+    FAISS_INDEX_CACHE_BYTES = int(os.environ.get('FAISS_INDEX_CACHE_BYTES') or 512 * 1024 * 1024)
+    FAISS_SEGMENT_COMPACT_THRESHOLD = int(os.environ.get('FAISS_SEGMENT_COMPACT_THRESHOLD') or 8)
+    FAISS_COMPACT_DEAD_RATIO = float(os.environ.get('FAISS_COMPACT_DEAD_RATIO') or 0.2)
+    FAISS_MMAP = (os.environ.get('FAISS_MMAP') or 'true').lower() not in ('0', 'false', 'no')
+    FAISS_HNSW_MIN_VECTORS = int(os.environ.get('FAISS_HNSW_MIN_VECTORS') or 50000)
+    FAISS_IVF_MIN_VECTORS = int(os.environ.get('FAISS_IVF_MIN_VECTORS') or 1000000)
+    FAISS_HNSW_FACTORY = os.environ.get('FAISS_HNSW_FACTORY') or 'HNSW32'
+    FAISS_IVF_FACTORY = os.environ.get('FAISS_IVF_FACTORY') or 'IVF{nlist},SQ8'
+    FAISS_MIN_RECALL = float(os.environ.get('FAISS_MIN_RECALL') or 0.9)
+    FAISS_RECALL_SAMPLE = int(os.environ.get('FAISS_RECALL_SAMPLE') or 200)
+    FAISS_NPROBE = int(os.environ.get('FAISS_NPROBE') or 16)
+    FAISS_EF_SEARCH = int(os.environ.get('FAISS_EF_SEARCH') or 64)
+    FAISS_SHARED_SHARDS = int(os.environ.get('FAISS_SHARED_SHARDS') or 0)
+    FAISS_SHARED_MAX_VECTORS = int(os.environ.get('FAISS_SHARED_MAX_VECTORS') or 10000)
+    FAISS_PREFILTER_EXACT_MAX = int(os.environ.get('FAISS_PREFILTER_EXACT_MAX') or 4096)
+    SEARCH_VECTOR_K = int(os.environ.get('SEARCH_VECTOR_K') or 10)
+    SEARCH_LEXICAL_K = int(os.environ.get('SEARCH_LEXICAL_K') or 10)
+    SEARCH_RRF_K = int(os.environ.get('SEARCH_RRF_K') or 60)
+    SEARCH_RERANK_CANDIDATES = int(os.environ.get('SEARCH_RERANK_CANDIDATES') or 6)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 3600)
+    SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES') or 1024)
+    SEARCH_CACHE_PATH = os.environ.get('SEARCH_CACHE_PATH')
+    AGGREGATION_MAX_WORKERS = int(os.environ.get('AGGREGATION_MAX_WORKERS') or 16)
+    AGGREGATION_PER_HOST_LIMIT = int(os.environ.get('AGGREGATION_PER_HOST_LIMIT') or 2)
+    AGGREGATION_QUEUE_SIZE = int(os.environ.get('AGGREGATION_QUEUE_SIZE') or 64)
+    AGGREGATION_SEEN_FILTER_CAPACITY = int(os.environ.get('AGGREGATION_SEEN_FILTER_CAPACITY') or 1000000)
+    AGGREGATION_SEEN_FILTER_ERROR_RATE = float(os.environ.get('AGGREGATION_SEEN_FILTER_ERROR_RATE') or 0.001)
+    ARTICLE_CACHE_PATH = os.environ.get('ARTICLE_CACHE_PATH', 'article_cache.db')
+    ARTICLE_CACHE_MAX_ENTRIES = int(os.environ.get('ARTICLE_CACHE_MAX_ENTRIES') or 5000)
+    ARTICLE_CACHE_TTL = int(os.environ.get('ARTICLE_CACHE_TTL') or 86400)
+    FEED_POLL_TICK = int(os.environ.get('FEED_POLL_TICK') or 300)
+    INGEST_MAX_WORKERS = int(os.environ.get('INGEST_MAX_WORKERS') or 2)
+    INGEST_EAGER = os.environ.get('INGEST_EAGER') is not None
+    INGEST_JOB_TIMEOUT = int(os.environ.get('INGEST_JOB_TIMEOUT') or 3600)
+    INGEST_POLL_INTERVAL = int(os.environ.get('INGEST_POLL_INTERVAL') or 60)
+    INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE') or 512)
+    CLUSTER_CACHE_MAX_USERS = int(os.environ.get('CLUSTER_CACHE_MAX_USERS') or 256)
+    CLUSTER_DRIFT_THRESHOLD = float(os.environ.get('CLUSTER_DRIFT_THRESHOLD') or 1.5)
+    CLUSTER_REFIT_RATIO = float(os.environ.get('CLUSTER_REFIT_RATIO') or 0.5)
+    AGGREGATION_LEASE_TTL = int(os.environ.get('AGGREGATION_LEASE_TTL') or 120)
+    FEED_POLL_DEFAULT_INTERVAL = int(os.environ.get('FEED_POLL_DEFAULT_INTERVAL') or 6 * 3600)
+    FEED_POLL_MIN_INTERVAL = int(os.environ.get('FEED_POLL_MIN_INTERVAL') or 900)
+    FEED_POLL_MAX_INTERVAL = int(os.environ.get('FEED_POLL_MAX_INTERVAL') or 86400)
+    FEED_POLL_BACKOFF = float(os.environ.get('FEED_POLL_BACKOFF') or 1.5)
+    FEED_POLL_JITTER = float(os.environ.get('FEED_POLL_JITTER') or 0.1)
     BING_API_KEY = os.environ.get('BING_API_KEY')
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 587)
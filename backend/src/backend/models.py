@@ -16,6 +16,9 @@ class User(db.Model):
         return check_password_hash(self.password_hash, password)
 
 class Document(db.Model):
+    # Ids must never be reused: deleted ids are tombstoned in the vector index
+    __table_args__ = {'sqlite_autoincrement': True}
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     file_path = db.Column(db.String(255), nullable=False)
@@ -23,12 +26,77 @@ class Document(db.Model):
     source = db.Column(db.String(255)) # URL or file name
     tags = db.Column(db.String(255)) # Comma-separated tags
     uploaded_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    terms_counted = db.Column(db.Boolean, default=False) # Set once its terms are in document_term and user_term
 
     user = db.relationship('User', backref=db.backref('documents', lazy=True))
 
+class DocumentText(db.Model):
+    """Text extracted from a document at ingest time, one entry per page."""
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), primary_key=True)
+    content = db.Column(db.LargeBinary, nullable=False) # zlib-compressed JSON list of page texts
+
+    document = db.relationship('Document', backref=db.backref('text', uselist=False, cascade='all, delete-orphan'))
+
+class DocumentTerm(db.Model):
+    """Number of occurrences of a term in a document, computed at ingest time."""
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), primary_key=True)
+    term = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+class UserTerm(db.Model):
+    """Number of occurrences of a term across all of a user's documents."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    term = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+class IngestJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    file_path = db.Column(db.String(255), nullable=False)
+    document_type = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued') # 'queued', 'running', 'done' or 'failed'
+    stage = db.Column(db.String(20)) # 'parse', 'chunk', 'embed' or 'index' while running
+    error = db.Column(db.Text)
+    document_id = db.Column(db.Integer) # Set once the job is done; the document may be deleted later
+    bulk_id = db.Column(db.String(32), index=True) # Shared by the jobs queued by one upload request
+    notified = db.Column(db.Boolean, nullable=False, default=False) # Set on the bulk's jobs once its notification is sent
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    user = db.relationship('User', backref=db.backref('ingest_jobs', lazy=True))
+
 class RssFeed(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     url = db.Column(db.String(255), nullable=False)
+    etag = db.Column(db.String(255)) # Validators of the last fetch, sent back as a conditional GET
+    last_modified = db.Column(db.String(64))
+    poll_interval = db.Column(db.Integer) # Seconds between polls, learned from the feed's activity
+    next_poll_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    user = db.relationship('User', backref=db.backref('feeds', lazy=True))
+
+class FeedEntry(db.Model):
+    """An RSS feed entry that has already been ingested for the feed's user."""
+    id = db.Column(db.Integer, primary_key=True)
+    feed_id = db.Column(db.Integer, db.ForeignKey('rss_feed.id'), nullable=False)
+    entry_key = db.Column(db.String(40), nullable=False) # SHA-1 of the entry's GUID or link
+    ingested_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    feed = db.relationship('RssFeed', backref=db.backref('entries', lazy=True, cascade='all, delete-orphan'))
+
+    __table_args__ = (db.UniqueConstraint('feed_id', 'entry_key'),)
+
+class AggregationRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    new_count = db.Column(db.Integer, default=0)
+    skipped_count = db.Column(db.Integer, default=0)
+    failed_count = db.Column(db.Integer, default=0)
 
-    user = db.relationship('User', backref=db.backref('feeds', lazy=True))
\ No newline at end of file
+class SchedulerLease(db.Model):
+    name = db.Column(db.String(64), primary_key=True)
+    owner = db.Column(db.String(255), nullable=False) # host:pid of the worker holding it
+    expires_at = db.Column(db.DateTime, nullable=False)
@@ -1,31 +1,74 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from ..services import knowledge_base, search, feeds, clustering
+from ..services import knowledge_base, search, feeds, clustering, ingest
+from ..services.custom_embeddings import EmbeddingError
 from datetime import datetime
+import json
+import tarfile
+import zipfile
 
 main_bp = Blueprint('main', __name__)
 
-@main_bp.route('/documents', methods=['GET'])
-@jwt_required()
-def get_documents():
-    user_id = get_jwt_identity()
-    doc_type = request.args.get('type')
-    start_date_str = request.args.get('start_date')
-    end_date_str = request.args.get('end_date')
+def _date_filters(params=None):
+    """
+    Parses the start_date and end_date query parameters (or keys of params).
+    Returns (start_date, end_date, error), where error is a response for an
+    invalid date, including a value that is not a string in a JSON body.
+    """
+    params = request.args if params is None else params
+    start_date_str = params.get('start_date')
+    end_date_str = params.get('end_date')
 
     start_date = None
     if start_date_str:
         try:
             start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
-        except ValueError:
-            return jsonify({"msg": "Invalid start_date format. Use YYYY-MM-DD."}), 400
+        except (TypeError, ValueError):
+            return None, None, (jsonify({"msg": "Invalid start_date format. Use YYYY-MM-DD."}), 400)
 
     end_date = None
     if end_date_str:
         try:
             end_date = datetime.strptime(end_date_str + " 23:59:59", '%Y-%m-%d %H:%M:%S')
-        except ValueError:
-            return jsonify({"msg": "Invalid end_date format. Use YYYY-MM-DD."}), 400
+        except (TypeError, ValueError):
+            return None, None, (jsonify({"msg": "Invalid end_date format. Use YYYY-MM-DD."}), 400)
+    return start_date, end_date, None
+
+def _search_filters(data):
+    """
+    Parses the document filters of a search request body: type, start_date,
+    end_date, tags (a list or a comma-separated string) and source. Returns
+    (filters, error), where error is a response for an invalid filter.
+    """
+    start_date, end_date, error = _date_filters(data)
+    if error:
+        return None, error
+    tags = data.get('tags')
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    if tags is not None and not (isinstance(tags, list) and all(isinstance(tag, str) for tag in tags)):
+        return None, (jsonify({"msg": "tags must be a list of strings."}), 400)
+    tags = [tag.strip() for tag in tags or [] if tag.strip()]
+    for key in ('type', 'source'):
+        if data.get(key) is not None and not isinstance(data.get(key), str):
+            return None, (jsonify({"msg": f"{key} must be a string."}), 400)
+    filters = {
+        "doc_type": data.get('type'),
+        "start_date": start_date,
+        "end_date": end_date,
+        "tags": tags or None,
+        "source": data.get('source'),
+    }
+    return {key: value for key, value in filters.items() if value}, None
+
+@main_bp.route('/documents', methods=['GET'])
+@jwt_required()
+def get_documents():
+    user_id = get_jwt_identity()
+    doc_type = request.args.get('type')
+    start_date, end_date, error = _date_filters()
+    if error:
+        return error
     
     docs = knowledge_base.get_user_documents(user_id, doc_type, start_date, end_date)
     return jsonify(docs)
@@ -40,11 +83,45 @@ def upload_document():
         return jsonify({"msg": "No selected file"}), 400
     
     user_id = get_jwt_identity()
-    doc = knowledge_base.add_document(user_id, file)
-    if doc:
-        return jsonify({"msg": "File uploaded successfully"}), 201
+    # Parsing, embedding and indexing happen in the background; clients
+    # follow the job through /documents/jobs/<job_id>.
+    job = ingest.ingest_queue.submit(user_id, file)
+    if job:
+        return jsonify({"msg": "File uploaded successfully", "job_id": job.id, "status": job.status}), 202
     return jsonify({"msg": "File type not supported"}), 400
 
+@main_bp.route('/documents/bulk', methods=['POST'])
+@jwt_required()
+def bulk_upload_documents():
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files:
+        return jsonify({"msg": "No files provided"}), 400
+
+    user_id = get_jwt_identity()
+    # Every file becomes an ingest job; workers embed and index them in
+    # batches, and clients follow each job through /documents/jobs/<job_id>.
+    try:
+        queued = ingest.ingest_queue.submit_many(user_id, knowledge_base.iter_upload_files(files))
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        print(e)
+        return jsonify({"msg": "Invalid archive"}), 400
+    report = [
+        {"filename": filename, "job_id": job.id, "status": job.status} if job
+        else {"filename": filename, "error": "File type not supported"}
+        for filename, job in queued
+    ]
+    uploaded = sum('job_id' in entry for entry in report)
+    return jsonify({"msg": f"{uploaded} of {len(report)} files uploaded successfully", "files": report}), 202
+
+@main_bp.route('/documents/jobs/<int:job_id>', methods=['GET'])
+@jwt_required()
+def get_ingest_job(job_id):
+    user_id = get_jwt_identity()
+    job = ingest.get_job(user_id, job_id)
+    if job:
+        return jsonify(job)
+    return jsonify({"msg": "Job not found"}), 404
+
 @main_bp.route('/documents/<int:doc_id>', methods=['DELETE'])
 @jwt_required()
 def delete_document(doc_id):
@@ -82,15 +159,57 @@ def search_documents():
     query = request.json.get('query')
     if not query:
         return jsonify({"msg": "Query is required"}), 400
+    filters, error = _search_filters(request.json)
+    if error:
+        return error
     user_id = get_jwt_identity()
-    results = search.perform_search(user_id, query)
+    try:
+        results = search.perform_search(user_id, query, filters)
+    except EmbeddingError as e:
+        print(e)
+        return jsonify({"msg": "Embedding service unavailable, please try again later"}), 503
     return jsonify(results)
 
+@main_bp.route('/search/stream', methods=['POST'])
+@jwt_required()
+def stream_search_documents():
+    """
+    Streams the answer as server-sent events: a "token" event per piece of
+    generated text, then a "sources" event. Answers not generated live (cached
+    or Bing results) arrive as a single "result" event. A final "done" event
+    closes the stream.
+    """
+    query = request.json.get('query')
+    if not query:
+        return jsonify({"msg": "Query is required"}), 400
+    filters, error = _search_filters(request.json)
+    if error:
+        return error
+    user_id = get_jwt_identity()
+
+    def generate():
+        try:
+            for event, data in search.stream_search(user_id, query, filters):
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        except EmbeddingError as e:
+            print(e)
+            yield f"event: error\ndata: {json.dumps({'msg': 'Embedding service unavailable, please try again later'})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
 @main_bp.route('/report/keywords', methods=['GET'])
 @jwt_required()
 def keyword_report():
     user_id = get_jwt_identity()
-    report = search.generate_keyword_report(user_id)
+    start_date, end_date, error = _date_filters()
+    if error:
+        return error
+    report = search.generate_keyword_report(user_id, request.args.get('type'), start_date, end_date)
     return jsonify(report)
 
 @main_bp.route('/report/clustering', methods=['GET'])
@@ -1,17 +1,72 @@
+import datetime
 import feedparser
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
 from io import BytesIO
+from urllib.parse import urlparse
 import werkzeug
-import requests
 from bs4 import BeautifulSoup
-from .knowledge_base import add_document
-from ..models import RssFeed
+from flask import current_app
+from .knowledge_base import add_shared_document
+from .feeds import normalize_feed_url
+from .feed_schedule import next_interval, next_poll_time, initial_poll_time
+from .seen_entries import seen_entries
+from .article_cache import article_cache
+from .http_session import get_session
+from ..models import db, RssFeed, AggregationRun
+
+def _download_feed(url, etag, modified):
+    """
+    Fetches and parses a feed, conditionally on the ETag and Last-Modified
+    values of its previous response. Returns a result with status 304 and no
+    entries if the feed has not changed.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    response = get_session().get(url, headers=headers, timeout=10)
+    if response.status_code == 304:
+        return feedparser.FeedParserDict(status=304, entries=[])
+    response.raise_for_status()
+    # feedparser reads the content type and base URL from lowercase header names
+    parsed_feed = feedparser.parse(response.content, response_headers={name.lower(): value for name, value in response.headers.items()})
+    parsed_feed['status'] = response.status_code
+    parsed_feed['etag'] = response.headers.get('ETag')
+    parsed_feed['modified'] = response.headers.get('Last-Modified')
+    return parsed_feed
+
+def _download_article(url):
+    """
+    Returns the HTML of an article page. A copy in the article cache younger
+    than ARTICLE_CACHE_TTL is used as is; an older one is revalidated with a
+    conditional request and reused if the server answers 304.
+    """
+    cached = article_cache.get(url)
+    if cached and time.time() - cached['fetched_at'] < current_app.config.get('ARTICLE_CACHE_TTL', 86400):
+        return cached['content']
+
+    headers = {}
+    if cached and cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached['last_modified']:
+        headers['If-Modified-Since'] = cached['last_modified']
+    response = get_session().get(url, headers=headers, timeout=10)
+    if cached and response.status_code == 304:
+        article_cache.touch(url)
+        return cached['content']
+    response.raise_for_status()
+    article_cache.put(url, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    return response.content
 
 def _get_article_text(url):
     """Fetches and extracts the main text content from a URL."""
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, 'lxml')
+        soup = BeautifulSoup(_download_article(url), 'lxml')
         
         # A simple approach to find the main content
         # This can be improved with more sophisticated extraction logic
@@ -22,32 +77,272 @@ def _get_article_text(url):
         print(f"  - Failed to fetch or parse article content from {url}: {e}")
         return None
 
-def run_aggregation_for_all_users():
+class _HostQueue:
+    """
+    Runs requests on a thread pool with at most limit of them in flight per
+    host. Requests to a busy host wait in that host's queue instead of in a
+    pool thread, so a slow host cannot occupy the pool while requests to
+    other hosts are waiting.
+    """
+    def __init__(self, pool, limit):
+        self._pool = pool
+        self._limit = limit
+        self._active = {}
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def submit(self, url, fn, *args):
+        """Schedules fn(*args), a request to url. Returns a Future of its result."""
+        host = urlparse(url).netloc.lower()
+        future = Future()
+        with self._lock:
+            if self._active.get(host, 0) >= self._limit:
+                self._waiting.setdefault(host, deque()).append((future, fn, args))
+                return future
+            self._active[host] = self._active.get(host, 0) + 1
+        self._pool.submit(self._run, host, future, fn, args)
+        return future
+
+    def _run(self, host, future, fn, args):
+        try:
+            result, error = fn(*args), None
+        except Exception as e:
+            result, error = None, e
+        # The host's slot is handed on before the result is delivered, so
+        # callbacks waiting for room in the article queue do not hold it
+        with self._lock:
+            waiting = self._waiting.get(host)
+            request = waiting.popleft() if waiting else None
+            if request is None:
+                self._active[host] -= 1
+        if request is not None:
+            self._pool.submit(self._run, host, *request)
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+_DONE = object()
+
+def _fetch_articles(app, feeds, articles, counts, validators, polls, max_workers, per_host_limit):
+    """
+    Fetches the feeds and the full text of their new entries on a thread
+    pool and puts (key, entry, content, subscribers) tuples on the articles
+    queue. feeds holds (url, subscriptions) pairs, with one pair per
+    distinct feed; each feed is fetched once and every new entry is queued
+    once with the (feed_id, user_id) pairs of the subscriptions it is new
+    for.
+
+    Feeds are requested conditionally with their stored ETag and
+    Last-Modified values, and those answering 304 are skipped; the
+    validators of the other feeds are collected in validators. The outcome
+    of each feed's poll is recorded in polls as (status, entries,
+    new_entries), keyed by its URL. Entries
+    already ingested are counted in counts['skipped'] and never downloaded,
+    and a link shared by several entries is downloaded once. The queue is
+    bounded, so fetching pauses while ingestion catches up.
+    """
+    pages = {}
+
+    def fetch_page(url):
+        with app.app_context():
+            return _get_article_text(url)
+
+    def queue_article(page, key, entry, subscribers):
+        # Runs once the page is downloaded; the returned future is done when
+        # the article is on the queue
+        queued = Future()
+
+        def put(page):
+            try:
+                articles.put((key, entry, page.result() if page.exception() is None else None, subscribers))
+            finally:
+                queued.set_result(None)
+
+        page.add_done_callback(put)
+        return queued
+
+    def request_validators(subscriptions):
+        # Subscriptions added after the last fetch have no validators yet
+        stored = {(etag, modified) for _, _, etag, modified in subscriptions}
+        return stored.pop() if len(stored) == 1 else (None, None)
+
+    try:
+        with app.app_context(), ThreadPoolExecutor(max_workers=max_workers) as pool:
+            hosts = _HostQueue(pool, per_host_limit)
+            feed_futures = {
+                hosts.submit(url, _download_feed, url, *request_validators(subscriptions)): (url, subscriptions)
+                for url, subscriptions in feeds
+            }
+            article_futures = []
+            for future in as_completed(feed_futures):
+                url, subscriptions = feed_futures[future]
+                try:
+                    parsed_feed = future.result()
+                except Exception as e:
+                    print(f"Failed to fetch feed {url}: {e}")
+                    polls[url] = ('failed', [], 0)
+                    continue
+                if parsed_feed.get('status') == 304:
+                    print(f"Feed not modified since last run: {url}")
+                    polls[url] = ('not_modified', [], 0)
+                    continue
+
+                entries = {}
+                subscribers = {}
+                for feed_id, user_id, _, _ in subscriptions:
+                    validators[feed_id] = (parsed_feed.get('etag'), parsed_feed.get('modified'))
+                    new_entries = seen_entries.new_entries(feed_id, parsed_feed.entries)
+                    counts['skipped'] += len(parsed_feed.entries) - len(new_entries)
+                    for key, entry in new_entries:
+                        entries.setdefault(key, entry)
+                        subscribers.setdefault(key, []).append((feed_id, user_id))
+                polls[url] = ('fetched', parsed_feed.entries, len(entries))
+                print(f"Aggregating feed {url} for {len(subscriptions)} subscribers ({len(entries)} new entries)")
+                for key, entry in entries.items():
+                    if entry.link not in pages:
+                        pages[entry.link] = hosts.submit(entry.link, fetch_page, entry.link)
+                    article_futures.append(queue_article(pages[entry.link], key, entry, subscribers[key]))
+            wait(article_futures)
+    finally:
+        articles.put(_DONE)
+
+def run_aggregation_for_all_users(due_only=False):
     """
     Iterates through all stored RSS feeds and adds new entries to the
-    knowledge base for each user.
+    knowledge base for each user. With due_only, only feeds whose next poll
+    time has passed are polled; this is how the scheduler runs it.
+
+    Each poll updates the feed's polling interval from its publishing
+    cadence and 304 rate (see feed_schedule.next_interval) and schedules
+    its next poll with some jitter, so busy feeds are polled often and
+    dormant ones rarely, without all feeds falling due at the same time.
+
+    Subscriptions are grouped by normalized feed URL: each distinct feed
+    and article is fetched once per run, and each article is split and
+    embedded once before being added to every subscriber's knowledge base.
+
+    Feeds and articles are downloaded concurrently, with at most
+    AGGREGATION_MAX_WORKERS requests in flight overall and
+    AGGREGATION_PER_HOST_LIMIT per host. Fetched articles are handed to
+    ingestion through a queue of AGGREGATION_QUEUE_SIZE entries, so
+    downloads overlap with embedding.
+
+    Entries already ingested from a feed are skipped before any request is
+    made; an entry is recorded as seen only once it has been added, so
+    failed entries are retried on the next run. Returns the AggregationRun
+    with the number of new, skipped and failed entries, or None if no feed
+    was due.
     """
+    config = current_app.config
+    now = datetime.datetime.utcnow()
+    feeds = {}
+    intervals = {}
+    due = set()
+    for feed in RssFeed.query.all():
+        key = normalize_feed_url(feed.url)
+        url, subscriptions = feeds.setdefault(key, (feed.url, []))
+        subscriptions.append((feed.id, feed.user_id, feed.etag, feed.last_modified))
+        intervals[url] = intervals.get(url) or feed.poll_interval
+        if due_only and feed.next_poll_at is None:
+            # Feeds never scheduled before are spread over their first
+            # interval instead of all being polled on the first tick.
+            feed.next_poll_at = initial_poll_time(feed.poll_interval or config.get('FEED_POLL_DEFAULT_INTERVAL', 21600), now)
+        if not due_only or feed.next_poll_at <= now:
+            due.add(key)
+    db.session.commit()
+    feeds = [feeds[key] for key in due]
+    if not feeds:
+        return None
+
     print("Running scheduled news aggregation...")
-    feeds = RssFeed.query.all()
-    for feed in feeds:
-        print(f"Aggregating feed for user {feed.user_id}: {feed.url}")
-        parsed_feed = feedparser.parse(feed.url)
-        for entry in parsed_feed.entries:
-            # Try to get full article text, fall back to summary
-            content = _get_article_text(entry.link)
-            if not content or len(content) < len(entry.summary):
-                content = entry.summary
-
-            full_content = f"{entry.title}\n\n{content}"
-            
-            # Sanitize filename
-            filename = "".join(c for c in entry.title if c.isalnum() or c in (' ', '.', '_')).rstrip()
-            filename = f"{filename}.txt"
-
-            file_obj = werkzeug.datastructures.FileStorage(
-                stream=BytesIO(full_content.encode('utf-8')),
-                filename=filename
-            )
-            
-            add_document(feed.user_id, file_obj)
-            print(f"  - Added: {entry.title}")
+    run = AggregationRun()
+    db.session.add(run)
+    db.session.commit()
+
+    articles = queue.Queue(maxsize=config.get('AGGREGATION_QUEUE_SIZE', 64))
+    counts = {'new': 0, 'skipped': 0, 'failed': 0}
+    validators = {}
+    polls = {}
+    failed_feeds = set()
+    fetcher = threading.Thread(
+        target=_fetch_articles,
+        args=(
+            current_app._get_current_object(),
+            feeds,
+            articles,
+            counts,
+            validators,
+            polls,
+            config.get('AGGREGATION_MAX_WORKERS', 16),
+            config.get('AGGREGATION_PER_HOST_LIMIT', 2),
+        ),
+        daemon=True,
+    )
+    fetcher.start()
+
+    # Ingestion needs the app context, so it runs on this thread
+    while True:
+        item = articles.get()
+        if item is _DONE:
+            break
+        key, entry, content, subscribers = item
+
+        # Fall back to the summary if the full article could not be fetched
+        if not content or len(content) < len(entry.summary):
+            content = entry.summary
+
+        full_content = f"{entry.title}\n\n{content}"
+        
+        # Sanitize filename
+        filename = "".join(c for c in entry.title if c.isalnum() or c in (' ', '.', '_')).rstrip()
+        filename = f"{filename}.txt"
+
+        file_obj = werkzeug.datastructures.FileStorage(
+            stream=BytesIO(full_content.encode('utf-8')),
+            filename=filename
+        )
+        
+        # Keep draining the queue on failure so the fetch threads never block
+        user_ids = list(dict.fromkeys(user_id for _, user_id in subscribers))
+        try:
+            added = add_shared_document(user_ids, file_obj)
+        except Exception as e:
+            print(f"  - Failed to add {entry.title}: {e}")
+            added = {}
+        for feed_id, user_id in subscribers:
+            if not added.get(user_id):
+                counts['failed'] += 1
+                failed_feeds.add(feed_id)
+                continue
+            seen_entries.mark_seen(feed_id, key)
+            counts['new'] += 1
+        added_count = sum(1 for doc in added.values() if doc)
+        if added_count:
+            print(f"  - Added: {entry.title} (for {added_count} of {len(user_ids)} subscribers)")
+    fetcher.join()
+
+    # A feed whose entries could not all be added keeps its old validators,
+    # otherwise the next run would get a 304 and never retry them.
+    for feed_id, (etag, modified) in validators.items():
+        feed = db.session.get(RssFeed, feed_id)
+        if feed and feed_id not in failed_feeds:
+            feed.etag, feed.last_modified = etag, modified
+
+    # Learn each polled feed's cadence and schedule its next poll
+    subscriptions_by_url = dict(feeds)
+    for url, (status, entries, new_entries) in polls.items():
+        interval = next_interval(intervals[url], status, entries, new_entries)
+        next_poll_at = next_poll_time(interval)
+        for feed_id, _, _, _ in subscriptions_by_url[url]:
+            feed = db.session.get(RssFeed, feed_id)
+            if feed:
+                feed.poll_interval, feed.next_poll_at = interval, next_poll_at
+
+    run.new_count = counts['new']
+    run.skipped_count = counts['skipped']
+    run.failed_count = counts['failed']
+    run.finished_at = datetime.datetime.utcnow()
+    db.session.commit()
+    print(f"Aggregation finished: {run.new_count} new, {run.skipped_count} skipped, {run.failed_count} failed")
+    return run
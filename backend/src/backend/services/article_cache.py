@@ -0,0 +1,101 @@
+import sqlite3
+import threading
+import time
+import zlib
+from flask import current_app
+
+ARTICLE_CACHE_PATH = 'article_cache.db'
+
+class ArticleCache:
+    """
+    Bounded local cache of downloaded article pages.
+
+    Pages are stored compressed in a SQLite database together with their
+    ETag and Last-Modified headers, so aggregation can reuse a page fetched
+    within ARTICLE_CACHE_TTL seconds and revalidate older ones with a
+    conditional request. The least recently used pages are evicted beyond
+    ARTICLE_CACHE_MAX_ENTRIES.
+    """
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('ARTICLE_CACHE_PATH', ARTICLE_CACHE_PATH)
+        app.config.setdefault('ARTICLE_CACHE_MAX_ENTRIES', 5000)
+        app.config.setdefault('ARTICLE_CACHE_TTL', 86400)
+
+    @property
+    def enabled(self):
+        return bool(current_app.config.get('ARTICLE_CACHE_PATH'))
+
+    def get(self, url):
+        """Returns a dict with the cached content, etag, last_modified and fetched_at, or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT content, etag, last_modified, fetched_at FROM articles WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE articles SET last_used = ? WHERE url = ?", (time.time(), url))
+            conn.commit()
+        return {
+            "content": zlib.decompress(row[0]),
+            "etag": row[1],
+            "last_modified": row[2],
+            "fetched_at": row[3],
+        }
+
+    def put(self, url, content, etag=None, last_modified=None):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO articles (url, content, etag, last_modified, fetched_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, zlib.compress(content), etag, last_modified, now, now),
+            )
+            conn.execute(
+                "DELETE FROM articles WHERE url IN (SELECT url FROM articles ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (current_app.config.get('ARTICLE_CACHE_MAX_ENTRIES', 5000),),
+            )
+            conn.commit()
+
+    def touch(self, url):
+        """Marks a cached page as fresh again after the server answered 304."""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("UPDATE articles SET fetched_at = ?, last_used = ? WHERE url = ?", (now, now, url))
+            conn.commit()
+
+    def _connection(self):
+        path = current_app.config['ARTICLE_CACHE_PATH']
+        conn = self._connections.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS articles "
+                "(url TEXT PRIMARY KEY, content BLOB NOT NULL, etag TEXT, last_modified TEXT, "
+                "fetched_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_articles_last_used ON articles (last_used)")
+            conn.commit()
+            self._connections[path] = conn
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+
+article_cache = ArticleCache()
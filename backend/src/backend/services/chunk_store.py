@@ -0,0 +1,140 @@
+import json
+import os
+import sqlite3
+import threading
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+CHUNKS_FILE = 'chunks.db'
+LEGACY_DOCSTORE_FILE = 'index.pkl'
+
+# Rows read per query when a whole store is scanned
+READ_BATCH = 4096
+
+def write_chunks(path, documents):
+    """
+    Writes LangChain documents (chunks) to a new chunk store at path. The
+    n-th document is stored under position n, the position of its vector in
+    the FAISS index written next to it.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute(
+            "CREATE TABLE chunks (position INTEGER PRIMARY KEY, doc_id INTEGER, content TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        batch = []
+        for position, doc in enumerate(documents):
+            batch.append((position, doc.metadata.get('doc_id'), doc.page_content, json.dumps(doc.metadata, default=str)))
+            if len(batch) >= READ_BATCH:
+                conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", batch)
+                batch = []
+        conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", batch)
+        conn.execute("CREATE INDEX ix_chunks_doc_id ON chunks (doc_id)")
+        conn.commit()
+    finally:
+        conn.close()
+
+class Positions:
+    """index_to_docstore_id of a chunk store: vector positions are the ids."""
+    def __getitem__(self, position):
+        return int(position)
+
+class ChunkStore(Docstore):
+    """
+    Chunk text and metadata of one index part, read from SQLite by vector
+    position when needed instead of being loaded into memory. Stores are
+    never modified after they are written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def search(self, position):
+        docs = self.get_many([position])
+        return docs.get(int(position), f"ID {position} not found.")
+
+    def get_many(self, positions):
+        """Returns {position: Document} for the given vector positions."""
+        positions = [int(position) for position in positions]
+        if not positions:
+            return {}
+        rows = self._query(
+            f"SELECT position, content, metadata FROM chunks WHERE position IN ({','.join('?' * len(positions))})",
+            positions,
+        )
+        return {position: Document(page_content=content, metadata=json.loads(metadata)) for position, content, metadata in rows}
+
+    def documents(self, start, end):
+        """Returns [(position, Document)] for the positions in [start, end)."""
+        rows = self._query(
+            "SELECT position, content, metadata FROM chunks WHERE position >= ? AND position < ? ORDER BY position",
+            (start, end),
+        )
+        return [(position, Document(page_content=content, metadata=json.loads(metadata))) for position, content, metadata in rows]
+
+    def doc_ids(self):
+        """Returns [(position, doc_id)] for every chunk."""
+        return self._query("SELECT position, doc_id FROM chunks")
+
+    def positions(self, doc_ids):
+        """Vector positions of the chunks belonging to the given documents."""
+        doc_ids = [int(doc_id) for doc_id in doc_ids]
+        if not doc_ids:
+            return []
+        # Passed as one JSON array: filters can select more documents than
+        # SQLite allows query parameters
+        rows = self._query(
+            "SELECT position FROM chunks WHERE doc_id IN (SELECT value FROM json_each(?)) ORDER BY position",
+            (json.dumps(doc_ids),),
+        )
+        return [position for position, in rows]
+
+    def count(self, doc_ids):
+        """Number of chunks belonging to the given documents."""
+        doc_ids = [int(doc_id) for doc_id in doc_ids]
+        if not doc_ids:
+            return 0
+        return self._query(
+            f"SELECT COUNT(*) FROM chunks WHERE doc_id IN ({','.join('?' * len(doc_ids))})",
+            doc_ids,
+        )[0][0]
+
+class PickledChunks(Docstore):
+    """
+    The same interface over the in-memory docstore of an index part written
+    by FAISS.save_local, for indexes saved before chunk stores existed.
+    """
+    def __init__(self, docstore, index_to_docstore_id):
+        self._docstore = docstore
+        self._ids = index_to_docstore_id
+
+    def search(self, position):
+        return self._docstore.search(self._ids[int(position)])
+
+    def get_many(self, positions):
+        return {int(position): self.search(position) for position in positions}
+
+    def documents(self, start, end):
+        end = min(end, len(self._ids))
+        return [(position, self.search(position)) for position in range(start, end)]
+
+    def doc_ids(self):
+        return [(position, self.search(position).metadata.get('doc_id')) for position in range(len(self._ids))]
+
+    def positions(self, doc_ids):
+        doc_ids = {int(doc_id) for doc_id in doc_ids}
+        return [position for position, doc_id in self.doc_ids() if doc_id in doc_ids]
+
+    def count(self, doc_ids):
+        doc_ids = set(doc_ids)
+        return sum(1 for doc in self._docstore._dict.values() if doc.metadata.get('doc_id') in doc_ids)
+
+def store_file(path):
+    """Returns the file holding the chunks of the index part at path."""
+    chunks_path = os.path.join(path, CHUNKS_FILE)
+    return chunks_path if os.path.exists(chunks_path) else os.path.join(path, LEGACY_DOCSTORE_FILE)
@@ -1,34 +1,191 @@
+import threading
+from collections import OrderedDict, defaultdict
+import numpy as np
+from flask import current_app
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from ..models import Document
-from langchain_community.document_loaders import TextLoader, PyPDFLoader, UnstructuredExcelLoader
+from .knowledge_base import iter_document_pages, load_document_pages
+from .custom_embeddings import LlamaServerEmbeddings
+from .index_manager import index_manager
+from .term_stats import backfill_terms, document_top_terms
+
+# Documents listed per cluster, closest to its centroid first
+REPRESENTATIVE_DOCUMENTS = 3
+
+class _ClusterModel:
+    """A user's fitted clustering model and the cluster of each document."""
+    def __init__(self, model, requested, doc_ids, labels, baseline):
+        self.model = model
+        self.requested = requested
+        self.labels = dict(zip(doc_ids, labels))
+        self.fitted = len(doc_ids)
+        # Mean distance of the fitted documents to their nearest centroid,
+        # which drift of later documents is measured against
+        self.baseline = baseline
+        self.changed = 0
+        self.added_distance = 0.0
+        self.added = 0
+        self.version = None
+        self.report = None
+
+class ClusterCache:
+    """
+    Per-user clustering models kept in memory between reports, for the
+    CLUSTER_CACHE_MAX_USERS most recently used users.
+    """
+    def __init__(self):
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self._user_locks = {}
+
+    def init_app(self, app):
+        app.config.setdefault('CLUSTER_CACHE_MAX_USERS', 256)
+        app.config.setdefault('CLUSTER_DRIFT_THRESHOLD', 1.5)
+        app.config.setdefault('CLUSTER_REFIT_RATIO', 0.5)
+
+    def user_lock(self, user_id):
+        """Returns the lock that serializes updates of a user's model."""
+        with self._lock:
+            return self._user_locks.setdefault(str(user_id), threading.Lock())
+
+    def get(self, user_id):
+        with self._lock:
+            state = self._models.get(str(user_id))
+            if state is not None:
+                self._models.move_to_end(str(user_id))
+            return state
+
+    def put(self, user_id, state):
+        limit = current_app.config.get('CLUSTER_CACHE_MAX_USERS', 256)
+        with self._lock:
+            self._models[str(user_id)] = state
+            self._models.move_to_end(str(user_id))
+            while len(self._models) > limit:
+                self._models.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+cluster_cache = ClusterCache()
+
+def _document_vectors(user_id, documents):
+    """
+    Returns {doc_id: normalized embedding} for the user's documents, each
+    the mean of its chunk vectors in the user's index.
+    """
+    index = index_manager.get(user_id, LlamaServerEmbeddings())
+    if index is None:
+        return {}
+    doc_ids = {doc.id for doc in documents}
+    vectors = {}
+    for doc_id, vector in index.document_vectors().items():
+        norm = np.linalg.norm(vector)
+        if doc_id in doc_ids and norm:
+            vectors[doc_id] = vector / norm
+    return vectors
+
+def _fit(vectors, n_clusters):
+    doc_ids = list(vectors)
+    X = np.array([vectors[doc_id] for doc_id in doc_ids])
+    model = MiniBatchKMeans(n_clusters=min(n_clusters, len(doc_ids)), random_state=42, n_init=3)
+    distances = model.fit_transform(X)
+    return _ClusterModel(model, n_clusters, doc_ids, distances.argmin(axis=1), float(distances.min(axis=1).mean()))
+
+def _update(state, vectors, n_clusters):
+    """
+    Brings the user's model up to date with their current documents. New
+    documents are assigned to the nearest centroid and folded into the model
+    with a mini-batch update. The model is refit from scratch instead when
+    the documents added and removed since the last fit exceed
+    CLUSTER_REFIT_RATIO of those it was fit on, or when new documents lie on
+    average more than CLUSTER_DRIFT_THRESHOLD times farther from their
+    centroid than the fitted ones.
+    """
+    config = current_app.config
+    if state is None or state.requested != n_clusters or \
+            state.model.n_clusters != min(n_clusters, len(vectors)):
+        return _fit(vectors, n_clusters)
+
+    removed = state.labels.keys() - vectors.keys()
+    added = [doc_id for doc_id in vectors if doc_id not in state.labels]
+    for doc_id in removed:
+        del state.labels[doc_id]
+    state.changed += len(removed) + len(added)
+    if state.changed > state.fitted * config.get('CLUSTER_REFIT_RATIO', 0.5):
+        return _fit(vectors, n_clusters)
+
+    if added:
+        X = np.array([vectors[doc_id] for doc_id in added])
+        distances = state.model.transform(X).min(axis=1)
+        state.added_distance += float(distances.sum())
+        state.added += len(added)
+        drift = state.added_distance / state.added
+        if drift > max(state.baseline, 1e-6) * config.get('CLUSTER_DRIFT_THRESHOLD', 1.5):
+            return _fit(vectors, n_clusters)
+        state.model.partial_fit(X)
+        state.labels.update(zip(added, state.model.predict(X)))
+    return state
+
+def _build_report(state, vectors, documents):
+    sources = {doc.id: doc.source for doc in documents}
+    members = defaultdict(list)
+    for doc_id, label in state.labels.items():
+        members[int(label)].append(doc_id)
+
+    clusters = []
+    for label in range(state.model.n_clusters):
+        doc_ids = members.get(label)
+        if not doc_ids:
+            continue
+        centroid = state.model.cluster_centers_[label]
+        doc_ids.sort(key=lambda doc_id: float(np.linalg.norm(vectors[doc_id] - centroid)))
+        clusters.append({
+            "cluster_id": label,
+            "size": len(doc_ids),
+            "top_terms": document_top_terms(doc_ids),
+            "documents": [sources[doc_id] for doc_id in doc_ids[:REPRESENTATIVE_DOCUMENTS]],
+        })
+    return {"clusters": clusters}
 
 def generate_cluster_report(user_id, n_clusters=5):
     """
-    Generates a data clustering report using KMeans.
+    Generates a data clustering report by clustering the user's documents on
+    the embeddings already stored in their index. The model is kept between
+    reports and updated incrementally (see _update), and the report itself is
+    reused until the index changes. Users without an index, such as those
+    whose documents predate per-document vectors, get a TF-IDF clustering of
+    the documents' pages instead.
     """
     documents = Document.query.filter_by(user_id=user_id).all()
     if not documents:
         return {"clusters": []}
 
+    version = index_manager.version(user_id)
+    with cluster_cache.user_lock(user_id):
+        state = cluster_cache.get(user_id)
+        # Every append and deletion changes the index version, so a report
+        # of the same version covers the same vectors and they need not be read
+        if state is not None and version is not None and state.version == version \
+                and state.requested == n_clusters:
+            return state.report
+
+        vectors = _document_vectors(user_id, documents)
+        if not vectors:
+            return _tfidf_report(documents, n_clusters)
+
+        backfill_terms(user_id, load_document_pages)
+        state = _update(state, vectors, n_clusters)
+        state.version = version
+        state.report = _build_report(state, vectors, documents)
+        cluster_cache.put(user_id, state)
+        return state.report
+
+def _tfidf_report(documents, n_clusters):
     full_texts = []
-    for doc in documents:
-        try:
-            ext = doc.document_type
-            if ext == 'txt':
-                loader = TextLoader(doc.file_path)
-            elif ext == 'pdf':
-                loader = PyPDFLoader(doc.file_path)
-            elif ext in ['xlsx', 'xls']:
-                loader = UnstructuredExcelLoader(doc.file_path)
-            else:
-                continue
-            
-            doc_content = loader.load()
-            for page in doc_content:
-                full_texts.append(page.page_content)
-        except Exception as e:
-            print(f"Error loading document for clustering: {doc.file_path}, {e}")
+    for doc, pages in iter_document_pages(documents):
+        full_texts.extend(pages)
 
     if not full_texts:
         return {"clusters": []}
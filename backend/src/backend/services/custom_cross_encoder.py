@@ -1,7 +1,9 @@
 from typing import Any, List
+from concurrent.futures import ThreadPoolExecutor
 from langchain_community.cross_encoders.base import BaseCrossEncoder
 import requests
 from flask import current_app
+from .http_session import get_session
 
 class LlamaServerCrossEncoder(BaseCrossEncoder):
     """Custom LangChain CrossEncoder class that calls the llama-server API."""
@@ -9,27 +11,58 @@ class LlamaServerCrossEncoder(BaseCrossEncoder):
     model: str = "gpustack/bge-reranker-v2-m3-GGUF"
 
     def score(self, text_pairs: List[List[str]]) -> List[float]:
-        """Score pairs of texts."""
+        """
+        Score pairs of texts. All documents paired with the same query are
+        scored in one /rerank request, split into RERANK_BATCH_SIZE batches
+        that are sent concurrently.
+        """
         llama_server_url = current_app.config.get('LLAMA_SERVER_RERANKING_URL')
-        scores = []
-        for query, document in text_pairs:
-            try:
-                response = requests.post(
-                    f"{llama_server_url}/rerank",
-                    json={
-                        "query": query,
-                        "documents": [document],
-                        "model": self.model,
-                        "top_n": 1,
-                    },
-                )
-                response.raise_for_status()
-                results = response.json().get("results")
-                if results:
-                    scores.append(results[0]["relevance_score"])
-                else:
-                    scores.append(0.0)
-            except requests.exceptions.RequestException as e:
-                print(f"Error calling rerank API: {e}")
-                scores.append(0.0)
+        batch_size = current_app.config.get('RERANK_BATCH_SIZE', 32)
+        max_workers = current_app.config.get('RERANK_MAX_WORKERS', 4)
+
+        positions_by_query = {}
+        for position, (query, _) in enumerate(text_pairs):
+            positions_by_query.setdefault(query, []).append(position)
+
+        batches = []
+        for query, positions in positions_by_query.items():
+            for start in range(0, len(positions), batch_size):
+                batches.append((query, positions[start:start + batch_size]))
+
+        scores = [0.0] * len(text_pairs)
+        if not batches:
+            return scores
+
+        def score_batch(batch):
+            query, positions = batch
+            documents = [text_pairs[position][1] for position in positions]
+            return positions, self._rerank(llama_server_url, query, documents)
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+            for positions, batch_scores in executor.map(score_batch, batches):
+                for position, score in zip(positions, batch_scores):
+                    scores[position] = score
+        return scores
+
+    def _rerank(self, llama_server_url, query, documents):
+        """Returns the relevance score of each document, in input order."""
+        try:
+            response = get_session().post(
+                f"{llama_server_url}/rerank",
+                json={
+                    "query": query,
+                    "documents": documents,
+                    "model": self.model,
+                    "top_n": len(documents),
+                },
+            )
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print(f"Error calling rerank API: {e}")
+            return [0.0] * len(documents)
+
+        # Results come back sorted by relevance; map them by document index
+        scores = [0.0] * len(documents)
+        for result in response.json().get("results") or []:
+            scores[result["index"]] = result["relevance_score"]
         return scores
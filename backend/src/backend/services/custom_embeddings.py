@@ -0,0 +1,113 @@
+import time
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.embeddings import Embeddings
+import requests
+from flask import current_app
+from .http_session import get_session
+from .embedding_cache import embedding_cache
+
+EMBEDDING_MODEL = "ggml-org/embeddinggemma-300M-GGUF"
+
+class EmbeddingError(Exception):
+    """Raised when the embedding server could not embed a batch of texts."""
+
+def _estimate_tokens(text):
+    # Rough upper bound for the embedding model's tokenizer on mixed text
+    return len(text) // 3 + 1
+
+def _make_batches(texts, max_texts, max_tokens):
+    """Splits texts into contiguous (start, end) ranges within both budgets."""
+    batches = []
+    start, tokens = 0, 0
+    for i, text in enumerate(texts):
+        text_tokens = _estimate_tokens(text)
+        if i > start and (i - start >= max_texts or tokens + text_tokens > max_tokens):
+            batches.append((start, i))
+            start, tokens = i, 0
+        tokens += text_tokens
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+def _retry_delay(response, attempt):
+    """
+    Seconds to wait before retrying a failed request: the server's
+    Retry-After (in seconds) when it sends one, else exponential backoff.
+    """
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.strip().isdigit():
+        return min(int(retry_after), 60)
+    return 0.5 * 2 ** attempt
+
+class LlamaServerEmbeddings(Embeddings):
+    """
+    Custom LangChain Embeddings class that calls the llama-server API.
+
+    Documents are sent in batches of at most EMBEDDING_BATCH_SIZE texts and
+    EMBEDDING_BATCH_TOKENS estimated tokens, with up to EMBEDDING_MAX_WORKERS
+    batches in flight. Failed batches are retried with exponential backoff;
+    if a batch still fails, EmbeddingError is raised rather than returning
+    empty vectors. Texts found in the embedding cache are not sent at all.
+    """
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not embedding_cache.enabled:
+            return self._embed_all(texts)
+
+        model = current_app.config.get('EMBEDDING_MODEL', EMBEDDING_MODEL)
+        vectors = embedding_cache.get_many(model, texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            embedded = dict(zip(missing, self._embed_all(missing)))
+            embedding_cache.put_many(model, missing, [embedded[text] for text in missing])
+            vectors = [embedded[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def _embed_all(self, texts):
+        config = current_app.config
+        llama_server_url = config.get('LLAMA_SERVER_EMBEDDING_URL')
+        model = config.get('EMBEDDING_MODEL', EMBEDDING_MODEL)
+        batches = _make_batches(
+            texts,
+            config.get('EMBEDDING_BATCH_SIZE', 64),
+            config.get('EMBEDDING_BATCH_TOKENS', 8192),
+        )
+        max_retries = config.get('EMBEDDING_MAX_RETRIES', 3)
+        timeout = config.get('EMBEDDING_TIMEOUT', 60)
+        if not batches:
+            return []
+
+        def embed_batch(batch):
+            start, end = batch
+            return self._post(llama_server_url, model, texts[start:end], max_retries, timeout)
+
+        vectors = []
+        max_workers = min(config.get('EMBEDDING_MAX_WORKERS', 4), len(batches))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch_vectors in executor.map(embed_batch, batches):
+                vectors.extend(batch_vectors)
+        return vectors
+
+    def _post(self, llama_server_url, model, texts, max_retries, timeout):
+        """Embeds one batch, retrying connection errors, server errors and 429 (server busy)."""
+        for attempt in range(max_retries + 1):
+            try:
+                response = get_session().post(
+                    f"{llama_server_url}/v1/embeddings",
+                    json={"input": texts, "model": model},
+                    timeout=timeout,
+                )
+                response.raise_for_status()
+                data = response.json()['data']
+                data.sort(key=lambda e: e['index'])
+                return [item['embedding'] for item in data]
+            except requests.exceptions.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                retryable = status is None or status >= 500 or status == 429
+                if attempt == max_retries or not retryable:
+                    raise EmbeddingError(f"Error calling embedding API: {e}") from e
+                print(f"Error calling embedding API, retrying batch of {len(texts)}: {e}")
+                time.sleep(_retry_delay(e.response, attempt))
@@ -1,13 +1,68 @@
 from langchain.llms.base import LLM
-from typing import Any, List, Mapping, Optional
+from langchain_core.outputs import GenerationChunk
+from typing import Any, Iterator, List, Mapping, Optional
+import json
 import requests
 from flask import current_app
 import re
+from .http_session import get_session
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+class LLMError(Exception):
+    """Raised when a streamed completion breaks off before it is finished."""
 
 def parse_llm_output(output: str) -> str:
     """Removes the <think>...</think> block from the LLM output."""
     return re.sub(r"<think>.*?</think>", "", output, flags=re.DOTALL).strip()
 
+class ThinkFilter:
+    """
+    Incremental version of parse_llm_output for streamed output.
+
+    feed() takes the next piece of model output and returns the part that can
+    be shown: text inside <think>...</think> is dropped as it arrives, and a
+    possible partial tag at the end of a piece is held back until the next one
+    tells whether it really is a tag. Leading whitespace is dropped as well.
+    """
+    def __init__(self):
+        self._buffer = ""
+        self._in_think = False
+        self._started = False
+
+    def feed(self, text: str) -> str:
+        self._buffer += text
+        visible = []
+        while self._buffer:
+            tag = THINK_CLOSE if self._in_think else THINK_OPEN
+            pos = self._buffer.find(tag)
+            if pos != -1:
+                if not self._in_think:
+                    visible.append(self._buffer[:pos])
+                self._buffer = self._buffer[pos + len(tag):]
+                self._in_think = not self._in_think
+                continue
+            # Keep back a suffix that could be the start of the tag
+            keep = next((n for n in range(len(tag) - 1, 0, -1) if self._buffer.endswith(tag[:n])), 0)
+            if not self._in_think:
+                visible.append(self._buffer[:len(self._buffer) - keep])
+            self._buffer = self._buffer[len(self._buffer) - keep:]
+            break
+        return self._lstrip("".join(visible))
+
+    def finish(self) -> str:
+        """Returns any held-back text once the stream has ended."""
+        text = "" if self._in_think else self._buffer
+        self._buffer = ""
+        return self._lstrip(text)
+
+    def _lstrip(self, text):
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
 class LlamaServerLLM(LLM):
     @property
     def _llm_type(self) -> str:
@@ -30,6 +85,49 @@ class LlamaServerLLM(LLM):
             print(f"Error calling LLM API: {e}")
             return ""
 
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        """
+        Streams the completion token by token, without the <think> block.
+        Raises LLMError if the stream fails or ends before llama-server sends
+        [DONE], so a cut-off answer is never taken for a complete one.
+        """
+        llama_server_url = current_app.config.get('LLAMA_SERVER_LLM_URL')
+        think_filter = ThinkFilter()
+        finished = False
+        try:
+            response = get_session().post(
+                f"{llama_server_url}/v1/chat/completions",
+                json={
+                    "messages": [{"role": "user", "content": prompt}],
+                    "model": "ggml-org/Qwen3-1.7B-GGUF",
+                    "stream": True,
+                },
+                stream=True,
+            )
+            response.raise_for_status()
+            with response:
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data: "):
+                        continue
+                    data = line[len("data: "):]
+                    if data == "[DONE]":
+                        finished = True
+                        break
+                    choices = json.loads(data).get('choices') or [{}]
+                    delta = choices[0].get('delta', {}).get('content')
+                    text = think_filter.feed(delta) if delta else ""
+                    if text:
+                        yield GenerationChunk(text=text)
+        except requests.exceptions.RequestException as e:
+            print(f"Error calling LLM API: {e}")
+            raise LLMError(f"Error calling LLM API: {e}") from e
+        if not finished:
+            raise LLMError("LLM stream ended before the answer was complete")
+
+        text = think_filter.finish()
+        if text:
+            yield GenerationChunk(text=text)
+
     @property
     def _identifying_params(self) -> Mapping[str, Any]:
         """Get the identifying parameters."""
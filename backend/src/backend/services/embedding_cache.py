@@ -0,0 +1,140 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+from flask import current_app
+
+EMBEDDING_CACHE_PATH = 'embedding_cache.db'
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache of embedding vectors.
+
+    Vectors are stored in a local SQLite database keyed by a hash of the
+    embedding model name and the text, so identical chunks are only embedded
+    once. The cache is cleared whenever the configured model changes, and the
+    least recently used entries are evicted beyond EMBEDDING_CACHE_MAX_ENTRIES.
+    Entry, hit and miss counters are kept in the database so they cover
+    every process sharing the cache.
+    """
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('EMBEDDING_CACHE_PATH', EMBEDDING_CACHE_PATH)
+        app.config.setdefault('EMBEDDING_CACHE_MAX_ENTRIES', 200000)
+
+    @property
+    def enabled(self):
+        return bool(current_app.config.get('EMBEDDING_CACHE_PATH'))
+
+    def get_many(self, model, texts):
+        """Returns the cached vector for each text, or None where there is none."""
+        keys = [self._key(model, text) for text in texts]
+        with self._lock:
+            conn = self._connection(model)
+            found = {}
+            for start in range(0, len(keys), 500):
+                chunk = list(set(keys[start:start + 500]))
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+            hits = sum(key in found for key in keys)
+            if found:
+                now = time.time()
+                conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            conn.executemany(
+                "UPDATE meta SET value = CAST(value AS INTEGER) + ? WHERE key = ?",
+                [(hits, 'hits'), (len(keys) - hits, 'misses')],
+            )
+            conn.commit()
+
+        return [np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None for key in keys]
+
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = {
+            self._key(model, text): (np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        }
+        with self._lock:
+            conn = self._connection(model)
+            # Keys are content addresses, so an existing row already holds the
+            # same vector and can be kept.
+            inserted = conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, vector, last_used) for key, (vector, last_used) in rows.items()],
+            ).rowcount
+            # The insert holds the database's write lock until the commit, so
+            # the count read back includes other processes' inserts
+            self._add_entries(conn, inserted)
+            excess = self._entries(conn) - current_app.config.get('EMBEDDING_CACHE_MAX_ENTRIES', 200000)
+            if excess > 0:
+                evicted = conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                ).rowcount
+                self._add_entries(conn, -evicted)
+            conn.commit()
+
+    def stats(self, model):
+        with self._lock:
+            conn = self._connection(model)
+            counters = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('entries', 'hits', 'misses')").fetchall())
+        hits, misses = int(counters['hits']), int(counters['misses'])
+        return {
+            "entries": int(counters['entries']),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+    def _entries(self, conn):
+        return int(conn.execute("SELECT value FROM meta WHERE key = 'entries'").fetchone()[0])
+
+    def _add_entries(self, conn, n):
+        conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + ? WHERE key = 'entries'", (n,))
+
+    def _key(self, model, text):
+        return hashlib.sha256(f"{model}\0{text}".encode('utf-8')).digest()
+
+    def _connection(self, model):
+        path = current_app.config['EMBEDDING_CACHE_PATH']
+        conn = self._connections.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # Caches created before the entry counter was kept start it from a count
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) SELECT 'entries', COUNT(*) FROM embeddings")
+            conn.commit()
+            self._connections[path] = conn
+
+        # Vectors from a different model are meaningless for this one
+        row = conn.execute("SELECT value FROM meta WHERE key = 'model'").fetchone()
+        if row is None or row[0] != model:
+            conn.execute("DELETE FROM embeddings")
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [('model', model), ('entries', '0'), ('hits', '0'), ('misses', '0')],
+            )
+            conn.commit()
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,47 @@
+import calendar
+import datetime
+import random
+import statistics
+from flask import current_app
+
+def _entry_timestamps(entries):
+    timestamps = []
+    for entry in entries:
+        parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+        if parsed:
+            timestamps.append(calendar.timegm(parsed))
+    return sorted(timestamps)
+
+def next_interval(interval, status, entries=(), new_entries=0):
+    """
+    Learns a feed's polling interval in seconds from the outcome of a poll.
+
+    status is 'fetched', 'not_modified' or 'failed'. A feed that publishes
+    new entries is polled about twice per median gap between its entry
+    timestamps; a 304 or a fetch without new entries backs off by
+    FEED_POLL_BACKOFF. Failed polls keep the current interval. The result is
+    kept between FEED_POLL_MIN_INTERVAL and FEED_POLL_MAX_INTERVAL.
+    """
+    config = current_app.config
+    interval = interval or config.get('FEED_POLL_DEFAULT_INTERVAL', 21600)
+    if status == 'not_modified' or (status == 'fetched' and not new_entries):
+        interval *= config.get('FEED_POLL_BACKOFF', 1.5)
+    elif status == 'fetched':
+        timestamps = _entry_timestamps(entries)
+        gaps = [later - earlier for earlier, later in zip(timestamps, timestamps[1:]) if later > earlier]
+        interval = statistics.median(gaps) / 2 if gaps else interval / 2
+    return int(min(max(interval, config.get('FEED_POLL_MIN_INTERVAL', 900)), config.get('FEED_POLL_MAX_INTERVAL', 86400)))
+
+def next_poll_time(interval, now=None):
+    """
+    Time of the next poll, jittered by up to FEED_POLL_JITTER of the interval
+    so feeds polled together drift apart instead of staying in step.
+    """
+    now = now or datetime.datetime.utcnow()
+    jitter = current_app.config.get('FEED_POLL_JITTER', 0.1)
+    return now + datetime.timedelta(seconds=interval * random.uniform(1 - jitter, 1 + jitter))
+
+def initial_poll_time(interval, now=None):
+    """Spreads feeds that were never scheduled uniformly over their first interval."""
+    now = now or datetime.datetime.utcnow()
+    return now + datetime.timedelta(seconds=interval * random.random())
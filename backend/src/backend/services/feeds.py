@@ -1,5 +1,17 @@
+from urllib.parse import urlsplit, urlunsplit
 from ..models import db, RssFeed
 
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def normalize_feed_url(url):
+    """Canonical form of a feed URL, used to recognise subscriptions to the same feed."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    return urlunsplit((scheme, host, parts.path.rstrip('/'), parts.query, ''))
+
 def get_user_feeds(user_id):
     feeds = RssFeed.query.filter_by(user_id=user_id).all()
     return [{"id": feed.id, "url": feed.url} for feed in feeds]
@@ -0,0 +1,25 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_MAXSIZE = 32
+
+_session = None
+_lock = threading.Lock()
+
+def get_session():
+    """
+    Returns the process-wide requests session used to call the llama-server
+    endpoints and to fetch feeds and article pages, so connections are pooled
+    and kept alive between calls.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_MAXSIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
@@ -0,0 +1,44 @@
+from typing import Any, List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from .index_manager import index_manager
+
+def reciprocal_rank_fusion(rankings, k=60, limit=None):
+    """
+    Merges ranked lists of chunks: each chunk scores the sum of 1 / (k + rank)
+    over the lists it appears in. Chunks are identified by document id and
+    text, so the same chunk found by both retrievers is counted once.
+    """
+    scores = {}
+    chunks = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = (doc.metadata.get('doc_id'), doc.page_content)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            chunks.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [chunks[key] for key in ranked[:limit]]
+
+class HybridRetriever(BaseRetriever):
+    """
+    Custom LangChain retriever combining vector search over the user's FAISS
+    index with BM25 keyword search over the same chunks, fused with
+    reciprocal rank fusion. Keyword search catches names and ticker symbols
+    that embeddings match poorly. Both searches are limited to the chunks of
+    doc_ids when it is set.
+    """
+    user_id: Any
+    vector_retriever: Any
+    embeddings: Any
+    lexical_k: int = 10
+    rrf_k: int = 60
+    top_n: int = 6
+    doc_ids: Any = None
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector_hits = self.vector_retriever.invoke(query)
+        lexical_hits = index_manager.lexical_search(self.user_id, query, self.lexical_k, self.embeddings, self.doc_ids)
+        return reciprocal_rank_fusion([vector_hits, lexical_hits], self.rrf_k, self.top_n)
@@ -0,0 +1,961 @@
+import os
+import fcntl
+import json
+import hashlib
+import pickle
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
+from functools import cached_property
+from flask import current_app
+from langchain_core.vectorstores import VectorStore
+from langchain_community.vectorstores import FAISS
+import numpy as np
+import faiss
+from . import chunk_store, index_types, lexical_index, shared_index
+
+FAISS_INDEX_PATH = 'faiss_index'
+INDEX_FILE = 'index.faiss'
+# Files of an index part saved by FAISS.save_local before chunk stores
+LEGACY_INDEX_FILES = (INDEX_FILE, chunk_store.LEGACY_DOCSTORE_FILE)
+BASE_LINK = 'base'
+SEGMENTS_DIR = 'segments'
+TOMBSTONES_FILE = 'tombstones.json'
+INDEX_META_FILE = 'index_meta.json'
+WRITE_LOCK_FILE = '.write.lock'
+# Full-precision copy of the vectors of a part whose index quantizes them
+VECTORS_FILE = 'vectors.npy'
+
+class SegmentedFAISS(VectorStore):
+    """
+    Read-only view over a user's base index and its delta segments.
+
+    Each part is searched separately and the hits are merged by distance, so
+    new segments can be added by building a new view instead of modifying an
+    index that concurrent searches may be using. Chunks of deleted documents
+    (tombstones) are filtered out of the results until compaction removes them.
+
+    The same class serves shared shards, whose parts hold the vectors of many
+    users under ids that encode their owner (see shared_index). for_tenant()
+    returns a view of one user's vectors, which searches select inside faiss.
+    """
+    def __init__(self, embeddings, segments, deleted=frozenset(), tenant=None, shard=None):
+        self._embeddings = embeddings
+        self.segments = list(segments)
+        self.deleted = frozenset(deleted)
+        self.tenant = tenant
+        self._shard = shard
+
+    @property
+    def embeddings(self):
+        return self._embeddings
+
+    @property
+    def ntotal(self):
+        if self.tenant is not None:
+            live, dead = self._shard.tenant_counts
+            return live.get(self.tenant, 0) + dead.get(self.tenant, 0)
+        return sum(segment.index.ntotal for segment in self.segments)
+
+    @cached_property
+    def dead_count(self):
+        """Number of vectors that belong to deleted documents."""
+        if not self.deleted:
+            return 0
+        if self.tenant is not None:
+            return self._shard.tenant_counts[1].get(self.tenant, 0)
+        return sum(segment.docstore.count(self.deleted) for segment in self.segments)
+
+    @cached_property
+    def tenant_counts(self):
+        """
+        Returns ({user id: live vectors}, {user id: deleted vectors}) for the
+        users that have vectors in this shard.
+        """
+        live, dead = Counter(), Counter()
+        for segment in self.segments:
+            owners = shared_index.owners(segment.index)
+            if owners is None or not len(owners):
+                continue
+            is_dead = np.zeros(len(owners), dtype=bool)
+            if self.deleted:
+                is_dead[segment.docstore.positions(self.deleted)] = True
+            for counter, mask in ((live, ~is_dead), (dead, is_dead)):
+                users, counts = np.unique(owners[mask], return_counts=True)
+                counter.update(dict(zip(users.tolist(), counts.tolist())))
+        return live, dead
+
+    def for_tenant(self, user_id):
+        """Returns a view of this shard restricted to one user's vectors."""
+        return SegmentedFAISS(self._embeddings, self.segments, self.deleted, int(user_id), self)
+
+    def doc_ids(self):
+        """Returns the ids of the live documents in the index."""
+        doc_ids = set()
+        for segment in self.segments:
+            owners = shared_index.owners(segment.index)
+            for position, doc_id in segment.docstore.doc_ids():
+                if self._owned(owners, position) and doc_id is not None and doc_id not in self.deleted:
+                    doc_ids.add(doc_id)
+        return doc_ids
+
+    def live_documents(self):
+        """Yields every live chunk, reading the chunk stores in batches."""
+        for _, _, live in self._live_batches(self.segments):
+            for _, doc in live:
+                yield doc
+
+    def document_vectors(self):
+        """
+        Returns {doc_id: mean of the document's chunk vectors} for every live
+        document in the index, reading the vectors stored in the segments.
+        """
+        sums, counts = {}, {}
+        for segment in self.segments:
+            if not segment.index.ntotal:
+                continue
+            vectors = self._vectors(segment, 0, segment.index.ntotal)
+            owners = shared_index.owners(segment.index)
+            for position, doc_id in segment.docstore.doc_ids():
+                if doc_id is None or doc_id in self.deleted or not self._owned(owners, position):
+                    continue
+                if doc_id in sums:
+                    sums[doc_id] += vectors[position]
+                    counts[doc_id] += 1
+                else:
+                    sums[doc_id] = vectors[position].copy()
+                    counts[doc_id] = 1
+        return {doc_id: sums[doc_id] / counts[doc_id] for doc_id in sums}
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("Use IndexManager.append to add documents.")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Use IndexManager.append to create an index.")
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, doc_ids=None, **kwargs):
+        """
+        Returns the k nearest chunks and their distances. With doc_ids, only
+        the chunks of those documents are searched: they are selected inside
+        faiss instead of being fetched and dropped afterwards.
+        """
+        filter = self._live_filter(filter)
+        if self.deleted:
+            # Fetch enough candidates that k live hits remain after dropping
+            # every dead one.
+            fetch_k = max(fetch_k, k + self.dead_count)
+        # Other tenants' vectors are skipped inside faiss, so they never take
+        # the place of the tenant's own hits
+        selector = shared_index.tenant_selector(self.tenant) if self.tenant is not None else None
+        vector = np.array([embedding], dtype=np.float32)
+        results = []
+        for segment in self.segments:
+            if not segment.index.ntotal:
+                continue
+            n = k if filter is None else fetch_k
+            if doc_ids is not None:
+                scores, ids = self._search_documents(segment, vector, n, doc_ids)
+            elif selector is None:
+                scores, ids = segment.index.search(vector, n)
+            else:
+                scores, ids = segment.index.search(vector, n, params=index_types.search_parameters(segment.index, selector))
+            hits = [(shared_index.position(i), float(score)) for i, score in zip(ids[0], scores[0]) if i != -1]
+            # Only the chunks of the hits are read from the chunk store
+            chunks = segment.docstore.get_many([position for position, _ in hits])
+            for position, score in hits:
+                doc = chunks[position]
+                if filter is None or filter(doc.metadata):
+                    results.append((doc, score))
+        results.sort(key=lambda result: result[1])
+        return results[:k]
+
+    def _search_documents(self, segment, vector, n, doc_ids):
+        # Searches the chunks of the given documents in one index part.
+        # Small selections are scored exactly on their stored vectors, as
+        # HNSW and IVF find few neighbours under a very selective filter.
+        positions = np.array(segment.docstore.positions(doc_ids), dtype=np.int64)
+        if not len(positions):
+            return np.empty((1, 0), dtype=np.float32), np.empty((1, 0), dtype=np.int64)
+        if len(positions) <= current_app.config.get('FAISS_PREFILTER_EXACT_MAX', 4096):
+            if segment.exact_vectors is not None:
+                vectors = np.ascontiguousarray(segment.exact_vectors[positions])
+            else:
+                vectors = shared_index.vectors_at(segment.index, positions)
+            scores, rows = faiss.knn(vector, vectors, min(n, len(positions)), metric=segment.index.metric_type)
+            return scores, positions[rows]
+        owners = shared_index.owners(segment.index)
+        ids = positions if owners is None else shared_index.vector_ids(owners[positions], positions)
+        selector = faiss.IDSelectorBatch(ids)
+        return segment.index.search(vector, n, params=index_types.search_parameters(segment.index, selector))
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        embedding = self._embeddings.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        return self.segments[0]._select_relevance_score_fn()
+
+    def _live_filter(self, filter):
+        deleted = self.deleted
+        if not deleted:
+            return None if filter is None else FAISS._create_filter_func(filter)
+        if filter is None:
+            return lambda metadata: metadata.get('doc_id') not in deleted
+        filter = FAISS._create_filter_func(filter)
+        return lambda metadata: metadata.get('doc_id') not in deleted and filter(metadata)
+
+    def _owned(self, owners, position):
+        return self.tenant is None or owners is None or owners[position] == self.tenant
+
+    def _vectors(self, segment, start, n):
+        # Reads n vectors of a part back by position. Parts with a quantized
+        # index keep a full-precision copy, so rebuilds never quantize the
+        # same vectors again and scores are computed on the originals.
+        if segment.exact_vectors is not None:
+            return np.array(segment.exact_vectors[start:start + n])
+        return shared_index.vectors(segment.index, start, n)
+
+    def save_vectors(self, file):
+        """
+        Writes the vectors of every part, in order and at full precision, to
+        a .npy file, for a base that appended() built with a quantized index.
+        """
+        out = np.lib.format.open_memmap(file, mode='w+', dtype=np.float32, shape=(self.ntotal, self.segments[0].index.d))
+        row = 0
+        for segment in self.segments:
+            for start in range(0, segment.index.ntotal, chunk_store.READ_BATCH):
+                vectors = self._vectors(segment, start, min(chunk_store.READ_BATCH, segment.index.ntotal - start))
+                out[row:row + len(vectors)] = vectors
+                row += len(vectors)
+        out.flush()
+
+    def _live_batches(self, segments):
+        # Yields (segment, start, [(position, chunk)]) for the live chunks of
+        # each batch of positions, so stores are never loaded all at once.
+        batch = chunk_store.READ_BATCH
+        for segment in segments:
+            owners = shared_index.owners(segment.index)
+            for start in range(0, segment.index.ntotal, batch):
+                live = [
+                    (position, doc)
+                    for position, doc in segment.docstore.documents(start, start + batch)
+                    if doc.metadata.get('doc_id') not in self.deleted and self._owned(owners, position)
+                ]
+                if live:
+                    yield segment, start, live
+
+    def merged(self, chunks_path):
+        """
+        Returns a single flat faiss index holding the live vectors of every
+        segment, whatever the type of the segments' indexes, and writes
+        their chunks in the same order to a new chunk store at chunks_path.
+        A shard is merged into a new shard part; a tenant view into a plain
+        index of the tenant's vectors.
+        """
+        first = self.segments[0].index
+        if self.tenant is None and shared_index.owners(first) is not None:
+            index = shared_index.new_index(first.d, first.metric_type)
+        else:
+            index = faiss.IndexFlat(first.d, first.metric_type)
+        return self._combined(index, self.segments, chunks_path)
+
+    def appended(self, chunks_path):
+        """
+        Returns a copy of the base index (the first segment) with the vectors
+        of the other segments added to it, keeping the base's index type,
+        and writes the chunks of all of them to chunks_path. Deleted vectors
+        are not removed, so use merged() when there are any.
+        """
+        base = self.segments[0]
+        # An owned copy: a memory-mapped index cannot grow (see IndexManager._load)
+        copy = faiss.deserialize_index(faiss.serialize_index(base.index))
+        return self._combined(copy, self.segments[1:], chunks_path, base)
+
+    def _combined(self, index, segments, chunks_path, base=None):
+        # Vectors are read back from the segments rather than moved with
+        # merge_from, so the segments used by concurrent searches stay intact
+        # and segments of different index types can be combined. Chunks are
+        # streamed in batches instead of being loaded all at once.
+        batch = chunk_store.READ_BATCH
+        keep_owners = shared_index.owners(index) is not None
+
+        def chunks():
+            if base is not None:
+                for start in range(0, base.index.ntotal, batch):
+                    for _, doc in base.docstore.documents(start, start + batch):
+                        yield doc
+            for segment, start, live in self._live_batches(segments):
+                end = live[-1][0] + 1
+                rows = [position - start for position, _ in live]
+                vectors = self._vectors(segment, start, end - start)[rows]
+                if keep_owners:
+                    # Vectors keep their owner and get their new position
+                    owners = shared_index.owners(segment.index)[[position for position, _ in live]]
+                    index.add_with_ids(vectors, shared_index.vector_ids(owners, np.arange(index.ntotal, index.ntotal + len(rows))))
+                else:
+                    index.add(vectors)
+                for _, doc in live:
+                    yield doc
+
+        chunk_store.write_chunks(chunks_path, chunks())
+        return index
+
+class _CacheEntry:
+    def __init__(self, index, signature, size):
+        self.index = index
+        self.signature = signature
+        self.size = size
+
+class IndexManager:
+    """
+    Process-wide cache of loaded per-user FAISS indexes.
+
+    A user's index is stored as an optional base index plus append-only delta
+    segments under `segments/`, which ingestion writes instead of rewriting the
+    whole index. Deleting documents records their ids in `tombstones.json`;
+    their vectors are filtered out at query time. compact() folds the segments
+    back into the base and physically drops the deleted vectors. Next to the
+    vectors, a BM25 index of the same chunks (`lexical.db`, see lexical_index)
+    is kept up to date for keyword search.
+
+    The base index type follows the number of vectors: compaction rebuilds
+    it as a flat, HNSW or IVF index (see index_types) when the size crosses
+    a threshold, and keeps the flat index if the new one fails a recall check
+    against it. The choice is recorded in `index_meta.json`. A base built as
+    a quantized type (such as IVF with SQ8) keeps the original vectors in
+    `vectors.npy`, which later rebuilds and clustering read instead of the
+    index's approximations.
+
+    With FAISS_SHARED_SHARDS set, users without a dedicated index keep their
+    vectors in one of that many shared shards (`shared_<n>`) instead, laid
+    out the same way, so thousands of small users don't each need an index
+    loaded. compact_all moves users between the two layouts by size.
+
+    Indexes are kept in memory until the combined size of the cached entries
+    exceeds FAISS_INDEX_CACHE_BYTES, at which point the least recently used
+    ones are evicted. An entry is refreshed whenever the files backing it
+    change on disk, so writes from other processes are picked up. Vectors are
+    memory-mapped and shared between processes (see _load), and new base
+    versions are published atomically (see _publish_base).
+    """
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        self._write_locks = {}
+
+    def init_app(self, app):
+        app.config.setdefault('FAISS_INDEX_PATH', FAISS_INDEX_PATH)
+        app.config.setdefault('FAISS_INDEX_CACHE_BYTES', 512 * 1024 * 1024)
+        app.config.setdefault('FAISS_SEGMENT_COMPACT_THRESHOLD', 8)
+        app.config.setdefault('FAISS_COMPACT_DEAD_RATIO', 0.2)
+        app.config.setdefault('FAISS_HNSW_MIN_VECTORS', 50000)
+        app.config.setdefault('FAISS_IVF_MIN_VECTORS', 1000000)
+        app.config.setdefault('FAISS_HNSW_FACTORY', 'HNSW32')
+        app.config.setdefault('FAISS_IVF_FACTORY', 'IVF{nlist},SQ8')
+        app.config.setdefault('FAISS_MIN_RECALL', 0.9)
+        app.config.setdefault('FAISS_RECALL_SAMPLE', 200)
+        app.config.setdefault('FAISS_NPROBE', 16)
+        app.config.setdefault('FAISS_EF_SEARCH', 64)
+        app.config.setdefault('FAISS_MMAP', True)
+        app.config.setdefault('FAISS_SHARED_SHARDS', 0)
+        app.config.setdefault('FAISS_SHARED_MAX_VECTORS', 10000)
+        app.config.setdefault('FAISS_PREFILTER_EXACT_MAX', 4096)
+
+    def index_path(self, user_id):
+        """Directory of the user's dedicated index, which also holds their lexical index."""
+        root = current_app.config.get('FAISS_INDEX_PATH', FAISS_INDEX_PATH)
+        return os.path.join(root, f"user_{user_id}")
+
+    def shard_path(self, user_id):
+        """Directory of the shared shard the user's vectors go to in the shared layout."""
+        root = current_app.config.get('FAISS_INDEX_PATH', FAISS_INDEX_PATH)
+        return os.path.join(root, shared_index.shard_name(user_id))
+
+    def user_ids(self):
+        """Returns the ids of all users that have an index directory."""
+        root = current_app.config.get('FAISS_INDEX_PATH', FAISS_INDEX_PATH)
+        if not os.path.isdir(root):
+            return []
+        return [name[len('user_'):] for name in sorted(os.listdir(root)) if name.startswith('user_')]
+
+    def exists(self, user_id):
+        return self._signature(self._vector_path(user_id)) is not None
+
+    def version(self, user_id):
+        """
+        Returns a token that changes whenever the user's index changes on disk
+        (documents appended or deleted, compaction), or None without an index.
+        In the shared layout this is the version of the user's shard.
+        """
+        signature = self._signature(self._vector_path(user_id))
+        if signature is None:
+            return None
+        return hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()[:16]
+
+    def segment_count(self, user_id):
+        signature = self._signature(self._vector_path(user_id))
+        return len(signature[1]) if signature else 0
+
+    @contextmanager
+    def write_lock(self, path):
+        """
+        Serializes writes to the index at path (appends, tombstones,
+        compaction) across threads and processes: web workers, their ingest
+        pools and the aggregation worker all write to the same indexes. A
+        thread lock orders the writers of this process; the flock on a file
+        in the index directory orders them against other processes.
+        """
+        with self._lock:
+            thread_lock = self._write_locks.setdefault(os.path.normpath(path), threading.Lock())
+        with thread_lock:
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, WRITE_LOCK_FILE), 'a') as lock_file:
+                # Released when the file is closed, or by the OS if the holder dies
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    @contextmanager
+    def _user_index(self, user_id):
+        # Locks the index holding the user's vectors and yields its path. The
+        # path is checked again under the lock, as compact_all may have moved
+        # the user to the other layout while the lock was awaited.
+        while True:
+            path = self._vector_path(user_id)
+            with self.write_lock(path):
+                if self._vector_path(user_id) == path:
+                    yield path
+                    return
+
+    def get(self, user_id, embeddings):
+        """
+        Returns the user's index, loading it from disk on a miss or when the
+        files changed since it was cached. Returns None if there is no index.
+        Users in the shared layout get a view of their shard.
+        """
+        path = self._vector_path(user_id)
+        index = self._get(path, embeddings)
+        if index is None or path == self.index_path(user_id):
+            return index
+        view = index.for_tenant(user_id)
+        return view if view.ntotal else None
+
+    def _get(self, path, embeddings):
+        signature = self._signature(path)
+        if signature is None:
+            self._discard(path)
+            return None
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry.signature == signature:
+                self._entries.move_to_end(path)
+                return entry.index
+
+        for attempt in range(3):
+            try:
+                return self._load_index(path, signature, entry, embeddings)
+            except FileNotFoundError:
+                # A compaction removed files between listing and opening them
+                if attempt == 2:
+                    raise
+                signature = self._signature(path)
+                if signature is None:
+                    self._discard(path)
+                    return None
+
+    def _load_index(self, path, signature, entry, embeddings):
+        base_signature, segment_signatures, _ = signature
+        if entry and entry.signature[0] == base_signature and \
+                segment_signatures[:len(entry.signature[1])] == entry.signature[1]:
+            # Only new segments were appended: load just those.
+            parts = list(entry.index.segments)
+            new_segments = segment_signatures[len(entry.signature[1]):]
+        else:
+            parts = []
+            if base_signature:
+                parts.append(self._load(self._base_path(path), embeddings))
+            new_segments = segment_signatures
+
+        for name, _ in new_segments:
+            parts.append(self._load(os.path.join(path, SEGMENTS_DIR, name), embeddings))
+
+        index = SegmentedFAISS(embeddings, parts, self._read_tombstones(path))
+        self._store(path, index, signature)
+        return index
+
+    def append(self, user_id, documents, embeddings, vectors=None):
+        """
+        Embeds the documents and writes them as a new delta segment, leaving
+        the existing base index and segments untouched. Vectors computed
+        earlier for the same documents can be passed to skip embedding.
+        """
+        if not documents:
+            return
+        # Databases created before document ids stopped being reused may hand
+        # out a tombstoned id again; drop the old vectors before reusing it.
+        if {doc.metadata.get('doc_id') for doc in documents} & self._read_tombstones(self._vector_path(user_id)):
+            self.compact(user_id, embeddings)
+
+        if vectors is None:
+            vectors = embeddings.embed_documents([doc.page_content for doc in documents])
+        vectors = np.array(vectors, dtype=np.float32)
+        user_path = self.index_path(user_id)
+        with self._user_index(user_id) as path:
+            # Indexes created before keyword search get their lexical index
+            # built in full on first use (see lexical_search)
+            update_lexical = self.get(user_id, embeddings) is None or os.path.exists(self._lexical_path(user_path))
+            if path == user_path:
+                segment = faiss.IndexFlatL2(vectors.shape[1])
+                segment.add(vectors)
+            else:
+                segment = shared_index.tenant_index(vectors, user_id)
+
+            def write(segment_path):
+                faiss.write_index(segment, os.path.join(segment_path, INDEX_FILE))
+                chunk_store.write_chunks(os.path.join(segment_path, chunk_store.CHUNKS_FILE), documents)
+
+            self._write_segment(path, write)
+            if update_lexical:
+                os.makedirs(user_path, exist_ok=True)
+                lexical_index.add_documents(self._lexical_path(user_path), documents)
+
+        # Refresh the cache entry; this only loads the segment just written.
+        self.get(user_id, embeddings)
+
+    def delete_documents(self, user_id, doc_ids, embeddings):
+        """
+        Tombstones the vectors of the given documents so searches skip them.
+        All ids are recorded in a single write.
+        """
+        user_path = self.index_path(user_id)
+        with self._user_index(user_id) as path:
+            if self._signature(path) is None:
+                return
+            self._add_tombstones(path, doc_ids)
+            if os.path.exists(self._lexical_path(user_path)):
+                lexical_index.delete_documents(self._lexical_path(user_path), doc_ids)
+
+        self.get(user_id, embeddings)
+
+    def lexical_search(self, user_id, query, k, embeddings, doc_ids=None):
+        """
+        Returns up to k of the user's chunks ranked by BM25 against the
+        query, only among the chunks of doc_ids if given. The lexical index
+        is built from the vector index if missing.
+        """
+        path = self.index_path(user_id)
+        lexical_path = self._lexical_path(path)
+        if not os.path.exists(lexical_path):
+            with self._user_index(user_id):
+                index = self.get(user_id, embeddings)
+                if index is None:
+                    return []
+                if not os.path.exists(lexical_path):
+                    os.makedirs(path, exist_ok=True)
+                    tmp_file = os.path.join(path, f".{lexical_index.LEXICAL_INDEX_FILE}.tmp")
+                    if os.path.exists(tmp_file):
+                        os.remove(tmp_file)
+                    lexical_index.add_documents(tmp_file, index.live_documents())
+                    os.replace(tmp_file, lexical_path)
+        return lexical_index.search(lexical_path, query, k, doc_ids)
+
+    def compact(self, user_id, embeddings):
+        """
+        Folds the user's delta segments into the base index and drops the
+        vectors of deleted documents. The base is rebuilt from scratch, as
+        the index type suited to its size, when there are deleted vectors or
+        that type changed; otherwise the segments are added to a copy of it.
+        Users in the shared layout have their whole shard compacted.
+        Returns the number of segments merged and vectors removed.
+        """
+        with self._user_index(user_id) as path:
+            return self._compact(path, embeddings)
+
+    def _compact(self, path, embeddings):
+        index = self._get(path, embeddings)
+        if index is None:
+            return {"segments": 0, "removed": 0}
+        names = self._segment_names(path)
+        meta = self._read_meta(path)
+        shard = shared_index.is_shard(path)
+        # Shards stay flat: a tenant's vectors are a small fraction of a
+        # shard, and HNSW and IVF find few neighbours under such a selector
+        factory = index_types.FLAT if shard else index_types.target_factory(index.ntotal - index.dead_count)
+        if not (names or index.deleted or factory != meta["target"]):
+            return {"segments": 0, "removed": 0}
+
+        incremental = not shard and self._file_signature(self._base_path(path)) and not index.deleted \
+            and factory == meta["target"]
+
+        def write(base_path):
+            chunks_path = os.path.join(base_path, chunk_store.CHUNKS_FILE)
+            if incremental:
+                merged, written = index.appended(chunks_path), meta
+                if not index_types.is_exact(merged):
+                    index.save_vectors(os.path.join(base_path, VECTORS_FILE))
+            else:
+                merged = index.merged(chunks_path)
+                written = {"target": factory, "factory": index_types.FLAT}
+                if factory != index_types.FLAT:
+                    candidate = index_types.build(merged, factory)
+                    recall = index_types.recall(merged, candidate)
+                    if recall >= current_app.config.get('FAISS_MIN_RECALL', 0.9):
+                        if not index_types.is_exact(candidate):
+                            np.save(os.path.join(base_path, VECTORS_FILE), merged.reconstruct_n(0, merged.ntotal))
+                        merged = candidate
+                        written["factory"] = factory
+                    else:
+                        print(f"Keeping a flat index for {os.path.basename(path)}: {factory} recall {recall:.2f} is too low")
+            faiss.write_index(merged, os.path.join(base_path, INDEX_FILE))
+            return merged, written
+
+        merged, meta = self._publish_base(path, write)
+        # Callers hold the write lock, so no segment or tombstone was written
+        # since the index was read, and temporary directories left in the
+        # segments directory belong to writers that died
+        segments_path = os.path.join(path, SEGMENTS_DIR)
+        if os.path.isdir(segments_path):
+            for name in os.listdir(segments_path):
+                if name in names or name.endswith('.tmp'):
+                    shutil.rmtree(os.path.join(segments_path, name))
+        if os.path.exists(os.path.join(path, TOMBSTONES_FILE)):
+            os.remove(os.path.join(path, TOMBSTONES_FILE))
+        self._write_meta(path, meta)
+
+        base = self._load(self._base_path(path), embeddings)
+        self._store(path, SegmentedFAISS(embeddings, [base]), self._signature(path))
+        return {"segments": len(names), "removed": index.ntotal - merged.ntotal}
+
+    def compact_all(self, embeddings, threshold=None, dead_ratio=None):
+        """
+        Compacts every user index and shard with at least `threshold` delta
+        segments, whose share of deleted vectors reached `dead_ratio`, or
+        (user indexes) whose size calls for a different index type than the
+        one it was built as. With FAISS_SHARED_SHARDS, users are first moved
+        between the layouts by size (see _move_to_shared, _move_to_dedicated).
+        Returns the results by user id, and by name for shards.
+        """
+        config = current_app.config
+        if threshold is None:
+            threshold = config.get('FAISS_SEGMENT_COMPACT_THRESHOLD', 8)
+        if dead_ratio is None:
+            dead_ratio = config.get('FAISS_COMPACT_DEAD_RATIO', 0.2)
+        max_vectors = config.get('FAISS_SHARED_MAX_VECTORS', 10000)
+        compacted = {}
+        for user_id in self.user_ids():
+            path = self.index_path(user_id)
+            signature = self._signature(path)
+            if signature is None:
+                continue
+            if shared_index.enabled():
+                # Half the limit, so users near it don't move back and forth
+                index = self._get(path, embeddings)
+                if index.ntotal - index.dead_count < max_vectors // 2:
+                    self._move_to_shared(user_id, embeddings)
+                    continue
+            _, segments, tombstones = signature
+            if len(segments) >= threshold:
+                compacted[user_id] = self.compact(user_id, embeddings)
+                continue
+            # The size of an index only changes through appends and deletes
+            if not (segments or tombstones or not os.path.exists(os.path.join(path, INDEX_META_FILE))):
+                continue
+            index = self.get(user_id, embeddings)
+            live = index.ntotal - index.dead_count
+            if (tombstones and index.ntotal and index.dead_count / index.ntotal >= dead_ratio) or \
+                    index_types.target_factory(live) != self._read_meta(path)["target"]:
+                compacted[user_id] = self.compact(user_id, embeddings)
+            elif not os.path.exists(os.path.join(path, INDEX_META_FILE)):
+                # Record that an older index is fine as it is, so it is not
+                # loaded again on every pass
+                with self.write_lock(path):
+                    self._write_meta(path, self._read_meta(path))
+
+        for name in self._shard_names():
+            path = os.path.join(config.get('FAISS_INDEX_PATH', FAISS_INDEX_PATH), name)
+            index = self._get(path, embeddings)
+            if index is None:
+                continue
+            if shared_index.enabled():
+                for user_id, live in sorted(index.tenant_counts[0].items()):
+                    if live >= max_vectors:
+                        self._move_to_dedicated(user_id, path, embeddings)
+            _, segments, tombstones = self._signature(path)
+            index = self._get(path, embeddings)
+            if len(segments) >= threshold or \
+                    (tombstones and index.ntotal and index.dead_count / index.ntotal >= dead_ratio):
+                with self.write_lock(path):
+                    compacted[name] = self._compact(path, embeddings)
+        return compacted
+
+    def _move_to_shared(self, user_id, embeddings):
+        """
+        Moves the live vectors of a user's dedicated index into their shard
+        as one new segment, then removes the dedicated index. The lexical
+        index stays in the user's directory.
+        """
+        path = self.index_path(user_id)
+        shard_path = self.shard_path(user_id)
+        with self.write_lock(path), self.write_lock(shard_path):
+            index = self._get(path, embeddings)
+            if index is None:
+                return
+            if index.doc_ids() & self._read_tombstones(shard_path):
+                # The shard still holds the user's vectors from before they
+                # last moved out; drop those first
+                self._compact(shard_path, embeddings)
+
+            def write(segment_path):
+                merged = index.merged(os.path.join(segment_path, chunk_store.CHUNKS_FILE))
+                vectors = merged.reconstruct_n(0, merged.ntotal)
+                faiss.write_index(shared_index.tenant_index(vectors, user_id, merged.metric_type), os.path.join(segment_path, INDEX_FILE))
+
+            if index.ntotal > index.dead_count:
+                self._write_segment(shard_path, write)
+            self._remove_index(path)
+            self._discard(path)
+        print(f"Moved user {user_id} to the shared index {os.path.basename(shard_path)}")
+
+    def _move_to_dedicated(self, user_id, shard_path, embeddings):
+        """
+        Publishes a user's vectors in a shard as the base of a new dedicated
+        index, which searches use from then on, and tombstones them in the
+        shard until its next compaction.
+        """
+        path = self.index_path(user_id)
+        with self.write_lock(path), self.write_lock(shard_path):
+            shard = self._get(shard_path, embeddings)
+            if self._signature(path) is not None or shard is None:
+                return
+            view = shard.for_tenant(user_id)
+            os.makedirs(path, exist_ok=True)
+
+            def write(base_path):
+                merged = view.merged(os.path.join(base_path, chunk_store.CHUNKS_FILE))
+                faiss.write_index(merged, os.path.join(base_path, INDEX_FILE))
+
+            self._publish_base(path, write)
+            self._write_meta(path, {"target": index_types.FLAT, "factory": index_types.FLAT})
+            self._add_tombstones(shard_path, view.doc_ids())
+        print(f"Moved user {user_id} from {os.path.basename(shard_path)} to a dedicated index")
+
+    def invalidate(self, user_id):
+        self._discard(self._vector_path(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _segment_names(self, path):
+        segments_path = os.path.join(path, SEGMENTS_DIR)
+        if not os.path.isdir(segments_path):
+            return []
+        return sorted(name for name in os.listdir(segments_path) if name.isdigit())
+
+    def _vector_path(self, user_id):
+        # Users without a dedicated index are in the shared layout when it is on
+        path = self.index_path(user_id)
+        if shared_index.enabled() and self._signature(path) is None:
+            return self.shard_path(user_id)
+        return path
+
+    def _shard_names(self):
+        root = current_app.config.get('FAISS_INDEX_PATH', FAISS_INDEX_PATH)
+        if not os.path.isdir(root):
+            return []
+        return sorted(name for name in os.listdir(root) if name.startswith(shared_index.SHARD_PREFIX))
+
+    def _write_segment(self, path, write):
+        """
+        Has write(directory) write a new delta segment and adds it to the
+        index at path, under its write lock. The segment is written to a
+        temporary directory of its own first so readers never see a partially
+        written segment.
+        """
+        segments_path = os.path.join(path, SEGMENTS_DIR)
+        names = self._segment_names(path)
+        name = f"{int(names[-1]) + 1 if names else 1:08d}"
+        tmp_path = os.path.join(segments_path, f".{name}.{uuid.uuid4().hex}.tmp")
+        os.makedirs(tmp_path)
+        write(tmp_path)
+        os.rename(tmp_path, os.path.join(segments_path, name))
+
+    def _add_tombstones(self, path, doc_ids):
+        deleted = self._read_tombstones(path) | {int(doc_id) for doc_id in doc_ids}
+        tmp_file = os.path.join(path, f".{TOMBSTONES_FILE}.tmp")
+        with open(tmp_file, 'w') as f:
+            json.dump({"doc_ids": sorted(deleted)}, f)
+        os.replace(tmp_file, os.path.join(path, TOMBSTONES_FILE))
+
+    def _remove_index(self, path):
+        """Removes the vector index at path, keeping the directory's lexical index."""
+        # The segments are moved aside and the base unlinked first, so
+        # readers switch from the whole index to none of it at once
+        removed_segments = os.path.join(path, f".{SEGMENTS_DIR}.removed")
+        if os.path.isdir(os.path.join(path, SEGMENTS_DIR)):
+            os.rename(os.path.join(path, SEGMENTS_DIR), removed_segments)
+        if os.path.lexists(os.path.join(path, BASE_LINK)):
+            os.remove(os.path.join(path, BASE_LINK))
+        for file_name in LEGACY_INDEX_FILES + (TOMBSTONES_FILE, INDEX_META_FILE):
+            if os.path.exists(os.path.join(path, file_name)):
+                os.remove(os.path.join(path, file_name))
+        for name in os.listdir(path):
+            if name.startswith('base.') or name == os.path.basename(removed_segments):
+                shutil.rmtree(os.path.join(path, name))
+
+    def _lexical_path(self, path):
+        return os.path.join(path, lexical_index.LEXICAL_INDEX_FILE)
+
+    def _base_path(self, path):
+        """
+        Directory holding the current base index: the target of the `base`
+        link, or the index directory itself for indexes written before bases
+        were versioned.
+        """
+        link = os.path.join(path, BASE_LINK)
+        return os.path.realpath(link) if os.path.islink(link) else path
+
+    def _publish_base(self, path, write):
+        """
+        Has write(directory) write a new base index to its own directory and
+        switches the `base` link to it with an atomic rename, so readers see
+        either the old or the new version in full. Older versions are then
+        removed; processes that still have them open keep reading them until
+        they reload. Returns the result of write.
+        """
+        version = f"base.{time.time_ns()}"
+        tmp_path = os.path.join(path, f".{version}.tmp")
+        os.makedirs(tmp_path)
+        result = write(tmp_path)
+        os.rename(tmp_path, os.path.join(path, version))
+        tmp_link = os.path.join(path, f".{BASE_LINK}.tmp")
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(version, tmp_link)
+        os.replace(tmp_link, os.path.join(path, BASE_LINK))
+
+        for file_name in LEGACY_INDEX_FILES:
+            if os.path.exists(os.path.join(path, file_name)):
+                os.remove(os.path.join(path, file_name))
+        for name in os.listdir(path):
+            if name.startswith('base.') and name != version:
+                shutil.rmtree(os.path.join(path, name))
+        return result
+
+    def _load(self, path, embeddings):
+        """
+        Loads the index part stored at path. With FAISS_MMAP the vectors are
+        memory-mapped read-only instead of read into private memory, so every
+        worker process on the host shares the same page cache pages. Loaded
+        indexes must therefore never be modified in place. Chunk text and
+        metadata stay in the part's chunk store and are read per search hit.
+        """
+        index_file = os.path.join(path, INDEX_FILE)
+        if current_app.config.get('FAISS_MMAP', True):
+            index = faiss.read_index(index_file, getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP))
+        else:
+            index = faiss.read_index(index_file)
+        index_types.configure(index)
+
+        if os.path.exists(os.path.join(path, chunk_store.CHUNKS_FILE)):
+            part = FAISS(embeddings, index, chunk_store.ChunkStore(os.path.join(path, chunk_store.CHUNKS_FILE)), chunk_store.Positions())
+        else:
+            # Parts saved by FAISS.save_local keep their chunks in a pickled
+            # docstore, which is loaded in full until the next compaction
+            # rewrites the index.
+            with open(os.path.join(path, chunk_store.LEGACY_DOCSTORE_FILE), 'rb') as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+            part = FAISS(embeddings, index, chunk_store.PickledChunks(docstore, index_to_docstore_id), index_to_docstore_id)
+        # Bases built as a quantized index keep the original vectors beside
+        # it for rebuilds, clustering and exact scoring
+        vectors_file = os.path.join(path, VECTORS_FILE)
+        part.exact_vectors = np.load(vectors_file, mmap_mode='r') if os.path.exists(vectors_file) else None
+        return part
+
+    def _read_meta(self, path):
+        """Returns the index type the base was meant to be and the one it was built as."""
+        try:
+            with open(os.path.join(path, INDEX_META_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # Indexes from before index types were chosen are flat
+            return {"target": index_types.FLAT, "factory": index_types.FLAT}
+
+    def _write_meta(self, path, meta):
+        tmp_file = os.path.join(path, f".{INDEX_META_FILE}.tmp")
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, os.path.join(path, INDEX_META_FILE))
+
+    def _read_tombstones(self, path):
+        try:
+            with open(os.path.join(path, TOMBSTONES_FILE)) as f:
+                return set(json.load(f)["doc_ids"])
+        except FileNotFoundError:
+            return set()
+
+    def _file_signature(self, path):
+        try:
+            stats = [os.stat(os.path.join(path, INDEX_FILE)), os.stat(chunk_store.store_file(path))]
+        except OSError:
+            return None
+        return tuple((st.st_mtime_ns, st.st_size) for st in stats)
+
+    def _signature(self, path):
+        """
+        Returns (base signature, ((segment name, segment signature), ...),
+        tombstones signature) for the index at path, or None if there is no
+        index there.
+        """
+        base = self._file_signature(self._base_path(path))
+        segments = []
+        for name in self._segment_names(path):
+            segment = self._file_signature(os.path.join(path, SEGMENTS_DIR, name))
+            if segment is not None:
+                segments.append((name, segment))
+        if base is None and not segments:
+            return None
+        try:
+            st = os.stat(os.path.join(path, TOMBSTONES_FILE))
+            tombstones = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            tombstones = None
+        return base, tuple(segments), tombstones
+
+    def _store(self, path, index, signature):
+        # Entries are measured by their on-disk size: the vectors are stored
+        # uncompressed, and the chunk store (or older pickled docstore) stands
+        # for the chunk data the entry reads. Memory-mapped vectors live in
+        # the shared page cache and only the chunk data counts.
+        base, segments, _ = signature
+        files = [base] if base else []
+        files.extend(sig for _, sig in segments)
+        if current_app.config.get('FAISS_MMAP', True):
+            size = sum(sig[1][1] for sig in files)
+        else:
+            size = sum(s for sig in files for _, s in sig)
+        budget = current_app.config.get('FAISS_INDEX_CACHE_BYTES', 0)
+        with self._lock:
+            self._discard(path)
+            self._entries[path] = _CacheEntry(index, signature, size)
+            self._total_bytes += size
+            while self._total_bytes > budget and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted.size
+
+    def _discard(self, path):
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry:
+                self._total_bytes -= entry.size
+
+index_manager = IndexManager()
@@ -0,0 +1,90 @@
+import math
+import numpy as np
+import faiss
+from flask import current_app
+
+FLAT = 'Flat'
+
+def target_factory(ntotal):
+    """
+    Returns the faiss index factory string to use for an index of ntotal
+    vectors: exact flat search for small indexes, FAISS_HNSW_FACTORY from
+    FAISS_HNSW_MIN_VECTORS and FAISS_IVF_FACTORY from FAISS_IVF_MIN_VECTORS.
+    """
+    config = current_app.config
+    if ntotal >= config.get('FAISS_IVF_MIN_VECTORS', 1000000):
+        nlist = max(1, min(int(4 * math.sqrt(ntotal)), ntotal // 39))
+        return config.get('FAISS_IVF_FACTORY', 'IVF{nlist},SQ8').format(nlist=nlist)
+    if ntotal >= config.get('FAISS_HNSW_MIN_VECTORS', 50000):
+        return config.get('FAISS_HNSW_FACTORY', 'HNSW32')
+    return FLAT
+
+def is_exact(index):
+    """
+    Whether the index keeps its vectors uncompressed, so that reading them
+    back returns the vectors that were added. Quantized indexes (SQ, PQ)
+    return approximations.
+    """
+    inner = faiss.downcast_index(index)
+    if hasattr(inner, 'id_map'):
+        inner = faiss.downcast_index(inner.index)
+    return isinstance(inner, (faiss.IndexFlat, faiss.IndexHNSWFlat, faiss.IndexIVFFlat))
+
+def configure(index):
+    """Applies the search-time parameters (FAISS_NPROBE, FAISS_EF_SEARCH) to a loaded index."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = current_app.config.get('FAISS_NPROBE', 16)
+    hnsw = getattr(faiss.downcast_index(index), 'hnsw', None)
+    if hnsw is not None:
+        hnsw.efSearch = current_app.config.get('FAISS_EF_SEARCH', 64)
+    return index
+
+def search_parameters(index, selector):
+    """
+    Search parameters restricting a search of the index to the vectors the
+    selector accepts. Each index type takes its own parameter class, which
+    also replaces the search-time settings applied by configure().
+    """
+    inner = faiss.downcast_index(index)
+    if hasattr(inner, 'id_map'):
+        inner = faiss.downcast_index(inner.index)
+    if faiss.try_extract_index_ivf(inner) is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=current_app.config.get('FAISS_NPROBE', 16))
+    if hasattr(inner, 'hnsw'):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=current_app.config.get('FAISS_EF_SEARCH', 64))
+    return faiss.SearchParameters(sel=selector)
+
+def build(flat_index, factory):
+    """
+    Builds an index of the given type holding the vectors of a flat index,
+    in the same order so positions keep mapping to the same chunks.
+    """
+    vectors = flat_index.reconstruct_n(0, flat_index.ntotal)
+    index = faiss.index_factory(flat_index.d, factory, flat_index.metric_type)
+    if not index.is_trained:
+        sample = vectors
+        if len(vectors) > 256 * 1024:
+            rows = np.random.default_rng(42).choice(len(vectors), 256 * 1024, replace=False)
+            sample = vectors[rows]
+        index.train(sample)
+    index.add(vectors)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # Needed to read vectors back by position (compaction, clustering)
+        ivf.make_direct_map()
+    return configure(index)
+
+def recall(flat_index, index, k=10):
+    """
+    Share of the exact k nearest neighbours that the index also returns,
+    averaged over FAISS_RECALL_SAMPLE of the stored vectors used as queries.
+    """
+    k = min(k, flat_index.ntotal)
+    sample_size = min(current_app.config.get('FAISS_RECALL_SAMPLE', 200), flat_index.ntotal)
+    rows = np.random.default_rng(0).choice(flat_index.ntotal, sample_size, replace=False)
+    queries = np.vstack([flat_index.reconstruct(int(row)) for row in rows])
+    _, expected = flat_index.search(queries, k)
+    _, found = index.search(queries, k)
+    hits = sum(len(set(a) & set(b)) for a, b in zip(expected.tolist(), found.tolist()))
+    return hits / (sample_size * k)
@@ -0,0 +1,275 @@
+import datetime
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import aliased
+from ..models import db, IngestJob
+from .knowledge_base import store_upload, process_document, add_documents_bulk, remove_upload, notify_documents_added
+from .custom_embeddings import EmbeddingError
+
+class IngestQueue:
+    """
+    Runs document ingestion outside the request that uploaded the file.
+
+    Jobs are rows of the ingest_job table, so they outlive the process that
+    queued them. Workers claim the oldest queued job with a conditional
+    update, which lets several processes share the table, and a running job
+    that has not reported progress for INGEST_JOB_TIMEOUT seconds is claimed
+    again. At most INGEST_MAX_WORKERS jobs run at once in each process.
+
+    The jobs queued by one upload request share a bulk id. A worker that
+    claims a job also claims up to INGEST_BATCH_SIZE - 1 more queued jobs of
+    the same bulk and embeds and indexes them together, with one index
+    segment and one transaction per batch, so a large archive is ingested in
+    a few batches that succeed or fail on their own. A single notification
+    is sent once the last job of the bulk has finished.
+    Besides after each upload, the table is polled every INGEST_POLL_INTERVAL
+    seconds from the first request on, so jobs left queued by a stopped
+    process and jobs whose worker died are picked up without waiting for
+    the next upload. With INGEST_EAGER, a job runs inside submit() instead
+    and nothing is polled, which the tests use.
+    """
+    def __init__(self):
+        self._executor = None
+        self._poller = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('INGEST_MAX_WORKERS', 2)
+        app.config.setdefault('INGEST_EAGER', False)
+        app.config.setdefault('INGEST_JOB_TIMEOUT', 3600)
+        app.config.setdefault('INGEST_POLL_INTERVAL', 60)
+        app.config.setdefault('INGEST_BATCH_SIZE', 512)
+
+        @app.before_request
+        def start_ingest_polling():
+            if self._poller is None:
+                self.start(app)
+
+    def submit(self, user_id, file):
+        """
+        Stores an uploaded file and queues its ingestion. Returns the
+        IngestJob, or None if the file type is not supported.
+        """
+        return self.submit_many(user_id, [file])[0][1]
+
+    def submit_many(self, user_id, files):
+        """
+        Stores uploaded files one at a time and queues their ingestion as
+        one bulk. Returns (filename, IngestJob) for every file, with None for
+        files whose type is not supported. If reading the files fails part
+        way, nothing is queued and the exception is raised.
+        """
+        bulk_id = uuid.uuid4().hex
+        queued = []
+        jobs = []
+        try:
+            for file in files:
+                stored = store_upload(file)
+                if stored is None:
+                    queued.append((file.filename, None))
+                    continue
+                filename, file_path, ext = stored
+                job = IngestJob(user_id=user_id, filename=filename, file_path=file_path, document_type=ext, bulk_id=bulk_id)
+                db.session.add(job)
+                queued.append((file.filename, job))
+                jobs.append(job)
+        except Exception:
+            db.session.rollback()
+            for job in jobs:
+                remove_upload(job.file_path)
+            raise
+        db.session.commit()
+        if not jobs:
+            return queued
+
+        app = current_app._get_current_object()
+        if app.config.get('INGEST_EAGER'):
+            size = app.config.get('INGEST_BATCH_SIZE', 512)
+            for start in range(0, len(jobs), size):
+                claimed = [job for job in jobs[start:start + size] if self._claim(job)]
+                if claimed:
+                    self._run(claimed)
+        else:
+            self._pool(app).submit(self._drain, app)
+        return queued
+
+    def start(self, app):
+        """Starts polling the job table in this process, unless INGEST_EAGER is set."""
+        if app.config.get('INGEST_EAGER'):
+            return
+        with self._lock:
+            if self._poller is not None:
+                return
+            self._stopped = threading.Event()
+            self._poller = threading.Thread(target=self._poll, args=(app, self._stopped), name='ingest-poll', daemon=True)
+            self._poller.start()
+
+    def shutdown(self):
+        """Waits for running jobs to finish and stops the worker threads."""
+        with self._lock:
+            poller, self._poller = self._poller, None
+            stopped = self._stopped
+        if poller:
+            stopped.set()
+            poller.join()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=True)
+
+    def _poll(self, app, stopped):
+        drain = None
+        while True:
+            # A drain still running claims new jobs itself
+            if drain is None or drain.done():
+                drain = self._pool(app).submit(self._drain, app)
+            if stopped.wait(app.config.get('INGEST_POLL_INTERVAL', 60)):
+                return
+
+    def _pool(self, app):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=app.config.get('INGEST_MAX_WORKERS', 2),
+                    thread_name_prefix='ingest',
+                )
+            return self._executor
+
+    def _drain(self, app):
+        """Runs queued jobs until none are left."""
+        with app.app_context():
+            while True:
+                jobs = self._claim_batch()
+                if not jobs:
+                    return
+                self._run(jobs)
+
+    def _claim_next(self):
+        timeout = current_app.config.get('INGEST_JOB_TIMEOUT', 3600)
+        stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+        while True:
+            candidates = IngestJob.query.filter(or_(
+                IngestJob.status == 'queued',
+                and_(IngestJob.status == 'running', IngestJob.updated_at < stale),
+            )).order_by(IngestJob.id).limit(8).all()
+            if not candidates:
+                return None
+            for job in candidates:
+                if self._claim(job):
+                    return job
+
+    def _claim_batch(self):
+        """Claims the next job and up to INGEST_BATCH_SIZE - 1 queued jobs of the same bulk."""
+        job = self._claim_next()
+        if job is None:
+            return []
+        jobs = [job]
+        # Jobs queued before bulk ids existed are batched per user
+        candidates = IngestJob.query.filter(
+            IngestJob.user_id == job.user_id,
+            IngestJob.bulk_id == job.bulk_id,
+            IngestJob.status == 'queued',
+        ).order_by(IngestJob.id).limit(current_app.config.get('INGEST_BATCH_SIZE', 512) - 1).all()
+        jobs.extend(candidate for candidate in candidates if self._claim(candidate))
+        return jobs
+
+    def _claim(self, job):
+        """Marks the job as running unless another worker got to it first."""
+        claimed = IngestJob.query.filter_by(id=job.id, status=job.status, updated_at=job.updated_at).update(
+            {'status': 'running', 'updated_at': datetime.datetime.utcnow()},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        if claimed:
+            db.session.refresh(job)
+        return bool(claimed)
+
+    def _run(self, jobs):
+        """Runs claimed jobs of one bulk, together if there are several."""
+        def progress(stage):
+            now = datetime.datetime.utcnow()
+            for job in jobs:
+                job.stage = stage
+                job.updated_at = now
+            db.session.commit()
+
+        try:
+            if len(jobs) == 1:
+                job = jobs[0]
+                results = [process_document(job.user_id, job.filename, job.file_path, job.document_type, progress, notify=False)]
+            else:
+                uploads = [(job.filename, job.file_path, job.document_type) for job in jobs]
+                results = add_documents_bulk(jobs[0].user_id, uploads, progress, notify=False)
+        except Exception as e:
+            db.session.rollback()
+            results = [e] * len(jobs)
+
+        now = datetime.datetime.utcnow()
+        for job, result in zip(jobs, results):
+            if isinstance(result, Exception):
+                print(f"Ingest job {job.id} failed: {result}")
+                job.status = 'failed'
+                if isinstance(result, EmbeddingError):
+                    job.error = "Embedding service unavailable, please try again later"
+                else:
+                    job.error = str(result)
+            else:
+                job.status = 'done'
+                job.document_id = result.id
+            job.updated_at = now
+        db.session.commit()
+        for job in jobs:
+            if job.status == 'failed':
+                # Kept while the job was running, see remove_upload
+                remove_upload(job.file_path)
+
+        if jobs[0].bulk_id is None:
+            notify_documents_added(jobs[0].user_id, [job.filename for job in jobs if job.status == 'done'])
+        else:
+            self._notify_if_finished(jobs[0].user_id, jobs[0].bulk_id)
+
+    def _notify_if_finished(self, user_id, bulk_id):
+        """
+        Sends the notification for a bulk once none of its jobs is queued or
+        running. The conditional update lets only one worker send it when
+        several finish the bulk's last batches at the same time.
+        """
+        pending = aliased(IngestJob)
+        finished = IngestJob.query.filter(
+            IngestJob.bulk_id == bulk_id,
+            IngestJob.notified.is_(False),
+            ~db.session.query(pending.id).filter(
+                pending.bulk_id == bulk_id,
+                pending.status.in_(('queued', 'running')),
+            ).exists(),
+        ).update({'notified': True}, synchronize_session=False)
+        db.session.commit()
+        if not finished:
+            return
+        jobs = IngestJob.query.filter_by(bulk_id=bulk_id).all()
+        notify_documents_added(
+            user_id,
+            [job.filename for job in jobs if job.status == 'done'],
+            failed=sum(1 for job in jobs if job.status == 'failed'),
+        )
+
+def get_job(user_id, job_id):
+    job = IngestJob.query.filter_by(id=job_id, user_id=user_id).first()
+    if job is None:
+        return None
+    return {
+        "id": job.id,
+        "filename": job.filename,
+        "status": job.status,
+        "stage": job.stage,
+        "error": job.error,
+        "document_id": job.document_id,
+        "created_at": job.created_at.isoformat(),
+        "updated_at": job.updated_at.isoformat(),
+    }
+
+ingest_queue = IngestQueue()
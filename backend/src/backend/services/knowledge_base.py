@@ -1,25 +1,52 @@
 import os
+import json
+import tarfile
+import uuid
+import zlib
+import zipfile
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
-from ..models import db, Document, User
+from sqlalchemy import func, or_
+from flask import current_app
+from ..models import db, Document, DocumentText, IngestJob, User
 from .notification import send_notification
 from langchain_community.document_loaders import TextLoader, PyPDFLoader, UnstructuredExcelLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from .search import LlamaServerEmbeddings
+from .custom_embeddings import LlamaServerEmbeddings
+from .index_manager import index_manager
+from .term_stats import add_document_terms, remove_document_terms
 
-UPLOAD_FOLDER = 'uploads'
-FAISS_INDEX_PATH = 'faiss_index'
-
-def get_user_documents(user_id, doc_type=None, start_date=None, end_date=None):
-    query = Document.query.filter_by(user_id=user_id)
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2')
 
+def _filter_documents(query, doc_type=None, start_date=None, end_date=None, tags=None, source=None):
+    """
+    Applies the document filters to a query: type, upload date range, any of
+    a list of tags (matched against the comma-separated tags, ignoring case
+    and spaces) and a source substring.
+    """
     if doc_type:
         query = query.filter(Document.document_type == doc_type)
     if start_date:
         query = query.filter(Document.uploaded_at >= start_date)
     if end_date:
         query = query.filter(Document.uploaded_at <= end_date)
-    
+    if tags:
+        padded = "," + func.replace(func.lower(func.coalesce(Document.tags, "")), " ", "") + ","
+        query = query.filter(or_(*[
+            padded.contains(f",{tag.lower().replace(' ', '')},", autoescape=True) for tag in tags
+        ]))
+    if source:
+        query = query.filter(Document.source.contains(source, autoescape=True))
+    return query
+
+def filtered_document_ids(user_id, doc_type=None, start_date=None, end_date=None, tags=None, source=None):
+    """Returns the ids of the user's documents matching the filters."""
+    query = _filter_documents(db.session.query(Document.id).filter(Document.user_id == user_id),
+                              doc_type, start_date, end_date, tags, source)
+    return [doc_id for doc_id, in query]
+
+def get_user_documents(user_id, doc_type=None, start_date=None, end_date=None):
+    query = _filter_documents(Document.query.filter_by(user_id=user_id), doc_type, start_date, end_date)
     documents = query.all()
     return [
         {
@@ -32,59 +59,100 @@ def get_user_documents(user_id, doc_type=None, start_date=None, end_date=None):
         } for doc in documents
     ]
 
-def add_document(user_id, file):
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER)
+LOADERS = {
+    'txt': TextLoader,
+    'pdf': PyPDFLoader,
+    'xlsx': UnstructuredExcelLoader,
+    'xls': UnstructuredExcelLoader,
+}
+
+def store_upload(file):
+    """
+    Saves an uploaded file to the upload folder under a unique name, so
+    uploads of files with the same name never overwrite each other. Returns
+    (filename, file_path, ext), or None if the file type is not supported.
+    """
+    upload_folder = current_app.config.get('UPLOAD_FOLDER', 'uploads')
+    if not os.path.exists(upload_folder):
+        os.makedirs(upload_folder)
 
     filename = secure_filename(file.filename)
     if not filename:
         return None
-        
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(file_path)
 
     _, ext = os.path.splitext(filename)
     ext = ext.lower().lstrip('.')
-
-    if ext == 'txt':
-        loader = TextLoader(file_path)
-    elif ext == 'pdf':
-        loader = PyPDFLoader(file_path)
-    elif ext in ['xlsx', 'xls']:
-        loader = UnstructuredExcelLoader(file_path)
-    else:
-        os.remove(file_path)
+    if ext not in LOADERS:
         return None
-    
-    documents = loader.load()
+        
+    file_path = os.path.join(upload_folder, f"{uuid.uuid4().hex}_{filename}")
+    file.save(file_path)
+    return filename, file_path, ext
 
+def _split(file_path, ext, progress=None):
+    """Returns the text of each page of a file and its chunks."""
+    if progress:
+        progress('parse')
+    documents = LOADERS[ext](file_path).load()
+
+    if progress:
+        progress('chunk')
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    texts = text_splitter.split_documents(documents)
+    return [page.page_content for page in documents], text_splitter.split_documents(documents)
 
-    embeddings = LlamaServerEmbeddings()
-    user_index_path = os.path.join(FAISS_INDEX_PATH, f"user_{user_id}")
-
-    if os.path.exists(user_index_path):
-        faiss_index = FAISS.load_local(user_index_path, embeddings, allow_dangerous_deserialization=True)
-        faiss_index.add_documents(texts)
-    else:
-        if not os.path.exists(FAISS_INDEX_PATH):
-            os.makedirs(FAISS_INDEX_PATH)
-        faiss_index = FAISS.from_documents(texts, embeddings)
-    
-    faiss_index.save_local(user_index_path)
+def _compress_pages(pages):
+    return zlib.compress(json.dumps(pages).encode('utf-8'))
 
+def load_document_pages(doc):
+    """
+    Returns the text of each page of a document. The text saved at ingest
+    time is used when there is one; otherwise the original file is parsed
+    and its text saved for next time.
+    """
+    if doc.text is not None:
+        return json.loads(zlib.decompress(doc.text.content).decode('utf-8'))
+    if doc.document_type not in LOADERS:
+        return []
+    pages = [page.page_content for page in LOADERS[doc.document_type](doc.file_path).load()]
+    doc.text = DocumentText(content=_compress_pages(pages))
+    db.session.commit()
+    return pages
+
+def iter_document_pages(documents):
+    """Yields (document, pages) for each document, skipping unreadable ones."""
+    for doc in documents:
+        try:
+            yield doc, load_document_pages(doc)
+        except Exception as e:
+            print(f"Error loading document text: {doc.file_path}, {e}")
+
+def _index_document(user_id, filename, file_path, ext, pages, texts, embeddings, vectors=None):
+    """Records the document and its text for a user and appends its chunks to the user's index."""
     doc = Document(
         user_id=user_id,
         file_path=file_path,
         document_type=ext,
         source=filename,
-        tags=""
+        tags="",
+        text=DocumentText(content=_compress_pages(pages))
     )
     db.session.add(doc)
+    db.session.flush()
+    add_document_terms(doc, pages)
+
+    # Tag every chunk with its document so its vectors can be deleted later
+    for text in texts:
+        text.metadata['doc_id'] = doc.id
+
+    try:
+        index_manager.append(user_id, texts, embeddings, vectors)
+    except Exception:
+        db.session.rollback()
+        raise
     db.session.commit()
+    return doc
 
-    # Send notification
+def _notify_document_added(user_id, filename):
     user = User.query.get(user_id)
     if user and user.username: # Assuming username is the email for simplicity
         send_notification(
@@ -93,37 +161,234 @@ def add_document(user_id, file):
             message_body=f"A new document '{filename}' has been successfully added."
         )
 
+def notify_documents_added(user_id, filenames, failed=0):
+    """
+    Sends a single notification for documents added together, such as the
+    files of one bulk upload, mentioning how many of them could not be added.
+    """
+    if not filenames:
+        return
+    if len(filenames) == 1 and not failed:
+        _notify_document_added(user_id, filenames[0])
+        return
+    user = User.query.get(user_id)
+    if user and user.username: # Assuming username is the email for simplicity
+        if failed:
+            message_body = f"{len(filenames)} of {len(filenames) + failed} uploaded documents have been successfully added."
+        else:
+            message_body = f"{len(filenames)} new documents have been successfully added."
+        send_notification(
+            recipient=user.username,
+            title="New Documents Added to Your Knowledge Base",
+            message_body=message_body
+        )
+
+def process_document(user_id, filename, file_path, ext, progress=None, notify=True):
+    """
+    Parses, splits, embeds and indexes a stored file for a user. If given,
+    progress is called with the name of each stage ('parse', 'chunk',
+    'embed', 'index') as it starts. The stored file is removed if
+    processing fails. Without notify, no notification is sent and the
+    caller reports the document.
+    """
+    try:
+        pages, texts = _split(file_path, ext, progress)
+        embeddings = LlamaServerEmbeddings()
+        if progress:
+            progress('embed')
+        vectors = embeddings.embed_documents([text.page_content for text in texts])
+        if progress:
+            progress('index')
+        doc = _index_document(user_id, filename, file_path, ext, pages, texts, embeddings, vectors)
+    except Exception:
+        remove_upload(file_path)
+        raise
+
+    # Send notification
+    if notify:
+        _notify_document_added(user_id, filename)
+
     return doc
 
+def add_document(user_id, file):
+    stored = store_upload(file)
+    if stored is None:
+        return None
+    filename, file_path, ext = stored
+    return process_document(user_id, filename, file_path, ext)
+
+def add_shared_document(user_ids, file):
+    """
+    Adds the same file to the knowledge base of several users. The file is
+    stored, split and embedded once; every user gets their own Document
+    and index segment built from the shared vectors. Returns a dict mapping
+    each user id to its Document, or to None if adding it failed.
+    """
+    stored = store_upload(file)
+    if stored is None:
+        return {user_id: None for user_id in user_ids}
+    filename, file_path, ext = stored
+
+    embeddings = LlamaServerEmbeddings()
+    try:
+        pages, texts = _split(file_path, ext)
+        vectors = embeddings.embed_documents([text.page_content for text in texts])
+    except Exception:
+        remove_upload(file_path)
+        raise
+
+    added = {}
+    for user_id in user_ids:
+        try:
+            added[user_id] = _index_document(user_id, filename, file_path, ext, pages, texts, embeddings, vectors)
+        except Exception as e:
+            print(f"Failed to add {filename} for user {user_id}: {e}")
+            added[user_id] = None
+            continue
+        _notify_document_added(user_id, filename)
+
+    if not any(added.values()):
+        remove_upload(file_path)
+    return added
+
+def iter_upload_files(files):
+    """
+    Yields the files of a bulk upload as FileStorage objects. Zip and tar
+    archives are expanded into their member files, which are read one at a
+    time rather than extracted up front.
+    """
+    for file in files:
+        name = file.filename.lower()
+        if name.endswith('.zip'):
+            with zipfile.ZipFile(file.stream) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    with archive.open(info) as member:
+                        yield FileStorage(stream=member, filename=info.filename)
+        elif name.endswith(ARCHIVE_EXTENSIONS):
+            # Stream mode reads the archive sequentially without seeking
+            with tarfile.open(fileobj=file.stream, mode='r|*') as archive:
+                for info in archive:
+                    if not info.isfile():
+                        continue
+                    yield FileStorage(stream=archive.extractfile(info), filename=info.name)
+        else:
+            yield file
+
+def add_documents_bulk(user_id, uploads, progress=None, notify=True):
+    """
+    Adds a batch of stored files, given as (filename, file_path, ext)
+    tuples, in one pass: each file is split, then the chunks of all files
+    are embedded together, written to the index as a single segment, and
+    their Document rows are committed in one transaction with a single
+    notification. Returns the Document of each file, or the exception that
+    kept it from being read. If embedding or indexing fails, nothing is
+    added, the files are removed and the exception is raised. progress and
+    notify are used as in process_document.
+    """
+    results = []
+    pending = []
+    if progress:
+        progress('parse')
+    for filename, file_path, ext in uploads:
+        try:
+            pages, texts = _split(file_path, ext)
+        except Exception as e:
+            remove_upload(file_path)
+            results.append(ValueError(f"Could not read file: {e}"))
+            continue
+        results.append(None)
+        pending.append((len(results) - 1, filename, file_path, ext, pages, texts))
+
+    if not pending:
+        return results
+
+    embeddings = LlamaServerEmbeddings()
+    chunks = [text for *_, texts in pending for text in texts]
+    try:
+        if progress:
+            progress('embed')
+        vectors = embeddings.embed_documents([chunk.page_content for chunk in chunks])
+        if progress:
+            progress('index')
+        docs = []
+        for _, filename, file_path, ext, pages, _ in pending:
+            doc = Document(
+                user_id=user_id,
+                file_path=file_path,
+                document_type=ext,
+                source=filename,
+                tags="",
+                text=DocumentText(content=_compress_pages(pages))
+            )
+            db.session.add(doc)
+            docs.append(doc)
+        db.session.flush()
+        for doc, (_, _, _, _, pages, _) in zip(docs, pending):
+            add_document_terms(doc, pages)
+
+        # Tag every chunk with its document so its vectors can be deleted later
+        for doc, (*_, texts) in zip(docs, pending):
+            for text in texts:
+                text.metadata['doc_id'] = doc.id
+
+        index_manager.append(user_id, chunks, embeddings, vectors)
+    except Exception:
+        db.session.rollback()
+        for _, _, file_path, _, _, _ in pending:
+            remove_upload(file_path)
+        raise
+    db.session.commit()
+
+    for doc, (position, *_) in zip(docs, pending):
+        results[position] = doc
+
+    if notify:
+        notify_documents_added(user_id, [doc.source for doc in docs])
+
+    return results
+
+def remove_upload(file_path):
+    """
+    Removes a stored file unless another document or a pending ingest job
+    still refers to it.
+    """
+    if not os.path.exists(file_path) or Document.query.filter_by(file_path=file_path).count():
+        return
+    if IngestJob.query.filter(IngestJob.file_path == file_path, IngestJob.status.in_(('queued', 'running'))).count():
+        return
+    os.remove(file_path)
+
 def delete_document(user_id, doc_id):
     doc = Document.query.filter_by(id=doc_id, user_id=user_id).first()
     if doc:
-        if os.path.exists(doc.file_path):
-            os.remove(doc.file_path)
-        
-        # Note: This operation does not remove the document's vectors from the
-        # local FAISS index. The vectors become "orphaned" but will not be
-        # returned in search results because the corresponding metadata in the
-        # SQL database has been deleted. For a production system, a vector
-        # database that supports deletions or a re-indexing strategy would be
-        # recommended.
-        
+        # The document's vectors are tombstoned and filtered out of searches
+        # until the next compaction removes them from the index.
+        index_manager.delete_documents(user_id, [doc.id], LlamaServerEmbeddings())
+        remove_document_terms(doc.user_id, [doc.id])
+
         db.session.delete(doc)
         db.session.commit()
+        # Shared documents (see add_shared_document) reuse the same file
+        remove_upload(doc.file_path)
         return True
     return False
 
 def batch_delete_documents(user_id, doc_ids):
     docs = Document.query.filter(Document.user_id == user_id, Document.id.in_(doc_ids)).all()
+    if docs:
+        index_manager.delete_documents(user_id, [doc.id for doc in docs], LlamaServerEmbeddings())
+        remove_document_terms(docs[0].user_id, [doc.id for doc in docs])
     
     deleted_count = 0
     for doc in docs:
-        if os.path.exists(doc.file_path):
-            os.remove(doc.file_path)
         db.session.delete(doc)
         deleted_count += 1
     
     db.session.commit()
+    for file_path in {doc.file_path for doc in docs}:
+        remove_upload(file_path)
     return deleted_count
 
 def edit_document_metadata(user_id, doc_id, tags, source):
@@ -0,0 +1,65 @@
+import json
+import re
+import sqlite3
+from contextlib import closing
+from langchain_core.documents import Document
+
+LEXICAL_INDEX_FILE = 'lexical.db'
+
+# Chunks are stored in an FTS5 table, whose bm25() ranking function scores
+# them against a query; the porter tokenizer matches word variants.
+SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5("
+    "content, doc_id UNINDEXED, metadata UNINDEXED, tokenize='porter unicode61')"
+)
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute(SCHEMA)
+    return conn
+
+def _match_expression(query):
+    """Turns free text into an FTS5 query matching any of its words."""
+    words = re.findall(r'\w+', query.lower())
+    return " OR ".join(f'"{word}"' for word in dict.fromkeys(words))
+
+def add_documents(path, documents):
+    """Adds LangChain documents (chunks) to the lexical index at path."""
+    with closing(_connect(path)) as conn:
+        conn.executemany(
+            "INSERT INTO chunks (content, doc_id, metadata) VALUES (?, ?, ?)",
+            [
+                (doc.page_content, doc.metadata.get('doc_id'), json.dumps(doc.metadata, default=str))
+                for doc in documents
+            ],
+        )
+        conn.commit()
+
+def delete_documents(path, doc_ids):
+    """Removes the chunks of the given documents."""
+    doc_ids = [int(doc_id) for doc_id in doc_ids]
+    if not doc_ids:
+        return
+    with closing(_connect(path)) as conn:
+        conn.execute(
+            f"DELETE FROM chunks WHERE doc_id IN ({','.join('?' * len(doc_ids))})",
+            doc_ids,
+        )
+        conn.commit()
+
+def search(path, query, k, doc_ids=None):
+    """
+    Returns up to k chunks ranked by BM25 against the query, best first,
+    only among the chunks of the given documents if doc_ids is not None.
+    """
+    expression = _match_expression(query)
+    if not expression:
+        return []
+    sql = "SELECT content, metadata FROM chunks WHERE chunks MATCH ?"
+    params = [expression]
+    if doc_ids is not None:
+        sql += " AND doc_id IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps([int(doc_id) for doc_id in doc_ids]))
+    with closing(_connect(path)) as conn:
+        rows = conn.execute(sql + " ORDER BY bm25(chunks) LIMIT ?", params + [k]).fetchall()
+    return [Document(page_content=content, metadata=json.loads(metadata)) for content, metadata in rows]
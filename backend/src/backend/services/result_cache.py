@@ -0,0 +1,113 @@
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+
+def normalize_query(query):
+    """Case- and whitespace-insensitive form of a query used as a cache key."""
+    return " ".join(query.casefold().split()).strip(" ?!.")
+
+class ResultCache:
+    """
+    TTL and LRU cache of final /search results.
+
+    Entries are keyed by user id, normalized query text, the version of the
+    user's index and, for filtered searches, the ids of the documents the
+    filters selected, so adding, deleting or retagging documents makes
+    earlier answers unreachable. Results are kept in process memory and, when
+    SEARCH_CACHE_PATH is set, also in a SQLite database shared by every
+    worker on the host.
+    """
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_CACHE_TTL', 3600)
+        app.config.setdefault('SEARCH_CACHE_MAX_ENTRIES', 1024)
+        app.config.setdefault('SEARCH_CACHE_PATH', None)
+
+    def get(self, user_id, query, version, doc_ids=None):
+        key = self._key(user_id, query, version, doc_ids)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                expires_at, results = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    return results
+                del self._entries[key]
+
+            conn = self._connection()
+            if conn is None:
+                return None
+            row = conn.execute("SELECT results, expires_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                return None
+            conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+            conn.commit()
+            results = json.loads(row[0])
+            self._remember(key, row[1], results)
+            return results
+
+    def put(self, user_id, query, version, results, doc_ids=None):
+        key = self._key(user_id, query, version, doc_ids)
+        now = time.time()
+        expires_at = now + current_app.config.get('SEARCH_CACHE_TTL', 3600)
+        with self._lock:
+            self._remember(key, expires_at, results)
+            conn = self._connection()
+            if conn is None:
+                return
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, results, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(results), expires_at, now),
+            )
+            conn.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (current_app.config.get('SEARCH_CACHE_MAX_ENTRIES', 1024),),
+            )
+            conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+
+    def _key(self, user_id, query, version, doc_ids=None):
+        raw = f"{user_id}\0{version}\0{normalize_query(query)}"
+        if doc_ids is not None:
+            raw += "\0" + ",".join(str(doc_id) for doc_id in sorted(doc_ids))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _remember(self, key, expires_at, results):
+        self._entries[key] = (expires_at, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > current_app.config.get('SEARCH_CACHE_MAX_ENTRIES', 1024):
+            self._entries.popitem(last=False)
+
+    def _connection(self):
+        path = current_app.config.get('SEARCH_CACHE_PATH')
+        if not path:
+            return None
+        conn = self._connections.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, results TEXT NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.commit()
+            self._connections[path] = conn
+        return conn
+
+result_cache = ResultCache()
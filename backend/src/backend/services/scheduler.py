@@ -0,0 +1,110 @@
+import datetime
+import os
+import socket
+from apscheduler.schedulers.blocking import BlockingScheduler
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from .aggregation import run_aggregation_for_all_users
+from .custom_embeddings import LlamaServerEmbeddings
+from .index_manager import index_manager
+from ..models import db, SchedulerLease
+
+AGGREGATION_LEASE = 'aggregation'
+
+def lease_owner():
+    """Identifies this worker process across hosts."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def acquire_lease(name, owner, ttl):
+    """
+    Takes the named lease for ttl seconds, or renews it if owner already
+    holds it. Returns False while another owner holds it and it has not
+    expired.
+
+    The lease is a row in the application database, so it elects a single
+    holder among workers on every host that shares the database. A holder
+    that dies stops renewing and loses the lease once it expires. Expiry
+    times come from the workers' clocks, which must agree to well within ttl.
+    """
+    now = datetime.datetime.utcnow()
+    if db.session.get(SchedulerLease, name) is None:
+        try:
+            db.session.add(SchedulerLease(name=name, owner=owner, expires_at=now))
+            db.session.commit()
+        except IntegrityError:
+            # Another worker created the row first
+            db.session.rollback()
+    acquired = SchedulerLease.query.filter(
+        SchedulerLease.name == name,
+        or_(SchedulerLease.owner == owner, SchedulerLease.expires_at <= now),
+    ).update(
+        {'owner': owner, 'expires_at': now + datetime.timedelta(seconds=ttl)},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return bool(acquired)
+
+def release_lease(name, owner):
+    """Lets the lease expire now, so a standby can take it over at once."""
+    SchedulerLease.query.filter_by(name=name, owner=owner).update(
+        {'expires_at': datetime.datetime.utcnow()},
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+def compact_indexes():
+    """
+    Folds delta segments and deletions back into the base indexes of every
+    user and shard that has accumulated enough of them.
+    """
+    for uid, result in index_manager.compact_all(LlamaServerEmbeddings()).items():
+        print(f"Compacted {result['segments']} index segments and removed {result['removed']} vectors for {uid}")
+
+def run_scheduler(app, owner):
+    """
+    Runs the aggregation scheduler until interrupted. Every FEED_POLL_TICK
+    seconds, the worker holding the aggregation lease polls due feeds and
+    then compacts the vector indexes; compaction runs even when no feed was
+    due, as uploads and deletions leave segments behind as well. Other
+    workers stand by and take the lease over once it expires.
+
+    The holder renews the lease at each tick and every AGGREGATION_LEASE_TTL
+    / 3 seconds in between, so a long run does not lose it. The first tick
+    runs immediately, and a tick that overruns the next one is not run twice.
+    """
+    ttl = app.config['AGGREGATION_LEASE_TTL']
+
+    def renew():
+        with app.app_context():
+            return acquire_lease(AGGREGATION_LEASE, owner, ttl)
+
+    def tick():
+        if not renew():
+            return
+        with app.app_context():
+            try:
+                run_aggregation_for_all_users(due_only=True)
+            finally:
+                compact_indexes()
+
+    scheduler = BlockingScheduler()
+    scheduler.add_job(
+        func=tick,
+        trigger="interval",
+        seconds=app.config['FEED_POLL_TICK'],
+        next_run_time=datetime.datetime.now(),
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        func=renew,
+        trigger="interval",
+        seconds=max(ttl // 3, 1),
+        max_instances=1,
+        coalesce=True,
+    )
+    try:
+        scheduler.start()
+    finally:
+        with app.app_context():
+            release_lease(AGGREGATION_LEASE, owner)
@@ -1,47 +1,25 @@
-import os
 import requests
 from flask import current_app
-from langchain_community.vectorstores import FAISS
-from langchain_core.embeddings import Embeddings
-from typing import List
 from langchain.chains import RetrievalQA
-from .custom_llm import LlamaServerLLM, parse_llm_output
+from .custom_llm import LlamaServerLLM, LLMError, parse_llm_output
 from langchain.prompts import PromptTemplate
 from langchain.retrievers import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors import CrossEncoderReranker
 from .custom_cross_encoder import LlamaServerCrossEncoder
+from .custom_embeddings import LlamaServerEmbeddings
+from .index_manager import index_manager
+from .hybrid_retriever import HybridRetriever
+from .result_cache import result_cache
 
-FAISS_INDEX_PATH = 'faiss_index'
+PROMPT = PromptTemplate(
+    template="""Use the following pieces of context to answer the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer.
 
-class LlamaServerEmbeddings(Embeddings):
-    """Custom LangChain Embeddings class that calls the llama-server API."""
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        llama_server_url = current_app.config.get('LLAMA_SERVER_EMBEDDING_URL')
-        try:
-            response = requests.post(
-                f"{llama_server_url}/v1/embeddings",
-                json={"input": texts, "model": "ggml-org/embeddinggemma-300M-GGUF"}
-            )
-            response.raise_for_status()
-            data = response.json()['data']
-            data.sort(key=lambda e: e['index'])
-            return [item['embedding'] for item in data]
-        except requests.exceptions.RequestException as e:
-            print(f"Error calling embedding API: {e}")
-            return [[] for _ in texts]
-
-    def embed_query(self, text: str) -> List[float]:
-        llama_server_url = current_app.config.get('LLAMA_SERVER_EMBEDDING_URL')
-        try:
-            response = requests.post(
-                f"{llama_server_url}/v1/embeddings",
-                json={"input": text, "model": "ggml-org/embeddinggemma-300M-GGUF"}
-            )
-            response.raise_for_status()
-            return response.json()['data'][0]['embedding']
-        except requests.exceptions.RequestException as e:
-            print(f"Error calling embedding API: {e}")
-            return []
+    {context}
+
+    Question: {question}
+    Answer:""",
+    input_variables=["context", "question"],
+)
 
 def _bing_search(query):
     """Performs a Bing search and summarizes the top 3 results."""
@@ -82,38 +60,90 @@ def _bing_search(query):
         return []
 
 
-def perform_search(user_id, query):
-    """Performs semantic search with reranking and Bing fallback."""
-    user_index_path = os.path.join(FAISS_INDEX_PATH, f"user_{user_id}")
-    if not os.path.exists(user_index_path):
-        return _bing_search(query)
+def perform_search(user_id, query, filters=None):
+    """
+    Performs semantic search with reranking and, for unfiltered searches,
+    Bing fallback. Answers are cached per user, normalized query and index
+    version, and for filtered searches per set of selected documents.
 
-    embeddings = LlamaServerEmbeddings()
-    faiss_index = FAISS.load_local(user_index_path, embeddings, allow_dangerous_deserialization=True)
-    
-    retriever = faiss_index.as_retriever(search_kwargs={"k": 10})
+    filters limits the search to the user's documents matching them, with
+    the keys doc_type, start_date, end_date, tags and source (see
+    knowledge_base.filtered_document_ids).
+    """
+    # Read the version first so an answer computed while the index changes
+    # is stored under the old version and never served afterwards.
+    version = index_manager.version(user_id)
+    # Resolved before the cache lookup: editing a document's tags or source
+    # changes which documents a filter selects but not the index version
+    doc_ids = _document_ids(user_id, filters)
+    results = result_cache.get(user_id, query, version, doc_ids)
+    if results is not None:
+        return results
+
+    results = _answer_query(user_id, query, doc_ids)
+    _cache_results(user_id, query, version, results, doc_ids)
+    return results
+
+def _cache_results(user_id, query, version, results, doc_ids=None):
+    # Empty answers mean the LLM or Bing call failed; don't cache those
+    if results and all(result["text"] for result in results):
+        result_cache.put(user_id, query, version, results, doc_ids)
+
+def _document_ids(user_id, filters):
+    """Ids of the documents a filtered search is limited to, or None for all of them."""
+    if not filters or not any(filters.values()):
+        return None
+    return filtered_document_ids(user_id, **filters)
+
+def _fallback(query, doc_ids):
+    """
+    Answer when the user's documents have nothing relevant: Bing results for
+    unfiltered searches. A filtered search is limited to the user's own
+    documents, so its query is never sent to Bing and it has no results.
+    """
+    if doc_ids is not None:
+        return []
+    return _bing_search(query)
+
+def _build_retriever(user_id, faiss_index, embeddings, doc_ids=None):
+    """
+    Hybrid retrieval: SEARCH_VECTOR_K vector and SEARCH_LEXICAL_K keyword
+    candidates are fused, and the best SEARCH_RERANK_CANDIDATES of them are
+    reranked down to the best 3. With doc_ids, both searches only consider
+    the chunks of those documents.
+    """
+    config = current_app.config
+    search_kwargs = {"k": config.get('SEARCH_VECTOR_K', 10)}
+    if doc_ids is not None:
+        search_kwargs["doc_ids"] = doc_ids
+    retriever = HybridRetriever(
+        user_id=user_id,
+        vector_retriever=faiss_index.as_retriever(search_kwargs=search_kwargs),
+        embeddings=embeddings,
+        lexical_k=config.get('SEARCH_LEXICAL_K', 10),
+        rrf_k=config.get('SEARCH_RRF_K', 60),
+        top_n=config.get('SEARCH_RERANK_CANDIDATES', 6),
+        doc_ids=doc_ids,
+    )
 
     compressor = CrossEncoderReranker(model=LlamaServerCrossEncoder(), top_n=3)
-    compression_retriever = ContextualCompressionRetriever(
+    return ContextualCompressionRetriever(
         base_compressor=compressor, base_retriever=retriever
     )
 
-    llm = LlamaServerLLM()
-
-    prompt_template = """Use the following pieces of context to answer the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer.
-
-    {context}
-
-    Question: {question}
-    Answer:"""
-    PROMPT = PromptTemplate(
-        template=prompt_template, input_variables=["context", "question"]
-    )
+def _answer_query(user_id, query, doc_ids=None):
+    # A filter that selects no documents leaves nothing to search
+    if doc_ids is not None and not doc_ids:
+        return []
+    embeddings = LlamaServerEmbeddings()
+    faiss_index = index_manager.get(user_id, embeddings)
+    if faiss_index is None:
+        return _fallback(query, doc_ids)
 
     qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
+        llm=LlamaServerLLM(),
         chain_type="stuff",
-        retriever=compression_retriever,
+        retriever=_build_retriever(user_id, faiss_index, embeddings, doc_ids),
         chain_type_kwargs={"prompt": PROMPT},
         return_source_documents=True,
     )
@@ -121,68 +151,68 @@ def perform_search(user_id, query):
     result = qa_chain.invoke({"query": query})
     
     if not result["source_documents"]:
-        return _bing_search(query)
+        return _fallback(query, doc_ids)
 
     return [{"text": result["result"], "source": [doc.metadata.get('source', 'Unknown') for doc in result["source_documents"]]}]
 
-import re
-from collections import Counter
-from ..models import Document
-from langchain_community.document_loaders import TextLoader, PyPDFLoader, UnstructuredExcelLoader
+def stream_search(user_id, query, filters=None):
+    """
+    Streaming variant of perform_search. Yields ("token", text) pairs as the
+    answer is generated, then a final ("sources", sources) pair. Results that
+    don't come from the LLM (cache hits, Bing fallback) are sent as a single
+    ("result", results) pair. If the LLM stream breaks off, an ("error", ...)
+    pair replaces the sources and the partial answer is not cached.
+    """
+    version = index_manager.version(user_id)
+    doc_ids = _document_ids(user_id, filters)
+    results = result_cache.get(user_id, query, version, doc_ids)
+    if results is not None:
+        yield "result", results
+        return
+
+    embeddings = LlamaServerEmbeddings()
+    documents = []
+    # A filter that selects no documents leaves nothing to search
+    if doc_ids is None or doc_ids:
+        faiss_index = index_manager.get(user_id, embeddings)
+        if faiss_index is not None:
+            documents = _build_retriever(user_id, faiss_index, embeddings, doc_ids).invoke(query)
+    if not documents:
+        results = _fallback(query, doc_ids)
+        _cache_results(user_id, query, version, results, doc_ids)
+        yield "result", results
+        return
+
+    # Same prompt the "stuff" chain builds in perform_search
+    prompt = PROMPT.format(
+        context="\n\n".join(doc.page_content for doc in documents),
+        question=query,
+    )
+    answer = []
+    try:
+        for token in LlamaServerLLM().stream(prompt):
+            answer.append(token)
+            yield "token", token
+    except LLMError as e:
+        print(e)
+        yield "error", {"msg": "The answer was cut off, please try again"}
+        return
+
+    sources = [doc.metadata.get('source', 'Unknown') for doc in documents]
+    _cache_results(user_id, query, version, [{"text": "".join(answer).strip(), "source": sources}], doc_ids)
+    yield "sources", sources
+
+from .knowledge_base import filtered_document_ids, load_document_pages
+from .term_stats import backfill_terms, top_terms
 
 # ... (rest of the file is the same until generate_keyword_report)
 
-def generate_keyword_report(user_id):
+def generate_keyword_report(user_id, doc_type=None, start_date=None, end_date=None):
     """
-    Generates a keyword report by calculating word frequencies across all
-    of the user's documents.
+    Reports the user's most frequent words, optionally limited to documents
+    of one type or uploaded within a date range. Word counts are kept up to
+    date as documents are added and deleted (see term_stats), so only
+    documents that predate them are read here.
     """
-    documents = Document.query.filter_by(user_id=user_id).all()
-    if not documents:
-        return {"top_keywords": []}
-
-    # A simple list of English stop words
-    stop_words = set([
-        "i", "me", "my", "myself", "we", "our", "ours", "ourselves", "you", "your", 
-        "yours", "yourself", "yourselves", "he", "him", "his", "himself", "she", 
-        "her", "hers", "herself", "it", "its", "itself", "they", "them", "their", 
-        "theirs", "themselves", "what", "which", "who", "whom", "this", "that", 
-        "these", "those", "am", "is", "are", "was", "were", "be", "been", "being", 
-        "have", "has", "had", "having", "do", "does", "did", "doing", "a", "an", 
-        "the", "and", "but", "if", "or", "because", "as", "until", "while", "of", 
-        "at", "by", "for", "with", "about", "against", "between", "into", "through", 
-        "during", "before", "after", "above", "below", "to", "from", "up", "down", 
-        "in", "out", "on", "off", "over", "under", "again", "further", "then", 
-        "once", "here", "there", "when", "where", "why", "how", "all", "any", 
-        "both", "each", "few", "more", "most", "other", "some", "such", "no", 
-        "nor", "not", "only", "own", "same", "so", "than", "too", "very", "s", 
-        "t", "can", "will", "just", "don", "should", "now"
-    ])
-
-    full_text = ""
-    for doc in documents:
-        try:
-            ext = doc.document_type
-            if ext == 'txt':
-                loader = TextLoader(doc.file_path)
-            elif ext == 'pdf':
-                loader = PyPDFLoader(doc.file_path)
-            elif ext in ['xlsx', 'xls']:
-                loader = UnstructuredExcelLoader(doc.file_path)
-            else:
-                continue
-            
-            doc_content = loader.load()
-            for page in doc_content:
-                full_text += page.page_content + " "
-        except Exception as e:
-            print(f"Error loading document for keyword report: {doc.file_path}, {e}")
-
-    # Clean and count words
-    words = re.findall(r'\b\w+\b', full_text.lower())
-    filtered_words = [word for word in words if word not in stop_words and not word.isdigit()]
-    word_counts = Counter(filtered_words)
-    
-    top_keywords = [word for word, count in word_counts.most_common(10)]
-    
-    return {"top_keywords": top_keywords}
\ No newline at end of file
+    backfill_terms(user_id, load_document_pages)
+    return {"top_keywords": top_terms(user_id, 10, doc_type, start_date, end_date)}
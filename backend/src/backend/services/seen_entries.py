@@ -0,0 +1,99 @@
+import hashlib
+import math
+import threading
+from flask import current_app
+from ..models import db, FeedEntry
+
+def entry_key(entry):
+    """Stable key of a feed entry: a hash of its GUID, or of its link if it has none."""
+    ident = entry.get('id') or entry.get('link') or entry.get('title', '')
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, sized for a capacity and false positive rate."""
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def _positions(self, item):
+        # Double hashing: k positions derived from two 64-bit halves of one digest
+        digest = hashlib.sha256(item.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+class SeenEntryIndex:
+    """
+    Remembers which feed entries have already been ingested.
+
+    FeedEntry rows are the persistent record. A Bloom filter built from them
+    on first use answers most lookups in memory: an entry missing from the
+    filter is definitely new, and only possible matches are confirmed
+    against the database, so a false positive never causes a new article to
+    be skipped.
+    """
+    def __init__(self):
+        self._filter = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('AGGREGATION_SEEN_FILTER_CAPACITY', 1000000)
+        app.config.setdefault('AGGREGATION_SEEN_FILTER_ERROR_RATE', 0.001)
+
+    def new_entries(self, feed_id, entries):
+        """Returns (key, entry) pairs for the entries of a feed not ingested yet."""
+        keyed = {}
+        for entry in entries:
+            keyed.setdefault(entry_key(entry), entry)
+
+        with self._lock:
+            bloom = self._bloom()
+            maybe_seen = [key for key in keyed if self._item(feed_id, key) in bloom]
+        if maybe_seen:
+            rows = db.session.query(FeedEntry.entry_key).filter(
+                FeedEntry.feed_id == feed_id,
+                FeedEntry.entry_key.in_(maybe_seen),
+            )
+            for (key,) in rows:
+                del keyed[key]
+        return list(keyed.items())
+
+    def mark_seen(self, feed_id, key):
+        db.session.add(FeedEntry(feed_id=feed_id, entry_key=key))
+        db.session.commit()
+        with self._lock:
+            self._bloom().add(self._item(feed_id, key))
+
+    def clear(self):
+        with self._lock:
+            self._filter = None
+
+    def _item(self, feed_id, key):
+        return f"{feed_id}:{key}"
+
+    def _bloom(self):
+        """Returns the filter, (re)building it from the database when missing or full."""
+        if self._filter is not None and self._filter.count <= self._filter.capacity:
+            return self._filter
+
+        config = current_app.config
+        total = FeedEntry.query.count()
+        capacity = max(config.get('AGGREGATION_SEEN_FILTER_CAPACITY', 1000000), 2 * total)
+        bloom = BloomFilter(capacity, config.get('AGGREGATION_SEEN_FILTER_ERROR_RATE', 0.001))
+        for feed_id, key in db.session.query(FeedEntry.feed_id, FeedEntry.entry_key).yield_per(10000):
+            bloom.add(self._item(feed_id, key))
+        self._filter = bloom
+        return bloom
+
+seen_entries = SeenEntryIndex()
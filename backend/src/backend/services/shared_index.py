@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import faiss
+from flask import current_app
+
+SHARD_PREFIX = 'shared_'
+
+# Vectors in a shard are stored under the id (user id << TENANT_SHIFT) |
+# position, so each tenant's vectors form one contiguous id range that an
+# IDSelectorRange picks out during the search.
+TENANT_SHIFT = 40
+POSITION_MASK = (1 << TENANT_SHIFT) - 1
+
+def enabled():
+    """Whether small users are stored in FAISS_SHARED_SHARDS shared shards."""
+    return current_app.config.get('FAISS_SHARED_SHARDS', 0) > 0
+
+def shard_name(user_id):
+    """Name of the shard directory holding the user's vectors in the shared layout."""
+    return f"{SHARD_PREFIX}{int(user_id) % current_app.config['FAISS_SHARED_SHARDS']:04d}"
+
+def is_shard(path):
+    return os.path.basename(os.path.normpath(path)).startswith(SHARD_PREFIX)
+
+def vector_ids(owners, positions):
+    """Ids of the vectors at the given positions, owned by the given user(s)."""
+    return (np.asarray(owners, dtype=np.int64) << TENANT_SHIFT) | np.asarray(positions, dtype=np.int64)
+
+def position(vector_id):
+    """Position of a vector in its index part; dedicated indexes use positions as ids."""
+    return int(vector_id) & POSITION_MASK
+
+def owners(index):
+    """
+    User ids of the vectors of a shard part, by position, or None for a part
+    of a dedicated index.
+    """
+    index = faiss.downcast_index(index)
+    if not hasattr(index, 'id_map'):
+        return None
+    return faiss.vector_to_array(index.id_map) >> TENANT_SHIFT
+
+def vectors(index, start, n):
+    """Reads n stored vectors back by position, whichever layout the part has."""
+    downcast = faiss.downcast_index(index)
+    if hasattr(downcast, 'id_map'):
+        # IndexIDMap2 reconstructs by id; its inner index by position
+        return downcast.index.reconstruct_n(start, n)
+    return index.reconstruct_n(start, n)
+
+def vectors_at(index, positions):
+    """Reads the stored vectors at the given positions."""
+    downcast = faiss.downcast_index(index)
+    if hasattr(downcast, 'id_map'):
+        index = downcast.index
+    return index.reconstruct_batch(np.asarray(positions, dtype=np.int64))
+
+def new_index(d, metric_type=faiss.METRIC_L2):
+    """An empty shard part: a flat index whose vectors carry their owner's id."""
+    return faiss.IndexIDMap2(faiss.IndexFlat(d, metric_type))
+
+def tenant_index(vectors, user_id, metric_type=faiss.METRIC_L2):
+    """A shard part holding vectors owned by one user."""
+    index = new_index(vectors.shape[1], metric_type)
+    index.add_with_ids(vectors, vector_ids(user_id, np.arange(len(vectors))))
+    return index
+
+def tenant_selector(user_id):
+    """Selects the vectors owned by the user."""
+    user_id = int(user_id)
+    return faiss.IDSelectorRange(user_id << TENANT_SHIFT, (user_id + 1) << TENANT_SHIFT)
@@ -0,0 +1,131 @@
+import re
+from collections import Counter
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert
+from ..models import db, Document, DocumentTerm, UserTerm
+
+# A simple list of English stop words
+STOP_WORDS = set([
+    "i", "me", "my", "myself", "we", "our", "ours", "ourselves", "you", "your",
+    "yours", "yourself", "yourselves", "he", "him", "his", "himself", "she",
+    "her", "hers", "herself", "it", "its", "itself", "they", "them", "their",
+    "theirs", "themselves", "what", "which", "who", "whom", "this", "that",
+    "these", "those", "am", "is", "are", "was", "were", "be", "been", "being",
+    "have", "has", "had", "having", "do", "does", "did", "doing", "a", "an",
+    "the", "and", "but", "if", "or", "because", "as", "until", "while", "of",
+    "at", "by", "for", "with", "about", "against", "between", "into", "through",
+    "during", "before", "after", "above", "below", "to", "from", "up", "down",
+    "in", "out", "on", "off", "over", "under", "again", "further", "then",
+    "once", "here", "there", "when", "where", "why", "how", "all", "any",
+    "both", "each", "few", "more", "most", "other", "some", "such", "no",
+    "nor", "not", "only", "own", "same", "so", "than", "too", "very", "s",
+    "t", "can", "will", "just", "don", "should", "now"
+])
+
+MAX_TERM_LENGTH = 64
+# Rows per INSERT, below SQLite's limit on bound parameters
+INSERT_BATCH = 300
+
+def count_terms(pages):
+    """Counts the words of a document's pages, without stop words and numbers."""
+    counts = Counter()
+    for page in pages:
+        counts.update(
+            word for word in re.findall(r'\b\w+\b', page.lower())
+            if word not in STOP_WORDS and not word.isdigit() and len(word) <= MAX_TERM_LENGTH
+        )
+    return counts
+
+def add_document_terms(doc, pages):
+    """
+    Stores the term counts of a new document and adds them to its user's
+    totals. The caller commits.
+    """
+    # Marks documents without any terms as counted too, see backfill_terms
+    doc.terms_counted = True
+    items = list(count_terms(pages).items())
+    for start in range(0, len(items), INSERT_BATCH):
+        batch = items[start:start + INSERT_BATCH]
+        db.session.execute(insert(DocumentTerm).values([
+            {"document_id": doc.id, "term": term, "count": count} for term, count in batch
+        ]))
+        statement = insert(UserTerm).values([
+            {"user_id": doc.user_id, "term": term, "count": count} for term, count in batch
+        ])
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[UserTerm.user_id, UserTerm.term],
+            set_={"count": UserTerm.count + statement.excluded.count},
+        ))
+
+def backfill_terms(user_id, load_pages):
+    """
+    Adds term counts for the user's documents whose terms were never
+    counted, such as documents ingested before term statistics were kept.
+    Documents with stored counts from before terms_counted existed are
+    skipped, so their terms are not counted twice.
+    """
+    missing = Document.query.filter(
+        Document.user_id == user_id,
+        Document.terms_counted.isnot(True),
+        ~db.session.query(DocumentTerm).filter(DocumentTerm.document_id == Document.id).exists(),
+    ).all()
+    for doc in missing:
+        try:
+            add_document_terms(doc, load_pages(doc))
+        except Exception as e:
+            print(f"Error loading document text: {doc.file_path}, {e}")
+    if missing:
+        db.session.commit()
+
+def remove_document_terms(user_id, doc_ids):
+    """
+    Subtracts the term counts of documents about to be deleted from their
+    user's totals and drops their stored counts. The caller commits.
+    """
+    if not doc_ids:
+        return
+    removed = db.session.query(DocumentTerm.term, func.sum(DocumentTerm.count).label('count')).filter(
+        DocumentTerm.document_id.in_(doc_ids)
+    ).group_by(DocumentTerm.term).subquery()
+    # One UPDATE for all terms, each decremented by its summed count
+    UserTerm.query.filter(UserTerm.user_id == user_id, UserTerm.term.in_(select(removed.c.term))).update(
+        {"count": UserTerm.count - select(removed.c.count).where(removed.c.term == UserTerm.term).scalar_subquery()},
+        synchronize_session=False,
+    )
+    UserTerm.query.filter(UserTerm.user_id == user_id, UserTerm.count <= 0).delete(synchronize_session=False)
+    DocumentTerm.query.filter(DocumentTerm.document_id.in_(doc_ids)).delete(synchronize_session=False)
+
+def top_terms(user_id, k=10, doc_type=None, start_date=None, end_date=None):
+    """
+    Returns the user's k most frequent terms. Without filters this reads the
+    user's running totals; with a document type or date range the stored
+    per-document counts of the matching documents are summed instead.
+    """
+    if not (doc_type or start_date or end_date):
+        rows = db.session.query(UserTerm.term).filter_by(user_id=user_id).order_by(
+            UserTerm.count.desc(), UserTerm.term
+        ).limit(k)
+        return [term for (term,) in rows]
+
+    total = func.sum(DocumentTerm.count)
+    query = db.session.query(DocumentTerm.term).join(Document, Document.id == DocumentTerm.document_id).filter(
+        Document.user_id == user_id
+    )
+    if doc_type:
+        query = query.filter(Document.document_type == doc_type)
+    if start_date:
+        query = query.filter(Document.uploaded_at >= start_date)
+    if end_date:
+        query = query.filter(Document.uploaded_at <= end_date)
+    rows = query.group_by(DocumentTerm.term).order_by(total.desc(), DocumentTerm.term).limit(k)
+    return [term for (term,) in rows]
+
+def document_top_terms(doc_ids, k=10):
+    """Returns the k most frequent terms across the given documents."""
+    if not doc_ids:
+        return []
+    total = func.sum(DocumentTerm.count)
+    rows = db.session.query(DocumentTerm.term).filter(DocumentTerm.document_id.in_(doc_ids)).group_by(
+        DocumentTerm.term
+    ).order_by(total.desc(), DocumentTerm.term).limit(k)
+    return [term for (term,) in rows]
@@ -1,21 +1,39 @@
 import pytest
 from src.backend.app import create_app
 from src.backend.models import db
+from src.backend.services.index_manager import index_manager
+from src.backend.services.embedding_cache import embedding_cache
+from src.backend.services.result_cache import result_cache
+from src.backend.services.seen_entries import seen_entries
+from src.backend.services.article_cache import article_cache
+from src.backend.services.ingest import ingest_queue
+from src.backend.services.clustering import cluster_cache
 
 @pytest.fixture(scope='function')
-def app():
+def app(tmp_path):
     """Create and configure a new app instance for each test."""
-    app = create_app()
-    app.config.update({
+    app = create_app({
         "TESTING": True,
-        "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
-        "JWT_SECRET_KEY": "test-secret-key"
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'app.db'}",
+        "JWT_SECRET_KEY": "test-secret-key",
+        "UPLOAD_FOLDER": str(tmp_path / "uploads"),
+        "FAISS_INDEX_PATH": str(tmp_path / "faiss_index"),
+        "EMBEDDING_CACHE_PATH": str(tmp_path / "embedding_cache.db"),
+        "ARTICLE_CACHE_PATH": str(tmp_path / "article_cache.db"),
+        "INGEST_EAGER": True
     })
 
     with app.app_context():
         db.create_all()
         yield app
+        ingest_queue.shutdown()
         db.drop_all()
+    index_manager.clear()
+    embedding_cache.close()
+    result_cache.clear()
+    seen_entries.clear()
+    article_cache.close()
+    cluster_cache.clear()
 
 @pytest.fixture(scope='function')
 def client(app):
@@ -1,9 +1,29 @@
 from unittest.mock import patch, MagicMock
 from io import BytesIO
-from src.backend.models import db, User, RssFeed
-from src.backend.services.aggregation import run_aggregation_for_all_users
+from src.backend.models import db, User, RssFeed, FeedEntry
+from src.backend.services.aggregation import _HostQueue, run_aggregation_for_all_users
+from src.backend.services.feed_schedule import next_interval
+import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import feedparser
 
+def _http_session(article_get, etag=None, modified=None):
+    """
+    Stands in for the shared HTTP session. Feed URLs (ending in .xml) get an
+    empty response, which the patched feedparser.parse fills in, and are
+    recorded on feed_get; article pages are passed to article_get.
+    """
+    headers = {name: value for name, value in (('ETag', etag), ('Last-Modified', modified)) if value}
+    session = MagicMock()
+    session.feed_get = MagicMock(return_value=MagicMock(status_code=200, content=b'<rss/>', headers=headers))
+    session.article_get = article_get
+    session.get.side_effect = lambda url, **kwargs: (
+        session.feed_get if url.endswith('.xml') else session.article_get
+    )(url, **kwargs)
+    return session
+
 def test_run_aggregation_for_all_users_fetches_full_article(app):
     """
     Tests that the RSS aggregation service attempts to fetch the full article
@@ -47,26 +67,37 @@ def test_run_aggregation_for_all_users_fetches_full_article(app):
     """
     mock_response = MagicMock()
     mock_response.content = mock_html.encode('utf-8')
+    mock_response.status_code = 200
+    mock_response.headers = {}
     mock_response.raise_for_status.return_value = None
 
     with patch('src.backend.services.aggregation.feedparser.parse', return_value=parsed_feed) as mock_parse, \
-         patch('src.backend.services.aggregation.requests.get', return_value=mock_response) as mock_get, \
-         patch('src.backend.services.aggregation.add_document') as mock_add_document:
-        
+         patch('src.backend.services.aggregation.get_session', return_value=_http_session(MagicMock(return_value=mock_response))) as mock_session, \
+         patch('src.backend.services.aggregation.add_shared_document') as mock_add_document:
+        mock_get = mock_session.return_value.article_get
+
         with app.app_context():
             run_aggregation_for_all_users()
 
-        # Assert
-        assert mock_get.call_count == len(parsed_feed.entries)
-        first_get_call_args = mock_get.call_args_list[0][0]
-        assert first_get_call_args[0] == parsed_feed.entries[0].link
+        # The feed is downloaded through the shared session and parsed from its bytes
+        assert mock_parse.call_args[0][0] == b'<rss/>'
+
+        # Assert: articles are fetched concurrently, so the order may vary,
+        # and a link shared by several entries is downloaded once
+        assert mock_get.call_count == len({entry.link for entry in parsed_feed.entries})
+        requested_urls = {call[0][0] for call in mock_get.call_args_list}
+        assert requested_urls == {entry.link for entry in parsed_feed.entries}
 
         first_entry = parsed_feed.entries[0]
         # This is the text we expect to be parsed from the mock HTML
         expected_text = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat.\nDuis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.\nCurabitur pretium tincidunt lacus. Nulla gravida orci a odio. Nullam varius, turpis et commodo pharetra, est eros bibendum elit, nec luctus magna felis sollicitudin mauris. Integer in mauris eu nibh euismod gravida.\nDuis ac tellus et risus vulputate vehicula. Donec lobortis risus a elit. Etiam tempor. Ut ullamcorper, ligula eu tempor congue, eros est euismod turpis, id tincidunt sapien risus a quam. Maecenas fermentum consequat mi. Donec fermentum."
         
-        first_call_args, _ = mock_add_document.call_args_list[0]
-        assert first_call_args[0] == user_id
+        assert mock_add_document.call_count == len(parsed_feed.entries)
+        first_call_args = next(
+            args for args, _ in mock_add_document.call_args_list
+            if args[1].filename.startswith("Former England rugby captain")
+        )
+        assert first_call_args[0] == [user_id]
         
         file_obj = first_call_args[1]
         file_content = file_obj.stream.read().decode('utf-8')
@@ -74,3 +105,233 @@ def test_run_aggregation_for_all_users_fetches_full_article(app):
         # Check that the parsed text is present in the final content
         assert expected_text in file_content
         assert first_entry.title in file_content
+
+def test_run_aggregation_limits_concurrent_requests_per_host(app):
+    """Articles are downloaded in parallel without exceeding the per-host limit."""
+    import threading
+    import time
+
+    with open('tests/testdata/rss.xml', 'rb') as f:
+        parsed_feed = feedparser.parse(f.read())
+
+    app.config.update({"AGGREGATION_MAX_WORKERS": 8, "AGGREGATION_PER_HOST_LIMIT": 2})
+    with app.app_context():
+        user = User(username='testuser')
+        user.set_password('password')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(RssFeed(user_id=user.id, url='http://example.com/rss.xml'))
+        db.session.commit()
+
+    lock = threading.Lock()
+    active = {}
+    peak = {}
+
+    def slow_get(url, headers, timeout):
+        host = url.split('/')[2]
+        with lock:
+            active[host] = active.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), active[host])
+        time.sleep(0.01)
+        with lock:
+            active[host] -= 1
+        raise ConnectionError("offline")
+
+    with patch('src.backend.services.aggregation.feedparser.parse', return_value=parsed_feed), \
+         patch('src.backend.services.aggregation.get_session', return_value=_http_session(MagicMock(side_effect=slow_get))), \
+         patch('src.backend.services.aggregation.add_shared_document') as mock_add_document:
+        with app.app_context():
+            run_aggregation_for_all_users()
+
+    assert mock_add_document.call_count == len(parsed_feed.entries)
+    assert max(peak.values()) == 2
+
+def test_run_aggregation_skips_entries_already_ingested(app):
+    """A second run neither downloads nor ingests entries added by the first one."""
+    with open('tests/testdata/rss.xml', 'rb') as f:
+        parsed_feed = feedparser.parse(f.read())
+    total = len(parsed_feed.entries)
+
+    with app.app_context():
+        user = User(username='testuser')
+        user.set_password('password')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(RssFeed(user_id=user.id, url='http://example.com/rss.xml'))
+        db.session.commit()
+
+    failing_title = parsed_feed.entries[0].title
+
+    def add_document(user_id, file_obj):
+        if file_obj.stream.read().decode('utf-8').startswith(failing_title):
+            raise RuntimeError("embedding failed")
+        return MagicMock()
+
+    with patch('src.backend.services.aggregation.feedparser.parse', return_value=parsed_feed), \
+         patch('src.backend.services.aggregation.get_session', return_value=_http_session(MagicMock(side_effect=ConnectionError("offline")))) as mock_session, \
+         patch('src.backend.services.aggregation.add_shared_document', side_effect=add_document) as mock_add_document:
+        mock_get = mock_session.return_value.article_get
+        with app.app_context():
+            run = run_aggregation_for_all_users()
+            assert (run.new_count, run.skipped_count, run.failed_count) == (total - 1, 0, 1)
+            assert FeedEntry.query.count() == total - 1
+
+            mock_get.reset_mock()
+            mock_add_document.reset_mock()
+            run = run_aggregation_for_all_users()
+
+        # Only the entry that failed is fetched and ingested again
+        assert (run.new_count, run.skipped_count, run.failed_count) == (0, total - 1, 1)
+        assert [call[0][0] for call in mock_get.call_args_list] == [parsed_feed.entries[0].link]
+        assert mock_add_document.call_count == 1
+
+def test_run_aggregation_uses_conditional_requests(app):
+    """Feeds answering 304 are skipped and stale cached article pages are revalidated."""
+    with open('tests/testdata/rss.xml', 'rb') as f:
+        parsed_feed = feedparser.parse(f.read())
+    links = {entry.link for entry in parsed_feed.entries}
+
+    with app.app_context():
+        user = User(username='testuser')
+        user.set_password('password')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(RssFeed(user_id=user.id, url='http://example.com/rss.xml'))
+        db.session.commit()
+
+    page = MagicMock(status_code=200, content=b"<p>" + b"Full article text. " * 50 + b"</p>", headers={'ETag': '"page-v1"'})
+
+    with patch('src.backend.services.aggregation.feedparser.parse', return_value=parsed_feed) as mock_parse, \
+         patch('src.backend.services.aggregation.get_session', return_value=_http_session(MagicMock(return_value=page), '"feed-v1"', 'Mon, 01 Sep 2025 10:00:00 GMT')) as mock_session, \
+         patch('src.backend.services.aggregation.add_shared_document', side_effect=RuntimeError("embedding failed")) as mock_add_document, \
+         app.app_context():
+        mock_get = mock_session.return_value.article_get
+        run_aggregation_for_all_users()
+        assert mock_get.call_count == len(links)
+        # Entries failed, so the feed keeps no validators and is fetched in full again
+        assert RssFeed.query.one().etag is None
+
+        app.config['ARTICLE_CACHE_TTL'] = 0
+        mock_get.reset_mock()
+        mock_get.return_value = MagicMock(status_code=304)
+        mock_add_document.side_effect = None
+        run = run_aggregation_for_all_users()
+        assert run.new_count == len(parsed_feed.entries)
+        assert mock_get.call_count == len(links)
+        assert {call.kwargs['headers']['If-None-Match'] for call in mock_get.call_args_list} == {'"page-v1"'}
+        # The stale pages were revalidated, so their cached text was used
+        assert "Full article text" in mock_add_document.call_args[0][1].stream.read().decode('utf-8')
+
+        feed = RssFeed.query.one()
+        assert (feed.etag, feed.last_modified) == ('"feed-v1"', 'Mon, 01 Sep 2025 10:00:00 GMT')
+
+        mock_get.reset_mock()
+        mock_add_document.reset_mock()
+        mock_parse.reset_mock()
+        mock_session.return_value.feed_get.return_value = MagicMock(status_code=304)
+        run_aggregation_for_all_users()
+        assert mock_session.return_value.feed_get.call_args.kwargs == {
+            'headers': {'If-None-Match': '"feed-v1"', 'If-Modified-Since': 'Mon, 01 Sep 2025 10:00:00 GMT'},
+            'timeout': 10,
+        }
+        assert mock_parse.call_count == 0
+        assert mock_get.call_count == 0
+        assert mock_add_document.call_count == 0
+
+def test_run_aggregation_fetches_shared_feeds_once(app):
+    """A feed subscribed by several users is fetched, scraped and ingested once for all of them."""
+    with open('tests/testdata/rss.xml', 'rb') as f:
+        parsed_feed = feedparser.parse(f.read())
+    total = len(parsed_feed.entries)
+
+    with app.app_context():
+        users = [User(username=f'user{i}') for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [user.id for user in users]
+        db.session.add_all([
+            RssFeed(user_id=user_ids[0], url='http://example.com/rss.xml'),
+            RssFeed(user_id=user_ids[1], url='HTTP://Example.com:80/rss.xml/'),
+            RssFeed(user_id=user_ids[2], url='http://example.com/other.xml'),
+        ])
+        db.session.commit()
+
+    with patch('src.backend.services.aggregation.feedparser.parse', return_value=parsed_feed) as mock_parse, \
+         patch('src.backend.services.aggregation.get_session', return_value=_http_session(MagicMock(side_effect=ConnectionError("offline")))) as mock_session, \
+         patch('src.backend.services.aggregation.add_shared_document') as mock_add_document:
+        with app.app_context():
+            run = run_aggregation_for_all_users()
+
+    mock_get = mock_session.return_value.article_get
+    assert mock_session.return_value.feed_get.call_count == 2
+    # Both feed URLs list the same articles, but each page is requested once
+    assert mock_get.call_count == len({entry.link for entry in parsed_feed.entries})
+    assert sorted(call[0][0] for call in mock_add_document.call_args_list) == sorted(
+        [[user_ids[0], user_ids[1]]] * total + [[user_ids[2]]] * total
+    )
+    assert run.new_count == 3 * total
+
+def test_next_interval_follows_feed_activity(app):
+    """Active feeds are polled about twice per publishing gap; quiet ones back off."""
+    hourly = [{'published_parsed': time.gmtime(1700000000 + hour * 3600)} for hour in range(5)]
+    with app.app_context():
+        assert next_interval(21600, 'fetched', hourly, new_entries=2) == 1800
+        assert next_interval(21600, 'not_modified') == 32400
+        assert next_interval(21600, 'fetched', hourly, new_entries=0) == 32400
+        assert next_interval(21600, 'failed') == 21600
+        # Learned intervals stay within the configured bounds
+        assert next_interval(80000, 'not_modified') == app.config['FEED_POLL_MAX_INTERVAL']
+        minutely = [{'updated_parsed': time.gmtime(1700000000 + minute * 60)} for minute in range(5)]
+        assert next_interval(None, 'fetched', minutely, new_entries=5) == app.config['FEED_POLL_MIN_INTERVAL']
+
+def test_scheduled_run_polls_only_due_feeds(app):
+    """The scheduler polls due feeds, reschedules them and spreads unscheduled ones."""
+    with open('tests/testdata/rss.xml', 'rb') as f:
+        parsed_feed = feedparser.parse(f.read())
+
+    now = datetime.datetime.utcnow()
+    with app.app_context():
+        user = User(username='testuser')
+        user.set_password('password')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add_all([
+            RssFeed(user_id=user.id, url='http://example.com/due.xml', next_poll_at=now - datetime.timedelta(minutes=1)),
+            RssFeed(user_id=user.id, url='http://example.com/later.xml', next_poll_at=now + datetime.timedelta(hours=1)),
+            RssFeed(user_id=user.id, url='http://example.com/legacy.xml'),
+        ])
+        db.session.commit()
+        # Rows created before polling was scheduled have no next poll time
+        RssFeed.query.filter_by(url='http://example.com/legacy.xml').update({'next_poll_at': None})
+        db.session.commit()
+
+    with patch('src.backend.services.aggregation.feedparser.parse', return_value=parsed_feed) as mock_parse, \
+         patch('src.backend.services.aggregation.get_session', return_value=_http_session(MagicMock(side_effect=ConnectionError("offline")))) as mock_session, \
+         patch('src.backend.services.aggregation.add_shared_document'), \
+         patch('src.backend.services.feed_schedule.random.random', return_value=0.5), \
+         app.app_context():
+        run = run_aggregation_for_all_users(due_only=True)
+
+        assert [call[0][0] for call in mock_session.return_value.feed_get.call_args_list] == ['http://example.com/due.xml']
+        assert run.new_count == len(parsed_feed.entries)
+        feeds = {feed.url: feed for feed in RssFeed.query.all()}
+        assert feeds['http://example.com/due.xml'].poll_interval >= app.config['FEED_POLL_MIN_INTERVAL']
+        assert feeds['http://example.com/due.xml'].next_poll_at > now
+        legacy_delay = feeds['http://example.com/legacy.xml'].next_poll_at - now
+        assert datetime.timedelta(hours=2) < legacy_delay < datetime.timedelta(hours=4)
+
+        # Nothing else is due yet
+        mock_session.return_value.feed_get.reset_mock()
+        assert run_aggregation_for_all_users(due_only=True) is None
+        assert mock_session.return_value.feed_get.call_count == 0
+
+def test_host_queue_keeps_pool_threads_for_other_hosts():
+    """Requests waiting for a busy host do not hold the pool threads other hosts need."""
+    release = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        hosts = _HostQueue(pool, 1)
+        slow = [hosts.submit(f'http://slow.example.com/{i}', release.wait, 5) for i in range(3)]
+        assert hosts.submit('http://fast.example.com/', lambda: 'done').result(timeout=5) == 'done'
+        assert not any(future.done() for future in slow)
+        release.set()
+        assert [future.result(timeout=5) for future in slow] == [True, True, True]
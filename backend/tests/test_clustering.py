@@ -1,4 +1,4 @@
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 import io
 
 def test_get_clustering_report_no_documents(client, auth_token):
@@ -24,10 +24,10 @@ def test_get_clustering_report_with_document(client, auth_token):
         data = {
             'file': (io.BytesIO(content), f'keywords_{i}.txt')
         }
-        with patch('src.backend.services.knowledge_base.FAISS'):
+        with patch('src.backend.services.knowledge_base.index_manager'):
             with patch('src.backend.services.knowledge_base.LlamaServerEmbeddings'):
                 rv = client.post('/documents', headers=headers, content_type='multipart/form-data', data=data)
-        assert rv.status_code == 201
+        assert rv.status_code == 202
 
     # Now, generate the report
     rv = client.get('/report/clustering', headers=headers)
@@ -35,3 +35,61 @@ def test_get_clustering_report_with_document(client, auth_token):
     report = rv.get_json()
     assert 'clusters' in report
     assert len(report['clusters']) > 0
+
+def _add_embedded_documents(user, vectors_by_name):
+    """Creates documents with term counts and one indexed chunk each."""
+    from langchain_core.documents import Document as Chunk
+    from src.backend.models import db, Document
+    from src.backend.services.index_manager import index_manager
+    from src.backend.services.term_stats import add_document_terms
+
+    chunks, vectors = [], []
+    for name, (text, vector) in vectors_by_name.items():
+        doc = Document(user_id=user.id, file_path=name, document_type='txt', source=name, tags="")
+        db.session.add(doc)
+        db.session.flush()
+        add_document_terms(doc, [text])
+        chunks.append(Chunk(page_content=text, metadata={'doc_id': doc.id}))
+        vectors.append(vector)
+    db.session.commit()
+    index_manager.append(user.id, chunks, MagicMock(), vectors)
+
+def test_clustering_report_uses_stored_embeddings(app, auth_token):
+    """Documents are clustered on their indexed vectors and new ones are assigned incrementally."""
+    from src.backend.models import User
+    from src.backend.services.clustering import cluster_cache, generate_cluster_report
+
+    user = User.query.filter_by(username='testuser').first()
+    _add_embedded_documents(user, {
+        'fruit1.txt': ("apple banana", [1.0, 0.0, 0.0]),
+        'fruit2.txt': ("apple cherry", [0.99, 0.1, 0.0]),
+        'fruit3.txt': ("apple grape", [0.98, 0.0, 0.1]),
+        'code1.txt': ("python code", [0.0, 1.0, 0.0]),
+        'code2.txt': ("python java", [0.1, 0.99, 0.0]),
+        'code3.txt': ("python rust", [0.0, 0.98, 0.1]),
+    })
+
+    with patch('src.backend.services.clustering.LlamaServerEmbeddings'):
+        report = generate_cluster_report(user.id, n_clusters=2)
+        clusters = sorted(report['clusters'], key=lambda cluster: cluster['top_terms'])
+        assert [cluster['top_terms'][0] for cluster in clusters] == ['apple', 'python']
+        assert [cluster['size'] for cluster in clusters] == [3, 3]
+        assert sorted(clusters[0]['documents']) == ['fruit1.txt', 'fruit2.txt', 'fruit3.txt']
+
+        # An unchanged index reuses the report without reading any vectors
+        with patch('src.backend.services.clustering._document_vectors') as mock_vectors:
+            assert generate_cluster_report(user.id, n_clusters=2) == report
+        assert mock_vectors.call_count == 0
+
+        # A close new document joins a cluster without refitting the model
+        model = cluster_cache.get(user.id).model
+        _add_embedded_documents(user, {'fruit4.txt': ("apple kiwi", [0.97, 0.05, 0.0])})
+        report = generate_cluster_report(user.id, n_clusters=2)
+        assert cluster_cache.get(user.id).model is model
+        fruit = next(cluster for cluster in report['clusters'] if cluster['top_terms'][0] == 'apple')
+        assert fruit['size'] == 4
+
+        # A distant one counts as drift and triggers a refit
+        _add_embedded_documents(user, {'space.txt': ("rocket", [0.0, 0.0, 1.0])})
+        generate_cluster_report(user.id, n_clusters=2)
+        assert cluster_cache.get(user.id).model is not model
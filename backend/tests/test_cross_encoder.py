@@ -0,0 +1,42 @@
+from unittest.mock import patch, MagicMock
+from src.backend.services.custom_cross_encoder import LlamaServerCrossEncoder
+
+def _rerank_response(scores):
+    """Builds a /rerank response, sorted by relevance like llama-server does."""
+    response = MagicMock()
+    response.raise_for_status.return_value = None
+    results = [{"index": i, "relevance_score": score} for i, score in enumerate(scores)]
+    results.sort(key=lambda r: r["relevance_score"], reverse=True)
+    response.json.return_value = {"results": results}
+    return response
+
+def test_score_sends_one_request_per_query(app):
+    """All candidates for a query are scored in one request and mapped back by index."""
+    pairs = [["query", f"document {i}"] for i in range(10)]
+    scores = [0.1 * i for i in range(10)][::-1]
+
+    with app.app_context(), \
+         patch('src.backend.services.custom_cross_encoder.get_session') as mock_session:
+        mock_session.return_value.post.return_value = _rerank_response(scores)
+        result = LlamaServerCrossEncoder().score(pairs)
+
+    assert result == scores
+    assert mock_session.return_value.post.call_count == 1
+    payload = mock_session.return_value.post.call_args.kwargs['json']
+    assert payload['documents'] == [f"document {i}" for i in range(10)]
+
+def test_score_splits_large_candidate_sets(app):
+    """Candidate sets larger than RERANK_BATCH_SIZE are split into several requests."""
+    app.config['RERANK_BATCH_SIZE'] = 4
+    pairs = [["query", f"document {i}"] for i in range(10)]
+
+    def post(url, json):
+        return _rerank_response([float(doc.split()[1]) for doc in json['documents']])
+
+    with app.app_context(), \
+         patch('src.backend.services.custom_cross_encoder.get_session') as mock_session:
+        mock_session.return_value.post.side_effect = post
+        result = LlamaServerCrossEncoder().score(pairs)
+
+    assert result == [float(i) for i in range(10)]
+    assert mock_session.return_value.post.call_count == 3
@@ -1,5 +1,9 @@
 import io
+import os
 from unittest.mock import patch
+from werkzeug.datastructures import FileStorage
+from src.backend.models import db, User, Document
+from src.backend.services.knowledge_base import add_shared_document, delete_document
 
 def test_get_documents_empty(client, auth_token):
     """Test getting documents when none have been uploaded."""
@@ -15,13 +19,18 @@ def test_document_upload_and_delete(client, auth_token):
     data = {
         'file': (io.BytesIO(b"this is a test file for testing uploads"), 'test_upload.txt')
     }
-    with patch('src.backend.services.knowledge_base.FAISS'):
+    with patch('src.backend.services.knowledge_base.index_manager'):
         with patch('src.backend.services.knowledge_base.LlamaServerEmbeddings'):
             rv = client.post('/documents', headers=headers, content_type='multipart/form-data', data=data)
     
-    assert rv.status_code == 201
+    assert rv.status_code == 202
     assert 'File uploaded successfully' in rv.get_json()['msg']
 
+    # Ingestion runs inline in the tests (INGEST_EAGER), so the job is done
+    rv = client.get(f"/documents/jobs/{rv.get_json()['job_id']}", headers=headers)
+    assert rv.status_code == 200
+    assert rv.get_json()['status'] == 'done'
+
     # 2. Test getting documents after upload
     rv = client.get('/documents', headers=headers)
     assert rv.status_code == 200
@@ -67,3 +76,226 @@ def test_upload_invalid_filename(client, auth_token):
     rv = client.post('/documents', headers=headers, content_type='multipart/form-data', data=data)
     assert rv.status_code == 400
     assert 'File type not supported' in rv.get_json()['msg']
+
+def test_add_shared_document_embeds_once(app):
+    """A document shared by several users is embedded once and indexed for each of them."""
+    with app.app_context():
+        users = [User(username=f'user{i}') for i in range(2)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [user.id for user in users]
+        file = FileStorage(stream=io.BytesIO(b"shared article text"), filename='shared_article.txt')
+
+        with patch('src.backend.services.knowledge_base.index_manager') as mock_index_manager, \
+             patch('src.backend.services.knowledge_base.LlamaServerEmbeddings') as mock_embeddings:
+            mock_embeddings.return_value.embed_documents.return_value = [[0.1, 0.2]]
+            added = add_shared_document(user_ids, file)
+
+            assert mock_embeddings.return_value.embed_documents.call_count == 1
+            assert mock_index_manager.append.call_count == 2
+            for user_id, call in zip(user_ids, mock_index_manager.append.call_args_list):
+                assert call.args[0] == user_id
+                assert call.args[3] == [[0.1, 0.2]]
+            assert {doc.user_id for doc in added.values()} == set(user_ids)
+            assert Document.query.count() == 2
+
+            # Both documents share the stored file; it is removed with the last one
+            file_path = added[user_ids[0]].file_path
+            assert delete_document(user_ids[0], added[user_ids[0]].id)
+            assert os.path.exists(file_path)
+            assert delete_document(user_ids[1], added[user_ids[1]].id)
+            assert not os.path.exists(file_path)
+
+def test_uploads_with_the_same_name_are_stored_apart(app):
+    """Queued uploads never overwrite each other's files, and a queued job keeps its file."""
+    from src.backend.models import IngestJob
+    from src.backend.services.knowledge_base import store_upload, remove_upload
+
+    first = store_upload(FileStorage(stream=io.BytesIO(b"first user's report"), filename='report.txt'))
+    second = store_upload(FileStorage(stream=io.BytesIO(b"second user's report"), filename='report.txt'))
+    try:
+        assert first[0] == second[0] == 'report.txt'
+        assert first[1] != second[1]
+        with open(first[1], 'rb') as f:
+            assert f.read() == b"first user's report"
+
+        db.session.add(IngestJob(user_id=1, filename='report.txt', file_path=first[1], document_type='txt'))
+        db.session.commit()
+        remove_upload(first[1])
+        assert os.path.exists(first[1])
+        IngestJob.query.update({'status': 'failed'})
+        db.session.commit()
+        remove_upload(first[1])
+        assert not os.path.exists(first[1])
+    finally:
+        for _, file_path, _ in (first, second):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+def test_upload_is_processed_by_worker_pool(app, client, auth_token):
+    """Uploads return a job immediately; a worker reports each stage until the job is done."""
+    import threading
+    from src.backend.services.ingest import ingest_queue
+
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    app.config['INGEST_EAGER'] = False
+    release = threading.Event()
+
+    def embed_documents(texts):
+        release.wait(5)
+        return [[0.0]] * len(texts)
+
+    with patch('src.backend.services.knowledge_base.index_manager'), \
+         patch('src.backend.services.knowledge_base.LlamaServerEmbeddings') as mock_embeddings:
+        mock_embeddings.return_value.embed_documents.side_effect = embed_documents
+        data = {'file': (io.BytesIO(b"background upload"), 'background.txt')}
+        rv = client.post('/documents', headers=headers, content_type='multipart/form-data', data=data)
+        assert rv.status_code == 202
+        job_id = rv.get_json()['job_id']
+
+        # The embedding step is blocked, so the job is still in progress
+        rv = client.get(f'/documents/jobs/{job_id}', headers=headers)
+        assert rv.get_json()['status'] in ('queued', 'running')
+
+        release.set()
+        ingest_queue.shutdown()
+
+    rv = client.get(f'/documents/jobs/{job_id}', headers=headers)
+    job = rv.get_json()
+    assert (job['status'], job['stage'], job['error']) == ('done', 'index', None)
+    assert job['document_id'] == client.get('/documents', headers=headers).get_json()[0]['id']
+
+def test_queued_and_stale_jobs_are_picked_up_without_an_upload(app):
+    """Polling runs jobs left queued or abandoned by a stopped process."""
+    import datetime
+    import time
+    from src.backend.models import IngestJob
+    from src.backend.services.ingest import ingest_queue
+    from src.backend.services.knowledge_base import store_upload
+
+    app.config['INGEST_EAGER'] = False
+    user = User(username='testuser')
+    db.session.add(user)
+    db.session.commit()
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['INGEST_JOB_TIMEOUT'] + 1)
+    for name, status, updated_at in (('queued.txt', 'queued', None), ('abandoned.txt', 'running', stale)):
+        _, file_path, _ = store_upload(FileStorage(stream=io.BytesIO(b"left behind"), filename=name))
+        db.session.add(IngestJob(user_id=user.id, filename=name, file_path=file_path, document_type='txt',
+                                 status=status, updated_at=updated_at or datetime.datetime.utcnow()))
+    db.session.commit()
+
+    with patch('src.backend.services.knowledge_base.index_manager'), \
+         patch('src.backend.services.knowledge_base.LlamaServerEmbeddings') as mock_embeddings:
+        mock_embeddings.return_value.embed_documents.return_value = [[0.0]]
+        ingest_queue.start(app)
+        deadline = time.time() + 5
+        while IngestJob.query.filter_by(status='done').count() < 2 and time.time() < deadline:
+            db.session.expire_all()
+            time.sleep(0.01)
+        ingest_queue.shutdown()
+
+    db.session.expire_all()
+    assert [job.status for job in IngestJob.query.order_by(IngestJob.id)] == ['done', 'done']
+    assert Document.query.count() == 2
+
+def test_failed_ingest_job_reports_error(client, auth_token):
+    """A job that cannot be embedded is marked failed with a readable error."""
+    from src.backend.services.custom_embeddings import EmbeddingError
+
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    with patch('src.backend.services.knowledge_base.index_manager'), \
+         patch('src.backend.services.knowledge_base.LlamaServerEmbeddings') as mock_embeddings:
+        mock_embeddings.return_value.embed_documents.side_effect = EmbeddingError("server down")
+        data = {'file': (io.BytesIO(b"this will fail"), 'failing.txt')}
+        rv = client.post('/documents', headers=headers, content_type='multipart/form-data', data=data)
+
+    job = client.get(f"/documents/jobs/{rv.get_json()['job_id']}", headers=headers).get_json()
+    assert (job['status'], job['stage']) == ('failed', 'embed')
+    assert 'Embedding service unavailable' in job['error']
+    assert client.get('/documents', headers=headers).get_json() == []
+    assert client.get('/documents/jobs/9999', headers=headers).status_code == 404
+
+def test_bulk_upload_archive(client, auth_token):
+    """An archive is embedded in one pass and indexed with a single write."""
+    import tarfile
+    import zipfile
+
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('news/first.txt', "first bulk document")
+        zf.writestr('news/second.txt', "second bulk document")
+        zf.writestr('news/image.png', b"not a document")
+    archive.seek(0)
+
+    tar_archive = io.BytesIO()
+    with tarfile.open(fileobj=tar_archive, mode='w:gz') as tf:
+        content = b"third bulk document"
+        info = tarfile.TarInfo('third.txt')
+        info.size = len(content)
+        tf.addfile(info, io.BytesIO(content))
+    tar_archive.seek(0)
+
+    data = {'files': [(archive, 'import.zip'), (tar_archive, 'more.tar.gz'), (io.BytesIO(b"loose file"), 'loose.txt')]}
+    with patch('src.backend.services.knowledge_base.index_manager') as mock_index_manager, \
+         patch('src.backend.services.knowledge_base.LlamaServerEmbeddings') as mock_embeddings, \
+         patch('src.backend.services.knowledge_base.send_notification') as mock_notify:
+        mock_embeddings.return_value.embed_documents.side_effect = lambda texts: [[0.0]] * len(texts)
+        rv = client.post('/documents/bulk', headers=headers, content_type='multipart/form-data', data=data)
+
+    assert rv.status_code == 202
+    report = {entry['filename']: entry for entry in rv.get_json()['files']}
+    assert set(report) == {'news/first.txt', 'news/second.txt', 'news/image.png', 'third.txt', 'loose.txt'}
+    assert report['news/image.png']['error'] == 'File type not supported'
+    jobs = [client.get(f"/documents/jobs/{entry['job_id']}", headers=headers).get_json()
+            for name, entry in report.items() if name != 'news/image.png']
+    assert [job['status'] for job in jobs] == ['done'] * 4
+
+    # The files fit in one batch (INGEST_BATCH_SIZE)
+    assert mock_embeddings.return_value.embed_documents.call_count == 1
+    assert mock_index_manager.append.call_count == 1
+    chunks = mock_index_manager.append.call_args.args[1]
+    assert {chunk.metadata['doc_id'] for chunk in chunks} == {job['document_id'] for job in jobs}
+    assert mock_notify.call_count == 1
+
+    docs = client.get('/documents', headers=headers).get_json()
+    assert sorted(doc['source'] for doc in docs) == ['loose.txt', 'news_first.txt', 'news_second.txt', 'third.txt']
+
+def test_bulk_upload_batches_fail_independently(app, client, auth_token):
+    """Bulk uploads are ingested in bounded batches; a failing batch does not undo the others."""
+    from src.backend.services.custom_embeddings import EmbeddingError
+
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    app.config['INGEST_BATCH_SIZE'] = 2
+
+    def embed_documents(texts):
+        if any('unlucky' in text for text in texts):
+            raise EmbeddingError("server down")
+        return [[0.0]] * len(texts)
+
+    names = ['one.txt', 'two.txt', 'unlucky.txt', 'four.txt', 'five.txt']
+    data = {'files': [(io.BytesIO(f"{name} contents".encode()), name) for name in names]}
+    with patch('src.backend.services.knowledge_base.index_manager') as mock_index_manager, \
+         patch('src.backend.services.knowledge_base.LlamaServerEmbeddings') as mock_embeddings, \
+         patch('src.backend.services.knowledge_base.send_notification') as mock_notify:
+        mock_embeddings.return_value.embed_documents.side_effect = embed_documents
+        rv = client.post('/documents/bulk', headers=headers, content_type='multipart/form-data', data=data)
+
+    assert rv.status_code == 202
+    statuses = [client.get(f"/documents/jobs/{entry['job_id']}", headers=headers).get_json()['status']
+                for entry in rv.get_json()['files']]
+    assert statuses == ['done', 'done', 'failed', 'failed', 'done']
+    assert mock_embeddings.return_value.embed_documents.call_count == 3
+    assert mock_index_manager.append.call_count == 2
+    docs = client.get('/documents', headers=headers).get_json()
+    assert sorted(doc['source'] for doc in docs) == ['five.txt', 'one.txt', 'two.txt']
+    # One notification for the whole upload, sent after its last batch
+    assert mock_notify.call_count == 1
+    assert mock_notify.call_args.kwargs['message_body'] == "3 of 5 uploaded documents have been successfully added."
+
+def test_bulk_upload_rejects_invalid_archive(client, auth_token):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    data = {'files': [(io.BytesIO(b"not really a zip"), 'broken.zip')]}
+    rv = client.post('/documents/bulk', headers=headers, content_type='multipart/form-data', data=data)
+    assert rv.status_code == 400
+    assert rv.get_json()['msg'] == 'Invalid archive'
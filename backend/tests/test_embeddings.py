@@ -0,0 +1,118 @@
+import pytest
+import requests
+from unittest.mock import patch, MagicMock
+from src.backend.services.custom_embeddings import LlamaServerEmbeddings, EmbeddingError
+from src.backend.services.embedding_cache import EmbeddingCache, embedding_cache
+
+def _embedding_response(texts):
+    response = MagicMock()
+    response.raise_for_status.return_value = None
+    data = [{"index": i, "embedding": [float(len(text))]} for i, text in enumerate(texts)]
+    response.json.return_value = {"data": data[::-1]}
+    return response
+
+def test_embed_documents_batches_by_count_and_tokens(app):
+    """Texts are split by both the batch size and the token budget, in order."""
+    app.config.update({"EMBEDDING_BATCH_SIZE": 3, "EMBEDDING_BATCH_TOKENS": 100})
+    texts = [f"a{i:09d}" for i in range(7)] + ["b" * 290, "c" * 10]
+
+    with app.app_context(), \
+         patch('src.backend.services.custom_embeddings.get_session') as mock_session:
+        mock_session.return_value.post.side_effect = lambda url, json, timeout: _embedding_response(json['input'])
+        vectors = LlamaServerEmbeddings().embed_documents(texts)
+
+    assert vectors == [[float(len(text))] for text in texts]
+    batch_sizes = sorted(len(call.kwargs['json']['input']) for call in mock_session.return_value.post.call_args_list)
+    assert batch_sizes == [1, 1, 1, 3, 3]
+
+@patch('src.backend.services.custom_embeddings.time.sleep')
+def test_embed_documents_retries_only_failed_batch(mock_sleep, app):
+    """A failed batch is retried on its own; the other batches are sent once."""
+    app.config.update({"EMBEDDING_BATCH_SIZE": 2, "EMBEDDING_MAX_WORKERS": 1})
+    texts = ["one", "two", "three", "four"]
+    failures = [requests.exceptions.ConnectionError("connection reset")]
+
+    def post(url, json, timeout):
+        if json['input'] == ["three", "four"] and failures:
+            raise failures.pop()
+        return _embedding_response(json['input'])
+
+    with app.app_context(), \
+         patch('src.backend.services.custom_embeddings.get_session') as mock_session:
+        mock_session.return_value.post.side_effect = post
+        vectors = LlamaServerEmbeddings().embed_documents(texts)
+
+    assert vectors == [[3.0], [3.0], [5.0], [4.0]]
+    assert mock_session.return_value.post.call_count == 3
+    assert mock_sleep.call_count == 1
+
+@patch('src.backend.services.custom_embeddings.time.sleep')
+def test_embed_documents_waits_out_busy_server(mock_sleep, app):
+    """429 answers are retried after the server's Retry-After; other 4xx are not."""
+    def status_response(status, headers=None):
+        response = MagicMock(status_code=status, headers=headers or {})
+        response.raise_for_status.side_effect = requests.exceptions.HTTPError(f"{status}", response=response)
+        return response
+
+    with app.app_context(), \
+         patch('src.backend.services.custom_embeddings.get_session') as mock_session:
+        mock_session.return_value.post.side_effect = [
+            status_response(429, {'Retry-After': '7'}),
+            status_response(429),
+            _embedding_response(["busy"]),
+        ]
+        assert LlamaServerEmbeddings().embed_documents(["busy"]) == [[4.0]]
+        assert [call.args[0] for call in mock_sleep.call_args_list] == [7, 1.0]
+
+        mock_session.return_value.post.side_effect = [status_response(400)]
+        with pytest.raises(EmbeddingError):
+            LlamaServerEmbeddings().embed_documents(["rejected"])
+
+@patch('src.backend.services.custom_embeddings.time.sleep')
+def test_embed_documents_raises_when_retries_exhausted(mock_sleep, app):
+    """Persistent failures raise instead of returning empty vectors."""
+    app.config.update({"EMBEDDING_MAX_RETRIES": 2})
+
+    with app.app_context(), \
+         patch('src.backend.services.custom_embeddings.get_session') as mock_session:
+        mock_session.return_value.post.side_effect = requests.exceptions.Timeout("timed out")
+        with pytest.raises(EmbeddingError):
+            LlamaServerEmbeddings().embed_documents(["some text"])
+
+    assert mock_session.return_value.post.call_count == 3
+
+def test_embed_documents_uses_cache(app):
+    """Cached and repeated texts are not sent to the embedding server again."""
+    with app.app_context(), \
+         patch('src.backend.services.custom_embeddings.get_session') as mock_session:
+        mock_session.return_value.post.side_effect = lambda url, json, timeout: _embedding_response(json['input'])
+        embeddings = LlamaServerEmbeddings()
+
+        assert embeddings.embed_documents(["alpha", "beta", "alpha"]) == [[5.0], [4.0], [5.0]]
+        assert mock_session.return_value.post.call_args.kwargs['json']['input'] == ["alpha", "beta"]
+
+        assert embeddings.embed_documents(["beta", "gamma"]) == [[4.0], [5.0]]
+        assert mock_session.return_value.post.call_args.kwargs['json']['input'] == ["gamma"]
+        assert mock_session.return_value.post.call_count == 2
+
+        stats = embedding_cache.stats(app.config['EMBEDDING_MODEL'])
+        assert (stats['entries'], stats['hits'], stats['misses']) == (3, 1, 4)
+
+        # Switching models invalidates every cached vector
+        app.config['EMBEDDING_MODEL'] = 'another-model'
+        embeddings.embed_documents(["beta"])
+        assert mock_session.return_value.post.call_count == 3
+        assert embedding_cache.stats('another-model')['entries'] == 1
+
+def test_embedding_cache_counts_entries_of_every_process(app):
+    """The entry count lives in the cache database, shared by every process."""
+    with app.app_context():
+        app.config['EMBEDDING_CACHE_MAX_ENTRIES'] = 3
+        model = app.config['EMBEDDING_MODEL']
+        embedding_cache.put_many(model, ["a", "b"], [[1.0], [2.0]])
+        # A second cache instance stands in for another worker process
+        other = EmbeddingCache()
+        other.put_many(model, ["b", "c", "d"], [[2.0], [3.0], [4.0]])
+        other.close()
+        assert embedding_cache.stats(model)['entries'] == 3
+        assert embedding_cache.get_many(model, ["a", "d"]) == [None, [4.0]]
@@ -0,0 +1,355 @@
+import os
+from unittest.mock import patch
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS
+from src.backend.services.index_manager import index_manager
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic embeddings so real FAISS indexes can be built offline."""
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [float(len(text)), float(sum(map(ord, text)) % 97), 1.0]
+
+def test_index_manager_caches_loaded_index(app):
+    """The index is loaded from disk once and reloaded only when it changes."""
+    embeddings = FakeEmbeddings()
+    with app.app_context():
+        assert index_manager.get(1, embeddings) is None
+
+        FAISS.from_texts(["first text"], embeddings).save_local(index_manager.index_path(1))
+        with patch.object(index_manager, '_load', wraps=index_manager._load) as mock_load:
+            first = index_manager.get(1, embeddings)
+            assert index_manager.get(1, embeddings) is first
+            assert mock_load.call_count == 1
+
+            # Another process rewrites the index on disk
+            FAISS.from_texts(["first text", "second text"], embeddings).save_local(index_manager.index_path(1))
+            second = index_manager.get(1, embeddings)
+            assert mock_load.call_count == 2
+            assert second is not first
+            assert second.ntotal == 2
+
+def test_index_manager_append_writes_delta_segments(app):
+    """Appends add segments without rewriting the base, and searches see every segment."""
+    embeddings = FakeEmbeddings()
+    with app.app_context():
+        FAISS.from_texts(["base text"], embeddings).save_local(index_manager.index_path(1))
+        cached = index_manager.get(1, embeddings)
+        base_file = os.path.join(index_manager.index_path(1), 'index.faiss')
+        base_mtime = os.stat(base_file).st_mtime_ns
+
+        index_manager.append(1, [Document(page_content="appended text")], embeddings)
+        index_manager.append(1, [Document(page_content="another appended text")], embeddings)
+
+        assert os.stat(base_file).st_mtime_ns == base_mtime
+        assert index_manager.segment_count(1) == 2
+        assert cached.ntotal == 1
+        index = index_manager.get(1, embeddings)
+        assert index.ntotal == 3
+        results = index.similarity_search("appended text", k=3)
+        assert {doc.page_content for doc in results} == {"base text", "appended text", "another appended text"}
+        assert results[0].page_content == "appended text"
+
+def test_index_manager_compacts_segments_into_base(app):
+    """Compaction folds the segments into the base index and removes them."""
+    embeddings = FakeEmbeddings()
+    with app.app_context():
+        for text in ("one", "two", "three"):
+            index_manager.append(1, [Document(page_content=text)], embeddings)
+        index_manager.append(2, [Document(page_content="four")], embeddings)
+
+        assert index_manager.compact_all(embeddings, threshold=2) == {'1': {"segments": 3, "removed": 0}}
+        assert index_manager.segment_count(1) == 0
+        assert index_manager.segment_count(2) == 1
+
+        index_manager.clear()
+        index = index_manager.get(1, embeddings)
+        assert len(index.segments) == 1
+        assert index.ntotal == 3
+
+def test_index_manager_deletes_documents(app):
+    """Deleted documents are filtered from searches and dropped on compaction."""
+    embeddings = FakeEmbeddings()
+    with app.app_context():
+        for doc_id, text in enumerate(("alpha", "beta", "gamma", "delta"), start=1):
+            chunks = [Document(page_content=f"{text} {n}", metadata={"doc_id": doc_id}) for n in range(2)]
+            index_manager.append(1, chunks, embeddings)
+        index_manager.compact(1, embeddings)
+
+        index_manager.delete_documents(1, [1, 2], embeddings)
+        index = index_manager.get(1, embeddings)
+        assert index.dead_count == 4
+        results = index.similarity_search("alpha 0", k=4)
+        assert len(results) == 4
+        assert {doc.metadata["doc_id"] for doc in results} == {3, 4}
+
+        # Half the vectors are dead, which exceeds the default ratio
+        assert index_manager.compact_all(embeddings) == {'1': {"segments": 0, "removed": 4}}
+        index_manager.clear()
+        index = index_manager.get(1, embeddings)
+        assert index.ntotal == 4
+        assert not index.deleted
+
+def test_index_manager_evicts_least_recently_used(app):
+    """Entries beyond the memory budget are evicted in LRU order."""
+    embeddings = FakeEmbeddings()
+    with app.app_context():
+        for user_id in (1, 2, 3):
+            FAISS.from_texts([f"text for user {user_id}"], embeddings).save_local(index_manager.index_path(user_id))
+
+        first = index_manager.get(1, embeddings)
+        app.config['FAISS_INDEX_CACHE_BYTES'] = index_manager._total_bytes * 2
+        index_manager.get(2, embeddings)
+        index_manager.get(1, embeddings)
+        index_manager.get(3, embeddings)
+
+        paths = list(index_manager._entries)
+        assert paths == [index_manager.index_path(1), index_manager.index_path(3)]
+        assert index_manager.get(1, embeddings) is first
+
+def test_index_manager_lexical_search(app):
+    """Keyword search follows appends and deletes, and is built for indexes that predate it."""
+    embeddings = FakeEmbeddings()
+    with app.app_context():
+        # An index written before keyword search existed
+        FAISS.from_texts(["NVDA shares rallied"], embeddings, metadatas=[{"doc_id": 1}]).save_local(index_manager.index_path(1))
+        index_manager.append(1, [Document(page_content="Markets closed flat", metadata={"doc_id": 2})], embeddings)
+
+        results = index_manager.lexical_search(1, "nvda rally", 5, embeddings)
+        assert [doc.page_content for doc in results] == ["NVDA shares rallied"]
+        assert results[0].metadata["doc_id"] == 1
+
+        index_manager.append(1, [Document(page_content="NVDA earnings beat", metadata={"doc_id": 3})], embeddings)
+        results = index_manager.lexical_search(1, "NVDA earnings", 5, embeddings)
+        assert [doc.page_content for doc in results] == ["NVDA earnings beat", "NVDA shares rallied"]
+
+        index_manager.delete_documents(1, [3], embeddings)
+        results = index_manager.lexical_search(1, "NVDA earnings", 5, embeddings)
+        assert [doc.page_content for doc in results] == ["NVDA shares rallied"]
+        assert index_manager.lexical_search(1, "?!", 5, embeddings) == []
+        assert index_manager.lexical_search(2, "NVDA", 5, embeddings) == []
+
+def test_index_manager_picks_index_type_by_size(app):
+    """Compaction migrates a growing index to HNSW, then IVF, after checking recall."""
+    import faiss
+    import numpy as np
+    embeddings = FakeEmbeddings()
+    rng = np.random.default_rng(1)
+
+    appended = []
+
+    def append(count):
+        chunks = [Document(page_content=f"chunk {n}", metadata={"doc_id": n}) for n in range(count)]
+        vectors = rng.random((count, 16), dtype='float32')
+        appended.extend(zip(range(count), vectors))
+        index_manager.append(1, chunks, embeddings, vectors.tolist())
+
+    app.config.update({"FAISS_HNSW_MIN_VECTORS": 100, "FAISS_IVF_MIN_VECTORS": 2000, "FAISS_EF_SEARCH": 128})
+    with app.app_context():
+        append(50)
+        assert index_manager.compact_all(embeddings) == {}
+        append(100)
+        # Below the segment threshold, but the size calls for HNSW
+        assert index_manager.compact_all(embeddings) == {'1': {"segments": 2, "removed": 0}}
+        index_manager.clear()
+        base = index_manager.get(1, embeddings).segments[0].index
+        assert isinstance(faiss.downcast_index(base), faiss.IndexHNSWFlat)
+        assert faiss.downcast_index(base).hnsw.efSearch == 128
+
+        # Same type: the segment is added to a copy of the HNSW base
+        append(10)
+        index_manager.compact(1, embeddings)
+        index = index_manager.get(1, embeddings)
+        assert index.ntotal == 160
+        assert isinstance(faiss.downcast_index(index.segments[0].index), faiss.IndexHNSWFlat)
+        assert len(index.similarity_search_with_score_by_vector([0.5] * 16, k=5)) == 5
+
+        # An IVF index that misses the recall target is not used
+        app.config["FAISS_MIN_RECALL"] = 1.01
+        append(2000)
+        index_manager.compact(1, embeddings)
+        index = index_manager.get(1, embeddings)
+        assert isinstance(index.segments[0].index, faiss.IndexFlat)
+        assert index.ntotal == 2160
+
+        app.config["FAISS_MIN_RECALL"] = 0.5
+        index_manager.delete_documents(1, [0], embeddings)
+        index_manager.compact(1, embeddings)
+        index = index_manager.get(1, embeddings)
+        assert faiss.try_extract_index_ivf(index.segments[0].index).nprobe == 16
+        assert index.ntotal == 2160 - 4
+
+        # The SQ8 base keeps the original vectors, so appending to it and
+        # rebuilding it never quantizes them twice
+        vectors = rng.random((10, 16), dtype='float32')
+        appended.extend(zip(range(5000, 5010), vectors))
+        chunks = [Document(page_content=f"chunk {n}", metadata={"doc_id": n}) for n in range(5000, 5010)]
+        index_manager.append(1, chunks, embeddings, vectors.tolist())
+        index_manager.compact(1, embeddings)
+        index_manager.delete_documents(1, [1], embeddings)
+        index_manager.compact(1, embeddings)
+        index_manager.clear()
+        index = index_manager.get(1, embeddings)
+        base_path = os.path.realpath(os.path.join(index_manager.index_path(1), 'base'))
+        assert os.path.exists(os.path.join(base_path, 'vectors.npy'))
+        assert faiss.try_extract_index_ivf(index.segments[0].index) is not None
+        live = [(doc_id, vector) for doc_id, vector in appended if doc_id not in (0, 1)]
+        assert index.ntotal == len(live)
+        expected = {doc_id: np.mean([v for d, v in live if d == doc_id], axis=0) for doc_id, _ in live}
+        assert all(np.allclose(vector, expected[doc_id], atol=1e-6) for doc_id, vector in index.document_vectors().items())
+
+def test_index_manager_publishes_memory_mapped_base_versions(app):
+    """Compaction publishes each base as a new version that readers map read-only."""
+    embeddings = FakeEmbeddings()
+    with app.app_context():
+        path = index_manager.index_path(1)
+        FAISS.from_texts(["legacy text"], embeddings).save_local(path)
+        index_manager.append(1, [Document(page_content="second text")], embeddings)
+        index_manager.compact(1, embeddings)
+
+        link = os.path.join(path, 'base')
+        first_version = os.readlink(link)
+        assert not os.path.exists(os.path.join(path, 'index.faiss'))
+        index_manager.clear()
+        index = index_manager.get(1, embeddings)
+        assert index.ntotal == 2
+        if os.path.exists('/proc/self/maps'):
+            with open('/proc/self/maps') as f:
+                assert os.path.join(path, first_version, 'index.faiss') in f.read()
+
+        index_manager.append(1, [Document(page_content="third text")], embeddings)
+        index_manager.compact(1, embeddings)
+        assert os.readlink(link) != first_version
+        assert [name for name in os.listdir(path) if name.startswith('base.')] == [os.readlink(link)]
+        # A reader still holding the previous version keeps working
+        assert len(index.similarity_search("second text", k=2)) == 2
+        assert index_manager.get(1, embeddings).ntotal == 3
+
+def test_index_manager_reads_only_hits_from_chunk_store(app):
+    """Chunks live in SQLite chunk stores and searches read just their hits."""
+    from src.backend.services.chunk_store import ChunkStore
+    embeddings = FakeEmbeddings()
+    with app.app_context():
+        path = index_manager.index_path(1)
+        texts = [f"text number {n}" for n in range(50)]
+        FAISS.from_texts(texts[:25], embeddings, metadatas=[{"doc_id": n} for n in range(25)]).save_local(path)
+        index_manager.append(1, [Document(page_content=text, metadata={"doc_id": n}) for n, text in enumerate(texts[25:], 25)], embeddings)
+        segment_path = os.path.join(path, 'segments', '00000001')
+        assert sorted(os.listdir(segment_path)) == ['chunks.db', 'index.faiss']
+
+        with patch.object(ChunkStore, 'get_many', autospec=True, side_effect=ChunkStore.get_many) as mock_get:
+            results = index_manager.get(1, embeddings).similarity_search("text number 30", k=3)
+        hit = next(doc for doc in results if doc.page_content == "text number 30")
+        assert hit.metadata == {"doc_id": 30}
+        assert [len(call.args[1]) for call in mock_get.call_args_list] == [3]
+
+        # Compaction moves the pickled chunks of the old base to a chunk store
+        index_manager.compact(1, embeddings)
+        base_path = os.path.join(path, os.readlink(os.path.join(path, 'base')))
+        assert sorted(os.listdir(base_path)) == ['chunks.db', 'index.faiss']
+        index_manager.clear()
+        index = index_manager.get(1, embeddings)
+        assert index.ntotal == 50
+        assert {doc.page_content for doc in index.similarity_search("text number 3", k=50)} == set(texts)
+
+def test_index_manager_shared_layout(app):
+    """Small users share sharded indexes, searched per user, and move out and back by size."""
+    embeddings = FakeEmbeddings()
+    app.config.update({"FAISS_SHARED_SHARDS": 2, "FAISS_SHARED_MAX_VECTORS": 4})
+    with app.app_context():
+        # Users 1 and 3 land in the same shard
+        index_manager.append(1, [Document(page_content=f"user one text {n}", metadata={"doc_id": n}) for n in (1, 2)], embeddings)
+        index_manager.append(3, [Document(page_content="user three text", metadata={"doc_id": 3})], embeddings)
+        shard_path = index_manager.shard_path(1)
+        assert shard_path == index_manager.shard_path(3)
+        assert index_manager.segment_count(1) == 2
+        assert os.listdir(index_manager.index_path(1)) == ['lexical.db']
+
+        results = index_manager.get(1, embeddings).similarity_search("user three text", k=10)
+        assert {doc.page_content for doc in results} == {"user one text 1", "user one text 2"}
+        assert [doc.page_content for doc in index_manager.get(3, embeddings).similarity_search("text", k=10)] == ["user three text"]
+        assert [doc.page_content for doc in index_manager.lexical_search(3, "three", 5, embeddings)] == ["user three text"]
+        assert index_manager.get(5, embeddings) is None
+
+        index_manager.delete_documents(1, [2], embeddings)
+        assert [doc.page_content for doc in index_manager.get(1, embeddings).similarity_search("text", k=10)] == ["user one text 1"]
+
+        # User 3 grows past FAISS_SHARED_MAX_VECTORS and gets their own index
+        index_manager.append(3, [Document(page_content=f"more text {n}", metadata={"doc_id": n}) for n in (4, 5, 6)], embeddings)
+        compacted = index_manager.compact_all(embeddings, threshold=2)
+        assert compacted[os.path.basename(shard_path)]["removed"] == 5
+        assert index_manager.get(3, embeddings).tenant is None
+        assert index_manager.get(3, embeddings).ntotal == 4
+        assert index_manager.get(1, embeddings).ntotal == 1
+        assert {doc.metadata["doc_id"] for doc in index_manager.get(3, embeddings).similarity_search("text", k=10)} == {3, 4, 5, 6}
+
+        # ...and moves back once it shrinks below half of it
+        index_manager.delete_documents(3, [4, 5, 6], embeddings)
+        index_manager.compact_all(embeddings)
+        assert sorted(os.listdir(index_manager.index_path(3))) == ['.write.lock', 'lexical.db']
+        index = index_manager.get(3, embeddings)
+        assert index.tenant == 3
+        assert [doc.page_content for doc in index.similarity_search("text", k=10)] == ["user three text"]
+        assert [doc.page_content for doc in index_manager.get(1, embeddings).similarity_search("text", k=10)] == ["user one text 1"]
+
+def test_index_manager_searches_selected_documents(app):
+    """Searches limited to some documents only score those documents' chunks."""
+    embeddings = FakeEmbeddings()
+    texts = [f"text number {n}" for n in range(40)]
+    with app.app_context():
+        for user_id in (1, 2):
+            index_manager.append(user_id, [Document(page_content=text, metadata={"doc_id": user_id * 100 + n}) for n, text in enumerate(texts[:20])], embeddings)
+            index_manager.append(user_id, [Document(page_content=text, metadata={"doc_id": user_id * 100 + n}) for n, text in enumerate(texts[20:], 20)], embeddings)
+        selected = [107, 125, 133]
+        index = index_manager.get(1, embeddings)
+
+        # Exactly scored selections, and selections searched through a faiss selector
+        for exact_max in (4096, 0):
+            app.config["FAISS_PREFILTER_EXACT_MAX"] = exact_max
+            results = index.similarity_search("text number 25", k=10, doc_ids=selected)
+            assert results[0].metadata["doc_id"] == 125
+            assert sorted(doc.metadata["doc_id"] for doc in results) == selected
+            assert index.similarity_search("text", k=10, doc_ids=[]) == []
+
+        assert [doc.metadata["doc_id"] for doc in index_manager.lexical_search(1, "text number", 10, embeddings, [133])] == [133]
+
+        # Selections work on tenants of a shared shard too
+        app.config.update({"FAISS_SHARED_SHARDS": 1, "FAISS_SHARED_MAX_VECTORS": 1000})
+        index_manager.compact_all(embeddings)
+        index = index_manager.get(2, embeddings)
+        assert index.tenant == 2
+        for exact_max in (4096, 0):
+            app.config["FAISS_PREFILTER_EXACT_MAX"] = exact_max
+            results = index.similarity_search("text number 25", k=5, doc_ids=[207, 225])
+            assert [doc.metadata["doc_id"] for doc in results][0] == 225
+            assert sorted(doc.metadata["doc_id"] for doc in results) == [207, 225]
+
+def test_index_manager_write_lock_excludes_other_processes(app):
+    """Index writes hold an flock that writers in other processes wait for."""
+    import fcntl
+    embeddings = FakeEmbeddings()
+    with app.app_context():
+        path = index_manager.index_path(1)
+        with index_manager.write_lock(path):
+            # A separate open file stands in for another process
+            with open(os.path.join(path, '.write.lock')) as other:
+                try:
+                    fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    assert False, "the write lock was not held"
+                except BlockingIOError:
+                    pass
+        with open(os.path.join(path, '.write.lock')) as other:
+            fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        # A writer that died mid-append leaves a temporary segment behind,
+        # which neither blocks appends nor survives compaction
+        os.makedirs(os.path.join(path, 'segments', '.00000001.dead.tmp'))
+        index_manager.append(1, [Document(page_content="first text", metadata={"doc_id": 1})], embeddings)
+        index_manager.append(1, [Document(page_content="second text", metadata={"doc_id": 2})], embeddings)
+        assert index_manager.segment_count(1) == 2
+        index_manager.compact(1, embeddings)
+        assert os.listdir(os.path.join(path, 'segments')) == []
+        assert index_manager.get(1, embeddings).ntotal == 2
@@ -0,0 +1,59 @@
+import json
+from unittest.mock import patch, MagicMock
+import pytest
+import requests
+from src.backend.services.custom_llm import LlamaServerLLM, LLMError, ThinkFilter, parse_llm_output
+
+def _feed_all(pieces):
+    think_filter = ThinkFilter()
+    return "".join(think_filter.feed(piece) for piece in pieces) + think_filter.finish()
+
+def test_think_filter_matches_parse_llm_output():
+    """Streaming removal of the think block gives the same text as parse_llm_output."""
+    output = "<think>\nLet me think about this.\n</think>\n\nThe answer is <b>42</b>."
+    for size in (1, 2, 3, 7, len(output)):
+        pieces = [output[i:i + size] for i in range(0, len(output), size)]
+        assert _feed_all(pieces) == parse_llm_output(output)
+
+def test_think_filter_emits_text_before_stream_ends():
+    """Text after the think block is released as soon as it arrives."""
+    think_filter = ThinkFilter()
+    assert think_filter.feed("<thi") == ""
+    assert think_filter.feed("nk>reasoning</th") == ""
+    assert think_filter.feed("ink>Hello") == "Hello"
+    assert think_filter.feed(" <") == " "
+    assert think_filter.feed("b>world") == "<b>world"
+
+def test_stream_yields_deltas_without_think_block(app):
+    """llama-server stream deltas are passed through with the think block removed."""
+    deltas = ["<think>", "hmm", "</think>", "\n\nStreamed", " answer"]
+    lines = [f"data: {json.dumps({'choices': [{'delta': {'content': d}}]})}" for d in deltas]
+    lines += ["", "data: [DONE]"]
+    response = MagicMock()
+    response.iter_lines.return_value = iter(lines)
+
+    with app.app_context(), \
+         patch('src.backend.services.custom_llm.get_session') as mock_session:
+        mock_session.return_value.post.return_value = response
+        tokens = list(LlamaServerLLM().stream("prompt"))
+
+    assert tokens == ["Streamed", " answer"]
+    assert mock_session.return_value.post.call_args.kwargs['json']['stream'] is True
+
+def test_stream_raises_when_cut_off(app):
+    """A stream that breaks off mid-answer raises instead of ending quietly."""
+    def lines():
+        yield f"data: {json.dumps({'choices': [{'delta': {'content': 'Partial'}}]})}"
+        raise requests.exceptions.ChunkedEncodingError("connection broken")
+    response = MagicMock()
+    response.iter_lines.return_value = lines()
+
+    with app.app_context(), \
+         patch('src.backend.services.custom_llm.get_session') as mock_session:
+        mock_session.return_value.post.return_value = response
+        tokens = []
+        with pytest.raises(LLMError):
+            for token in LlamaServerLLM().stream("prompt"):
+                tokens.append(token)
+
+    assert tokens == ["Partial"]
@@ -17,10 +17,10 @@ def test_get_keyword_report_with_document(client, auth_token):
     data = {
         'file': (io.BytesIO(file_content), 'keywords.txt')
     }
-    with patch('src.backend.services.knowledge_base.FAISS'):
+    with patch('src.backend.services.knowledge_base.index_manager'):
         with patch('src.backend.services.knowledge_base.LlamaServerEmbeddings'):
             rv = client.post('/documents', headers=headers, content_type='multipart/form-data', data=data)
-    assert rv.status_code == 201
+    assert rv.status_code == 202
 
     # Now, generate the report
     rv = client.get('/report/keywords', headers=headers)
@@ -31,3 +31,84 @@ def test_get_keyword_report_with_document(client, auth_token):
     assert 'apple' in report['top_keywords']
     assert 'banana' in report['top_keywords']
     assert 'orange' in report['top_keywords']
+
+def test_keyword_report_reads_extracted_text(app, client, auth_token):
+    """Reports use the text saved at ingest time and never re-parse the file."""
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    data = {'file': (io.BytesIO(b"kiwi kiwi mango"), 'stored.txt')}
+    with patch('src.backend.services.knowledge_base.index_manager'), \
+         patch('src.backend.services.knowledge_base.LlamaServerEmbeddings'):
+        client.post('/documents', headers=headers, content_type='multipart/form-data', data=data)
+
+    with patch('src.backend.services.knowledge_base.LOADERS', {}):
+        rv = client.get('/report/keywords', headers=headers)
+    assert rv.get_json()['top_keywords'] == ['kiwi', 'mango']
+
+def test_keyword_report_falls_back_to_original_file(app, client, auth_token, tmp_path):
+    """Documents without saved text are parsed once and their text is saved."""
+    from src.backend.models import db, Document, User
+
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    file_path = tmp_path / "legacy.txt"
+    file_path.write_text("papaya papaya lime")
+    user = User.query.filter_by(username='testuser').first()
+    db.session.add(Document(user_id=user.id, file_path=str(file_path), document_type='txt', source='legacy.txt', tags=""))
+    db.session.commit()
+
+    rv = client.get('/report/keywords', headers=headers)
+    assert rv.get_json()['top_keywords'] == ['papaya', 'lime']
+
+    doc = Document.query.filter_by(source='legacy.txt').one()
+    assert doc.text is not None
+    file_path.unlink()
+    rv = client.get('/report/keywords', headers=headers)
+    assert rv.get_json()['top_keywords'] == ['papaya', 'lime']
+
+def test_keyword_report_filters_and_deletes(app, client, auth_token):
+    """Keyword counts follow the type and date filters and drop deleted documents."""
+    from src.backend.models import db, Document, UserTerm
+
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    with patch('src.backend.services.knowledge_base.index_manager'), \
+         patch('src.backend.services.knowledge_base.LlamaServerEmbeddings'):
+        for name, content in [('a.txt', b"cherry cherry grape"), ('b.txt', b"grape grape grape melon")]:
+            client.post('/documents', headers=headers, content_type='multipart/form-data',
+                        data={'file': (io.BytesIO(content), name)})
+
+        rv = client.get('/report/keywords', headers=headers)
+        assert rv.get_json()['top_keywords'] == ['grape', 'cherry', 'melon']
+        assert client.get('/report/keywords?type=pdf', headers=headers).get_json() == {"top_keywords": []}
+        assert client.get('/report/keywords?end_date=2000-01-01', headers=headers).get_json() == {"top_keywords": []}
+        assert client.get('/report/keywords?start_date=bad', headers=headers).status_code == 400
+
+        doc = Document.query.filter_by(source='b.txt').one()
+        db.session.query(Document).filter_by(id=doc.id).update({'document_type': 'pdf'})
+        db.session.commit()
+        rv = client.get('/report/keywords?type=txt', headers=headers)
+        assert rv.get_json()['top_keywords'] == ['cherry', 'grape']
+
+        rv = client.delete(f'/documents/{doc.id}', headers=headers)
+        assert rv.status_code == 200
+
+    rv = client.get('/report/keywords', headers=headers)
+    assert rv.get_json()['top_keywords'] == ['cherry', 'grape']
+    counts = {term.term: term.count for term in UserTerm.query.all()}
+    assert counts == {'cherry': 2, 'grape': 1}
+
+def test_documents_without_terms_are_backfilled_once(app, client, auth_token, tmp_path):
+    """A legacy document with no countable terms is parsed once, not on every report."""
+    from src.backend.models import db, Document, User
+    from src.backend.services import term_stats
+
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    file_path = tmp_path / "numbers.txt"
+    file_path.write_text("2024 the 42")
+    user = User.query.filter_by(username='testuser').first()
+    db.session.add(Document(user_id=user.id, file_path=str(file_path), document_type='txt', source='numbers.txt', tags=""))
+    db.session.commit()
+
+    with patch.object(term_stats, 'add_document_terms', wraps=term_stats.add_document_terms) as mock_add:
+        assert client.get('/report/keywords', headers=headers).get_json() == {"top_keywords": []}
+        assert client.get('/report/keywords', headers=headers).get_json() == {"top_keywords": []}
+    assert mock_add.call_count == 1
+    assert Document.query.filter_by(source='numbers.txt').one().terms_counted
@@ -0,0 +1,62 @@
+import datetime
+from unittest.mock import patch
+from src.backend.models import db, SchedulerLease
+from src.backend.services.scheduler import acquire_lease, release_lease, run_scheduler
+
+def test_lease_has_one_holder_until_it_expires(app):
+    """A second owner is refused until the lease expires or is released."""
+    with app.app_context():
+        assert acquire_lease('aggregation', 'host-a:1', 60)
+        assert not acquire_lease('aggregation', 'host-b:1', 60)
+        # The holder renews it
+        assert acquire_lease('aggregation', 'host-a:1', 60)
+
+        # A holder that stopped renewing loses it
+        SchedulerLease.query.filter_by(name='aggregation').update(
+            {'expires_at': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)}
+        )
+        db.session.commit()
+        assert acquire_lease('aggregation', 'host-b:1', 60)
+        assert not acquire_lease('aggregation', 'host-a:1', 60)
+
+        release_lease('aggregation', 'host-b:1')
+        assert acquire_lease('aggregation', 'host-a:1', 60)
+
+def test_aggregation_worker_runs_scheduler_with_lease(app, runner):
+    """A worker started while another holds the lease stands by, or exits with --no-wait."""
+    def run_scheduler(app, owner):
+        # A worker on another host cannot take over while this one is running
+        with patch('src.backend.app.lease_owner', return_value='host-b:1'):
+            result = runner.invoke(args=['aggregation-worker', '--no-wait'])
+        assert result.exit_code == 1
+        assert 'Another aggregation worker is already running' in result.output
+
+    with patch('src.backend.app.lease_owner', return_value='host-a:1'), \
+         patch('src.backend.app.run_scheduler', side_effect=run_scheduler) as mock_run_scheduler:
+        result = runner.invoke(args=['aggregation-worker'])
+        assert result.exit_code == 0, result.output
+        assert 'Acquired the aggregation lease' in result.output
+        assert mock_run_scheduler.call_args[0][1] == 'host-a:1'
+
+    with patch('src.backend.app.lease_owner', return_value='host-b:1'), \
+         patch('src.backend.app.run_scheduler') as mock_run_scheduler:
+        result = runner.invoke(args=['aggregation-worker'])
+        assert result.exit_code == 0, result.output
+        assert 'standing by' in result.output
+        assert mock_run_scheduler.call_count == 1
+
+def test_scheduler_tick_runs_only_for_lease_holder(app):
+    """The lease holder compacts on every tick, even when no feed is due; a standby does nothing."""
+    with app.app_context():
+        acquire_lease('aggregation', 'host-a:1', 60)
+
+    for owner, runs in (('host-a:1', 1), ('host-b:1', 0)):
+        with patch('src.backend.services.scheduler.BlockingScheduler') as mock_scheduler, \
+             patch('src.backend.services.scheduler.run_aggregation_for_all_users', return_value=None) as mock_run, \
+             patch('src.backend.services.scheduler.index_manager.compact_all', return_value={}) as mock_compact:
+            run_scheduler(app, owner)
+            tick = mock_scheduler.return_value.add_job.call_args_list[0].kwargs['func']
+            tick()
+
+        assert mock_run.call_count == runs
+        assert mock_compact.call_count == runs
@@ -1,13 +1,12 @@
 from unittest.mock import patch, MagicMock
 from langchain_core.runnables import Runnable
 
-@patch('src.backend.services.search.os.path.exists', return_value=True)
-@patch('src.backend.services.search.FAISS.load_local')
+@patch('src.backend.services.search.index_manager.get')
 @patch('src.backend.services.search.RetrievalQA.from_chain_type')
-def test_search(mock_from_chain_type, mock_faiss_load, mock_path_exists, client, auth_token):
+def test_search(mock_from_chain_type, mock_index_get, client, auth_token):
     """Test the search endpoint."""
     mock_retriever = MagicMock(spec=Runnable)
-    mock_faiss_load.return_value.as_retriever.return_value = mock_retriever
+    mock_index_get.return_value.as_retriever.return_value = mock_retriever
     
     mock_qa_chain = MagicMock()
     mock_qa_chain.invoke.return_value = {
@@ -29,3 +28,201 @@ def test_search(mock_from_chain_type, mock_faiss_load, mock_path_exists, client,
     rv = client.post('/search', headers=headers, json={})
     assert rv.status_code == 400
     assert 'Query is required' in rv.get_json()['msg']
+
+@patch('src.backend.services.search.index_manager.version', return_value='v1')
+@patch('src.backend.services.search.index_manager.get')
+@patch('src.backend.services.search.RetrievalQA.from_chain_type')
+def test_search_results_are_cached_per_index_version(mock_from_chain_type, mock_index_get, mock_version, client, auth_token):
+    """Repeated queries are answered from the cache until the index changes."""
+    mock_index_get.return_value.as_retriever.return_value = MagicMock(spec=Runnable)
+    mock_qa_chain = MagicMock()
+    mock_qa_chain.invoke.return_value = {
+        "result": "This is a search result.",
+        "source_documents": [MagicMock(metadata={"source": "test.txt"})]
+    }
+    mock_from_chain_type.return_value = mock_qa_chain
+    headers = {'Authorization': f'Bearer {auth_token}'}
+
+    first = client.post('/search', headers=headers, json={'query': 'Daily briefing?'}).get_json()
+    second = client.post('/search', headers=headers, json={'query': '  daily   BRIEFING '}).get_json()
+    assert first == second
+    assert mock_qa_chain.invoke.call_count == 1
+
+    # A document was added or deleted: the cached answer must not be served
+    mock_version.return_value = 'v2'
+    client.post('/search', headers=headers, json={'query': 'daily briefing'})
+    assert mock_qa_chain.invoke.call_count == 2
+
+def test_result_cache_shared_through_disk(app, tmp_path):
+    """With SEARCH_CACHE_PATH set, answers are visible to other processes."""
+    from src.backend.services.result_cache import result_cache
+    app.config['SEARCH_CACHE_PATH'] = str(tmp_path / "search_cache.db")
+    results = [{"text": "answer", "source": ["a.txt"]}]
+    with app.app_context():
+        result_cache.put(1, "query", "v1", results)
+        # Simulate another worker: nothing in this process's memory
+        result_cache._entries.clear()
+        assert result_cache.get(1, "Query", "v1") == results
+        assert result_cache.get(1, "query", "v2") is None
+        assert result_cache.get(2, "query", "v1") is None
+
+        app.config['SEARCH_CACHE_TTL'] = -1
+        result_cache.put(1, "expired", "v1", results)
+        assert result_cache.get(1, "expired", "v1") is None
+
+@patch('src.backend.services.search.LlamaServerLLM')
+@patch('src.backend.services.search._build_retriever')
+@patch('src.backend.services.search.index_manager.get')
+def test_search_stream(mock_index_get, mock_build_retriever, mock_llm, client, auth_token):
+    """The streaming endpoint sends tokens as SSE events followed by the sources."""
+    mock_build_retriever.return_value.invoke.return_value = [
+        MagicMock(page_content="context", metadata={"source": "test.txt"})
+    ]
+    mock_llm.return_value.stream.return_value = iter(["Hello", " world"])
+    headers = {'Authorization': f'Bearer {auth_token}'}
+
+    rv = client.post('/search/stream', headers=headers, json={'query': 'test query'})
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/event-stream'
+    assert rv.get_data(as_text=True) == (
+        'event: token\ndata: "Hello"\n\n'
+        'event: token\ndata: " world"\n\n'
+        'event: sources\ndata: ["test.txt"]\n\n'
+        'event: done\ndata: {}\n\n'
+    )
+
+    # The streamed answer is cached for both endpoints
+    rv = client.post('/search', headers=headers, json={'query': 'test query'})
+    assert rv.get_json() == [{"text": "Hello world", "source": ["test.txt"]}]
+
+@patch('src.backend.services.search.LlamaServerLLM')
+@patch('src.backend.services.search._build_retriever')
+@patch('src.backend.services.search.index_manager.get')
+def test_search_stream_cut_off(mock_index_get, mock_build_retriever, mock_llm, client, auth_token):
+    """A stream that breaks off ends with an error event and is not cached."""
+    from src.backend.services.custom_llm import LLMError
+
+    def cut_off():
+        yield "Hello"
+        raise LLMError("connection broken")
+
+    mock_build_retriever.return_value.invoke.return_value = [
+        MagicMock(page_content="context", metadata={"source": "test.txt"})
+    ]
+    mock_llm.return_value.stream.return_value = cut_off()
+    headers = {'Authorization': f'Bearer {auth_token}'}
+
+    rv = client.post('/search/stream', headers=headers, json={'query': 'test query'})
+    assert rv.get_data(as_text=True) == (
+        'event: token\ndata: "Hello"\n\n'
+        'event: error\ndata: {"msg": "The answer was cut off, please try again"}\n\n'
+        'event: done\ndata: {}\n\n'
+    )
+
+    # The next request generates the answer again instead of serving the partial one
+    mock_llm.return_value.stream.return_value = iter(["Hello", " world"])
+    rv = client.post('/search/stream', headers=headers, json={'query': 'test query'})
+    assert 'event: sources' in rv.get_data(as_text=True)
+
+@patch('src.backend.services.search.index_manager.version', return_value='v1')
+@patch('src.backend.services.search._build_retriever')
+@patch('src.backend.services.search.index_manager.get')
+@patch('src.backend.services.search.RetrievalQA.from_chain_type')
+def test_search_filters_documents(mock_from_chain_type, mock_index_get, mock_build_retriever, mock_version, app, client, auth_token):
+    """Search filters select the documents the retriever is limited to."""
+    import datetime
+    from src.backend.models import db, Document, User
+    from src.backend.services.result_cache import result_cache
+    user = User.query.filter_by(username='testuser').first()
+    docs = [
+        Document(user_id=user.id, file_path='a', document_type='article', source='https://reuters.com/a',
+                 tags='Markets, AI', uploaded_at=datetime.datetime(2024, 5, 2)),
+        Document(user_id=user.id, file_path='b', document_type='article', source='https://example.com/b',
+                 tags='ai', uploaded_at=datetime.datetime(2024, 5, 1)),
+        Document(user_id=user.id, file_path='c', document_type='pdf', source='report.pdf',
+                 tags='markets', uploaded_at=datetime.datetime(2024, 5, 2)),
+    ]
+    db.session.add_all(docs)
+    db.session.commit()
+    mock_from_chain_type.return_value.invoke.return_value = {
+        "result": "Filtered answer.",
+        "source_documents": [MagicMock(metadata={"source": "https://reuters.com/a"})]
+    }
+    headers = {'Authorization': f'Bearer {auth_token}'}
+
+    def searched_doc_ids(**filters):
+        result_cache.clear()
+        rv = client.post('/search', headers=headers, json={'query': 'test query', **filters})
+        assert rv.status_code == 200
+        return mock_build_retriever.call_args.args[3]
+
+    assert searched_doc_ids() is None
+    assert searched_doc_ids(type='article', start_date='2024-05-02') == [docs[0].id]
+    assert sorted(searched_doc_ids(tags=['markets'])) == [docs[0].id, docs[2].id]
+    assert searched_doc_ids(tags='AI', source='reuters.com', end_date='2024-05-02') == [docs[0].id]
+
+    # Filters matching nothing give no results, without a web search
+    mock_build_retriever.reset_mock()
+    with patch('src.backend.services.search._bing_search') as mock_bing:
+        rv = client.post('/search', headers=headers, json={'query': 'test query', 'type': 'xlsx'})
+        assert rv.get_json() == []
+        events = client.post('/search/stream', headers=headers, json={'query': 'test query', 'type': 'xlsx'}).get_data(as_text=True)
+        assert 'event: result' in events and 'data: []' in events
+        # Nor when the selected documents have no relevant chunks
+        mock_from_chain_type.return_value.invoke.return_value = {"result": "", "source_documents": []}
+        assert client.post('/search', headers=headers, json={'query': 'other query', 'type': 'pdf'}).get_json() == []
+    assert mock_bing.call_count == 0
+    assert mock_build_retriever.call_count == 1
+    mock_from_chain_type.return_value.invoke.return_value = {
+        "result": "Filtered answer.",
+        "source_documents": [MagicMock(metadata={"source": "https://reuters.com/a"})]
+    }
+
+    # Cached answers follow edits of the tags a filter selects on
+    mock_build_retriever.reset_mock()
+    client.post('/search', headers=headers, json={'query': 'test query', 'tags': 'ai'})
+    client.post('/search', headers=headers, json={'query': 'test query', 'tags': 'ai'})
+    assert mock_build_retriever.call_count == 1
+    rv = client.put(f'/documents/{docs[2].id}', headers=headers, json={'tags': 'markets, ai'})
+    assert rv.status_code == 200
+    client.post('/search', headers=headers, json={'query': 'test query', 'tags': 'ai'})
+    assert mock_build_retriever.call_count == 2
+    assert sorted(mock_build_retriever.call_args.args[3]) == [doc.id for doc in docs]
+
+    rv = client.post('/search', headers=headers, json={'query': 'test query', 'start_date': '05/02/2024'})
+    assert rv.status_code == 400
+    rv = client.post('/search', headers=headers, json={'query': 'test query', 'tags': [1]})
+    assert rv.status_code == 400
+
+def test_search_rejects_malformed_filters(client, auth_token):
+    """Filter values of the wrong JSON type are refused with a 400, not a server error."""
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    for filters, msg in (
+        ({'source': 5}, "source must be a string."),
+        ({'type': ['a']}, "type must be a string."),
+        ({'start_date': 5}, "Invalid start_date format. Use YYYY-MM-DD."),
+        ({'end_date': ['2025-01-01']}, "Invalid end_date format. Use YYYY-MM-DD."),
+        ({'tags': [1]}, "tags must be a list of strings."),
+    ):
+        for endpoint in ('/search', '/search/stream'):
+            rv = client.post(endpoint, headers=headers, json={'query': 'test query', **filters})
+            assert rv.status_code == 400
+            assert rv.get_json() == {"msg": msg}
+
+def test_hybrid_retriever_fuses_vector_and_keyword_hits(app):
+    """Chunks found by both retrievers rank first and only top_n reach the reranker."""
+    from langchain_core.documents import Document
+    from src.backend.services.hybrid_retriever import HybridRetriever
+
+    def chunk(doc_id, text):
+        return Document(page_content=text, metadata={"doc_id": doc_id})
+
+    vector_retriever = MagicMock()
+    vector_retriever.invoke.return_value = [chunk(1, "a"), chunk(2, "b"), chunk(3, "c")]
+    retriever = HybridRetriever(user_id=1, vector_retriever=vector_retriever, embeddings=None, top_n=3)
+    with patch('src.backend.services.hybrid_retriever.index_manager.lexical_search',
+               return_value=[chunk(4, "d"), chunk(3, "c")]) as mock_lexical:
+        results = retriever.invoke("AAPL guidance")
+
+    mock_lexical.assert_called_once_with(1, "AAPL guidance", 10, None, None)
+    assert [doc.page_content for doc in results] == ["c", "a", "d"]
@@ -12,22 +12,103 @@ CREATE TABLE user (
 
 -- Create the 'document' table
 CREATE TABLE document (
-    id INTEGER NOT NULL,
+    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
     file_path VARCHAR(255) NOT NULL,
     document_type VARCHAR(50) NOT NULL,
     source VARCHAR(255),
     tags VARCHAR(255),
     uploaded_at DATETIME,
+    terms_counted BOOLEAN,
+    FOREIGN KEY(user_id) REFERENCES user (id)
+);
+
+-- Create the 'document_text' table
+CREATE TABLE document_text (
+    document_id INTEGER NOT NULL,
+    content BLOB NOT NULL,
+    PRIMARY KEY (document_id),
+    FOREIGN KEY(document_id) REFERENCES document (id)
+);
+
+-- Create the 'document_term' table
+CREATE TABLE document_term (
+    document_id INTEGER NOT NULL,
+    term VARCHAR(64) NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (document_id, term),
+    FOREIGN KEY(document_id) REFERENCES document (id)
+);
+
+-- Create the 'user_term' table
+CREATE TABLE user_term (
+    user_id INTEGER NOT NULL,
+    term VARCHAR(64) NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_id, term),
+    FOREIGN KEY(user_id) REFERENCES user (id)
+);
+
+-- Create the 'ingest_job' table
+CREATE TABLE ingest_job (
+    id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    filename VARCHAR(255) NOT NULL,
+    file_path VARCHAR(255) NOT NULL,
+    document_type VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    stage VARCHAR(20),
+    error TEXT,
+    document_id INTEGER,
+    bulk_id VARCHAR(32),
+    notified BOOLEAN NOT NULL,
+    created_at DATETIME,
+    updated_at DATETIME,
     PRIMARY KEY (id),
     FOREIGN KEY(user_id) REFERENCES user (id)
 );
 
+CREATE INDEX ix_ingest_job_bulk_id ON ingest_job (bulk_id);
+
 -- Create the 'rss_feed' table
 CREATE TABLE rss_feed (
     id INTEGER NOT NULL,
     user_id INTEGER NOT NULL,
     url VARCHAR(255) NOT NULL,
+    etag VARCHAR(255),
+    last_modified VARCHAR(64),
+    poll_interval INTEGER,
+    next_poll_at DATETIME,
     PRIMARY KEY (id),
     FOREIGN KEY(user_id) REFERENCES user (id)
 );
+
+-- Create the 'feed_entry' table
+CREATE TABLE feed_entry (
+    id INTEGER NOT NULL,
+    feed_id INTEGER NOT NULL,
+    entry_key VARCHAR(40) NOT NULL,
+    ingested_at DATETIME,
+    PRIMARY KEY (id),
+    UNIQUE (feed_id, entry_key),
+    FOREIGN KEY(feed_id) REFERENCES rss_feed (id)
+);
+
+-- Create the 'aggregation_run' table
+CREATE TABLE aggregation_run (
+    id INTEGER NOT NULL,
+    started_at DATETIME,
+    finished_at DATETIME,
+    new_count INTEGER,
+    skipped_count INTEGER,
+    failed_count INTEGER,
+    PRIMARY KEY (id)
+);
+
+-- Create the 'scheduler_lease' table
+CREATE TABLE scheduler_lease (
+    name VARCHAR(64) NOT NULL,
+    owner VARCHAR(255) NOT NULL,
+    expires_at DATETIME NOT NULL,
+    PRIMARY KEY (name)
+);
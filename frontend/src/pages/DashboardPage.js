@@ -1,5 +1,5 @@
 import React, { useState, useEffect, useCallback } from 'react';
-import { getDocuments, uploadDocument, deleteDocument, search, getKeywordReport, getFeeds, addFeed, deleteFeed, editDocumentMetadata, batchDeleteDocuments, getClusteringReport } from '../services/api';
+import { getDocuments, uploadDocument, waitForIngestJob, deleteDocument, search, getKeywordReport, getFeeds, addFeed, deleteFeed, editDocumentMetadata, batchDeleteDocuments, getClusteringReport } from '../services/api';
 
 const DashboardPage = () => {
   const [documents, setDocuments] = useState([]);
@@ -43,9 +43,13 @@ const DashboardPage = () => {
     e.preventDefault();
     if (!file) return;
     try {
-      await uploadDocument(file);
-      fetchDocuments(); // Refresh document list
+      const response = await uploadDocument(file);
       setFile(null); // Clear the file input
+      const job = await waitForIngestJob(response.data.job_id);
+      if (job.status === 'failed') {
+        console.error('Failed to process document', job.error);
+      }
+      fetchDocuments(); // Refresh document list
     } catch (error) {
       console.error('Failed to upload document', error);
     }
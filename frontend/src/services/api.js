@@ -40,6 +40,21 @@ export const uploadDocument = (file) => {
   return apiClient.post('/documents', formData);
 };
 
+export const getIngestJob = (jobId) => {
+  return apiClient.get(`/documents/jobs/${jobId}`);
+};
+
+// Uploads are processed in the background; poll the job until it finishes
+export const waitForIngestJob = async (jobId, interval = 1000) => {
+  for (;;) {
+    const response = await getIngestJob(jobId);
+    if (response.data.status === 'done' || response.data.status === 'failed') {
+      return response.data;
+    }
+    await new Promise((resolve) => setTimeout(resolve, interval));
+  }
+};
+
 export const deleteDocument = (docId) => {
   return apiClient.delete(`/documents/${docId}`);
 };
@@ -48,12 +63,12 @@ export const batchDeleteDocuments = (docIds) => {
   return apiClient.post('/documents/batch_delete', { doc_ids: docIds });
 };
 
-export const search = (query) => {
-  return apiClient.post('/search', { query });
+export const search = (query, filters = {}) => {
+  return apiClient.post('/search', { query, ...filters });
 };
 
-export const getKeywordReport = () => {
-  return apiClient.get('/report/keywords');
+export const getKeywordReport = (params = {}) => {
+  return apiClient.get('/report/keywords', { params });
 };
 
 export const getClusteringReport = () => {